@@ -0,0 +1,189 @@
+# Copyright (c) 2026, the Dart project authors.  Please see the AUTHORS file
+# for details. All rights reserved. Use of this source code is governed by a
+# BSD-style license that can be found in the LICENSE file.
+
+"""Micro benchmarks of the redirector's hot paths.
+
+Nothing is fetched from Google Storage: the docs are served from memory, and
+the files of the cloudstorage benchmarks are read from a FakeStorageApi. Run
+from this directory with the App Engine SDK on the path:
+
+  PYTHONPATH=<path to google_appengine> python benchmark.py <benchmark>
+
+Benchmarks:
+
+  routes: time to match typical request paths with the PrefixRouter of the
+      redirector and with the linear webapp2.Router it replaces.
+
+  readinto: bytes per second and peak memory of reading a --megabytes file
+      with ReadBuffer.readinto into one preallocated buffer, with read in
+      chunks of the same size, and with a single read of the whole file.
+      Memory is measured in a child process, so this only runs on Linux.
+
+  lines: seconds to iterate over the lines of files of a quarter, half and
+      all of --megabytes, of short lines and of lines many buffers long. The
+      time per megabyte stays the same when the iteration is linear.
+"""
+
+import argparse
+import os
+import pickle
+import resource
+import time
+
+try:
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+except ImportError:
+  pass
+
+# As on App Engine, where google.appengine.ext.webapp is webapp2.
+os.environ.setdefault('APPENGINE_RUNTIME', 'python27')
+os.environ.setdefault('DOCS_STORAGE', 'memory')
+
+import webapp2
+
+# Most requests are for pages of a docs version, which only the catch-all
+# route at the end of the list matches.
+ROUTE_PATHS = [
+  '/stable/3.4.0/dart-core/String-class.html',
+  '/stable/3.4.0/dart-async/Future/then.html',
+  '/dev/3.5.0-200.0.dev/dart-html/Element-class.html',
+  '/stable/3.4.0/static-assets/styles.css',
+  '/stable',
+  '/apidocs/channels/stable/docs/index.html',
+  '/docs/channels/stable/latest/dart_core.html',
+  '/dart_core/Iterable.html',
+]
+
+
+def timed(func, repeat):
+  """Seconds per call of func, the best of three runs of repeat calls."""
+  best = None
+  for _ in range(3):
+    start = time.time()
+    for _ in xrange(repeat):
+      func()
+    elapsed = (time.time() - start) / repeat
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+def measured(func):
+  """Call func in a child process. Returns its result and the peak memory,
+  in bytes, the child used on top of what it started with."""
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    with open('/proc/self/statm') as f:
+      start = int(f.read().split()[1]) * resource.getpagesize()
+    result = func()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - start
+    with os.fdopen(write_fd, 'wb') as f:
+      pickle.dump((result, max(peak, 0)), f)
+    os._exit(0)
+  os.close(write_fd)
+  with os.fdopen(read_fd, 'rb') as f:
+    result = pickle.load(f)
+  os.waitpid(pid, 0)
+  return result
+
+
+def bench_routes(args):
+  import redirector
+  routes = redirector.application.router.match_routes
+  routers = [('prefix', redirector.PrefixRouter(routes)),
+             ('linear', webapp2.Router(routes))]
+  print '%-52s %10s %10s' % ('path', 'prefix us', 'linear us')
+  for path in ROUTE_PATHS:
+    request = webapp2.Request.blank(path, base_url='http://api.dart.dev')
+    times = [timed(lambda: router.match(request), args.repeat) * 1e6
+             for _, router in routers]
+    print '%-52s %10.1f %10.1f' % (path, times[0], times[1])
+
+
+def bench_readinto(args):
+  from cloudstorage import storage_api
+  from cloudstorage import test_utils
+  path = '/dartlang-api-docs/benchmark'
+  size = args.megabytes * 1024 * 1024
+  chunk_size = storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE
+  api = test_utils.FakeStorageApi()
+  api.put(path, 'x' * size)
+
+  def read_chunks(f):
+    while f.read(chunk_size):
+      pass
+
+  def readinto(f):
+    b = bytearray(chunk_size)
+    while f.readinto(b):
+      pass
+
+  def read_all(f):
+    f.read()
+
+  print '%-10s %10s %10s' % ('method', 'MB/s', 'peak MB')
+  for name, read in (('readinto', readinto), ('read', read_chunks),
+                     ('read all', read_all)):
+    def run():
+      start = time.time()
+      read(storage_api.ReadBuffer(api, path))
+      return time.time() - start
+    seconds, peak = measured(run)
+    print '%-10s %10.0f %10.1f' % (name, args.megabytes / seconds,
+                                   peak / 1024.0 / 1024)
+
+
+def bench_lines(args):
+  from cloudstorage import storage_api
+  from cloudstorage import test_utils
+  path = '/dartlang-api-docs/benchmark'
+  buffer_size = storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE
+  api = test_utils.FakeStorageApi()
+
+  def count_lines():
+    count = 0
+    for _ in storage_api.ReadBuffer(api, path):
+      count += 1
+    return count
+
+  print '%-6s %8s %10s %10s %10s' % ('lines', 'MB', 'lines', 'seconds',
+                                     'ms/MB')
+  for name, line_size in (('short', 80), ('long', buffer_size * 8)):
+    line = 'x' * (line_size - 1) + '\n'
+    for megabytes in (args.megabytes / 4.0, args.megabytes / 2.0,
+                      args.megabytes):
+      lines = int(megabytes * 1024 * 1024) // line_size
+      api.put(path, line * lines)
+      start = time.time()
+      count = count_lines()
+      seconds = time.time() - start
+      assert count == lines
+      print '%-6s %8.0f %10d %10.2f %10.1f' % (name, megabytes, count,
+                                               seconds,
+                                               seconds * 1000 / megabytes)
+
+
+BENCHMARKS = {
+  'routes': bench_routes,
+  'readinto': bench_readinto,
+  'lines': bench_lines,
+}
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Micro benchmarks of the redirector.')
+  parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+  parser.add_argument('--repeat', type=int, default=2000,
+                      help='calls per timed run')
+  parser.add_argument('--megabytes', type=int, default=100,
+                      help='size of the files read')
+  args = parser.parse_args()
+  BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+  main()
@@ -21,6 +21,7 @@ from __future__ import with_statement
 
 
 __all__ = ['delete',
+           'download',
            'listbucket',
            'open',
            'stat',
@@ -28,6 +29,7 @@ __all__ = ['delete',
 
 import logging
 import StringIO
+import time
 import urllib
 import xml.etree.cElementTree as ET
 from . import api_utils
@@ -35,6 +37,11 @@ from . import common
 from . import errors
 from . import storage_api
 
+try:
+  from google.appengine.ext import ndb
+except ImportError:
+  from google.appengine.ext import ndb
+
 
 
 def open(filename,
@@ -43,7 +50,10 @@ def open(filename,
          options=None,
          read_buffer_size=storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE,
          retry_params=None,
-         _account_id=None):
+         _account_id=None,
+         max_readahead=storage_api.ReadBuffer.DEFAULT_MAX_READAHEAD,
+         lazy=False,
+         block_cache=None):
   """Opens a Google Cloud Storage file and returns it as a File-like object.
 
   Args:
@@ -66,6 +76,18 @@ def open(filename,
     retry_params: An instance of api_utils.RetryParams for subsequent calls
       to GCS from this file handle. If None, the default one is used.
     _account_id: Internal-use only.
+    max_readahead: Max number of buffers read keeps in flight ahead of the
+      one being read, so that fast sequential reads do not wait on the
+      network for every buffer. Memory use is bounded by
+      read_buffer_size * (max_readahead + 1). Only valid in reading mode.
+    lazy: True to skip the HEAD request and to send no request at all until
+      the file is first read or sought. The size and etag of the file are
+      then taken from the first GET, which saves one request per open. A
+      missing file is only reported by that first read or seek. Only valid
+      in reading mode.
+    block_cache: A storage_api.BlockCache to read the file through, for files
+      that are read at random offsets. Buffers are then the blocks of the
+      cache and read_buffer_size is ignored. Only valid in reading mode.
 
   Returns:
     A reading or writing buffer that supports File-like interface. Buffer
@@ -91,7 +113,10 @@ def open(filename,
                        'for writing mode.')
     return storage_api.ReadBuffer(api,
                                   filename,
-                                  buffer_size=read_buffer_size)
+                                  buffer_size=read_buffer_size,
+                                  max_readahead=max_readahead,
+                                  lazy=lazy,
+                                  block_cache=block_cache)
   else:
     raise ValueError('Invalid mode %s.' % mode)
 
@@ -151,6 +176,94 @@ def stat(filename, retry_params=None, _account_id=None):
   return file_stat
 
 
+def download(filename,
+             fileobj,
+             concurrency=8,
+             part_size=storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE * 4,
+             retry_params=None,
+             _account_id=None):
+  """Download a Google Cloud Storage file with parallel ranged GETs.
+
+  The file is split by the size from stat into parts of part_size bytes, and
+  up to concurrency of them are fetched at the same time. Parts are written
+  to fileobj in order as soon as all the parts before them have arrived, so
+  at most concurrency parts are held in memory.
+
+  Args:
+    filename: A Google Cloud Storage filename of form '/bucket/filename'.
+    fileobj: A File-like object open for writing, positioned where the
+      content of the file should go.
+    concurrency: Max number of GETs in flight.
+    part_size: Number of bytes to fetch with one GET. Max is 30MB.
+    retry_params: An api_utils.RetryParams for the calls to GCS. If None,
+      the default one is used.
+    _account_id: Internal-use only.
+
+  Returns:
+    A dict with the number of 'bytes' and 'parts' downloaded, the 'seconds'
+    it took and the resulting 'bytes_per_second'.
+
+  Raises:
+    errors.AuthorizationError: if authorization failed.
+    errors.NotFoundError: if an object that's expected to exist doesn't.
+    ValueError: if the file has changed while downloading, or if part_size
+      or concurrency are out of range.
+  """
+  if not 0 < part_size <= storage_api.ReadBuffer.MAX_REQUEST_SIZE:
+    raise ValueError('part_size must be between 1 and %d.'
+                     % storage_api.ReadBuffer.MAX_REQUEST_SIZE)
+  if concurrency < 1:
+    raise ValueError('concurrency must be at least 1.')
+
+  start_time = time.time()
+  file_stat = stat(filename, retry_params=retry_params,
+                   _account_id=_account_id)
+  size = file_stat.st_size
+  api = storage_api._get_storage_api(retry_params=retry_params,
+                                     account_id=_account_id)
+  path = api_utils._quote_filename(filename)
+  num_parts = (size + part_size - 1) // part_size
+
+  in_flight = {}
+  done = {}
+  next_part = 0
+  next_write = 0
+  while next_write < num_parts:
+    # Only fetch ahead of the first part not written yet by concurrency parts,
+    # so that parts waiting to be written stay bounded.
+    while (next_part < num_parts and
+           next_part - next_write < concurrency):
+      start = next_part * part_size
+      end = min(start + part_size, size) - 1
+      future = api.get_object_async(
+          path, headers={'Range': 'bytes=%d-%d' % (start, end)})
+      in_flight[future] = (next_part, end - start + 1)
+      next_part += 1
+
+    future = ndb.Future.wait_any(in_flight.keys())
+    index, length = in_flight.pop(future)
+    status, resp_headers, content = future.get_result()
+    errors.check_status(status, [200, 206], filename,
+                        resp_headers=resp_headers, body=content)
+    etag = resp_headers.get('etag')
+    if etag is not None and etag.strip('"') != file_stat.etag:
+      raise ValueError('File on GCS has changed while reading.')
+    if len(content) != length:
+      raise ValueError('Expected %d bytes of part %d of %s, got %d.'
+                       % (length, index, filename, len(content)))
+    done[index] = content
+
+    while next_write in done:
+      fileobj.write(done.pop(next_write))
+      next_write += 1
+
+  seconds = time.time() - start_time
+  return {'bytes': size,
+          'parts': num_parts,
+          'seconds': seconds,
+          'bytes_per_second': size / seconds if seconds else None}
+
+
 def _copy2(src, dst, metadata=None, retry_params=None):
   """Copy the file content from src to dst.
 
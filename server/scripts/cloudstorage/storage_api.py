@@ -18,12 +18,15 @@
 
 
 
-__all__ = ['ReadBuffer',
+__all__ = ['BlockCache',
+           'ReadBuffer',
            'StreamingBuffer',
           ]
 
 import collections
 import os
+import threading
+import time
 import urlparse
 
 from . import api_utils
@@ -173,38 +176,173 @@ class _StorageApi(rest_api._RestApi):
 _StorageApi = rest_api.add_sync_methods(_StorageApi)
 
 
+class BlockCache(object):
+  """A cache of blocks of Google storage files shared by ReadBuffers.
+
+  Files are cut into aligned blocks of block_size bytes. A block is cached
+  under the path and etag of its file and its index, so a file that is
+  replaced is never read from stale blocks. Blocks are evicted least recently
+  used first once their total size is over max_bytes.
+
+  A ReadBuffer that misses a block also fetches, in the same request, up to
+  prefetch_blocks of the blocks after it that are not cached either, so that
+  reads near each other after a seek hit the cache.
+
+  The cache is thread safe. One instance is meant to be shared by all the
+  ReadBuffers of a process that read files randomly.
+  """
+
+  DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+  DEFAULT_PREFETCH_BLOCKS = 1
+
+  def __init__(self,
+               max_bytes=DEFAULT_MAX_BYTES,
+               block_size=None,
+               prefetch_blocks=DEFAULT_PREFETCH_BLOCKS):
+    """Constructor.
+
+    Args:
+      max_bytes: Max total size of the cached blocks.
+      block_size: Size of a block. This is also the buffer size of the
+        ReadBuffers using the cache. Defaults to
+        ReadBuffer.DEFAULT_BUFFER_SIZE.
+      prefetch_blocks: Number of blocks after a missed block to fetch with it.
+    """
+    if block_size is None:
+      block_size = ReadBuffer.DEFAULT_BUFFER_SIZE
+    assert block_size > 0
+    assert prefetch_blocks >= 0
+    self.max_bytes = max_bytes
+    self.block_size = block_size
+    self.prefetch_blocks = prefetch_blocks
+    self._blocks = collections.OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    """Returns the block cached for key, or None.
+
+    Args:
+      key: a (path, etag, block index) tuple.
+    """
+    with self._lock:
+      block = self._blocks.pop(key, None)
+      if block is None:
+        self.misses += 1
+        return None
+      self._blocks[key] = block
+      self.hits += 1
+      return block
+
+  def __contains__(self, key):
+    """Whether key is cached. Does not count as a hit or a miss."""
+    with self._lock:
+      return key in self._blocks
+
+  def set(self, key, block):
+    """Caches block under key, a (path, etag, block index) tuple."""
+    with self._lock:
+      old = self._blocks.pop(key, None)
+      if old is not None:
+        self._bytes -= len(old)
+      self._blocks[key] = block
+      self._bytes += len(block)
+      while self._blocks and self._bytes > self.max_bytes:
+        _, evicted = self._blocks.popitem(last=False)
+        self._bytes -= len(evicted)
+        self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._blocks.clear()
+      self._bytes = 0
+
+  def memory_usage(self):
+    """Total size of the cached blocks."""
+    return self._bytes
+
+  def __len__(self):
+    return len(self._blocks)
+
+  def stats(self):
+    return {'blocks': len(self._blocks), 'bytes': self._bytes,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions}
+
+
 class ReadBuffer(object):
   """A class for reading Google storage files."""
 
   DEFAULT_BUFFER_SIZE = 1024 * 1024
   MAX_REQUEST_SIZE = 30 * DEFAULT_BUFFER_SIZE
+  DEFAULT_MAX_READAHEAD = 4
+  # Waiting longer than this for the next buffer counts as being blocked on
+  # the network.
+  BLOCKED_THRESHOLD = 0.001
 
   def __init__(self,
                api,
                path,
                buffer_size=DEFAULT_BUFFER_SIZE,
-               max_request_size=MAX_REQUEST_SIZE):
+               max_request_size=MAX_REQUEST_SIZE,
+               max_readahead=DEFAULT_MAX_READAHEAD,
+               lazy=False,
+               block_cache=None):
     """Constructor.
 
     Args:
       api: A StorageApi instance.
       path: Quoted/escaped path to the object, e.g. /mybucket/myfile
       buffer_size: buffer size. The ReadBuffer keeps
-        one buffer. But there may be a pending future that contains
-        a second buffer. This size must be less than max_request_size.
+        one buffer. But there may be pending futures that contain
+        the following buffers. This size must be less than max_request_size.
       max_request_size: Max bytes to request in one urlfetch.
+      max_readahead: Max number of buffers requested ahead of the current
+        one. The number actually kept in flight starts at one, doubles each
+        time a read has to wait for the network and shrinks by one each time
+        it does not.
+      lazy: True to send no request until the file is first read or sought.
+        The HEAD request is then skipped altogether: the size and etag of the
+        file are taken from the response to the GET of the first buffer. A
+        missing file is only reported by that first read or seek.
+      block_cache: A BlockCache to read the file through, or None. Buffers
+        are then the aligned blocks of the cache, and buffer_size is ignored.
+        The cache is not kept when the ReadBuffer is pickled.
     """
     self._api = api
     self._path = path
     self.name = api_utils._unquote_filename(path)
     self.closed = False
 
+    if block_cache is not None:
+      buffer_size = block_cache.block_size
     assert buffer_size <= max_request_size
+    assert max_readahead >= 1
+    self._block_cache = block_cache
+    # Futures of the blocks being fetched for this buffer, by block index.
+    self._pending_blocks = {}
     self._buffer_size = buffer_size
     self._max_request_size = max_request_size
+    self._max_readahead = max_readahead
+    self._readahead_depth = 1
+    self._readahead = collections.deque()
     self._offset = 0
     self._buffer = _Buffer()
     self._etag = None
+    # Time spent by reads waiting for buffers, and the number of waits.
+    self.blocked_seconds = 0.0
+    self.blocked_reads = 0
+    # Seeks served from the current buffer or the readahead window, and seeks
+    # that had to request data again.
+    self.buffered_seeks = 0
+    self.refetched_seeks = 0
+
+    if lazy:
+      self._file_size = None
+      return
 
     get_future = self._get_segment(0, self._buffer_size, check_response=False)
 
@@ -213,11 +351,10 @@ class ReadBuffer(object):
     self._file_size = long(common.get_stored_content_length(headers))
     self._check_etag(headers.get('etag'))
 
-    self._buffer_future = None
-
     if self._file_size != 0:
       content, check_response_closure = get_future.get_result()
       check_response_closure()
+      self._cache_block(0, content)
       self._buffer.reset(content)
       self._request_next_buffer()
 
@@ -239,7 +376,8 @@ class ReadBuffer(object):
             'etag': self._etag,
             'size': self._file_size,
             'offset': self._offset,
-            'closed': self.closed}
+            'closed': self.closed,
+            'max_readahead': self._max_readahead}
 
   def __setstate__(self, state):
     """Restore state as part of deserialization/unpickling.
@@ -259,23 +397,34 @@ class ReadBuffer(object):
     self._offset = state['offset']
     self._buffer = _Buffer()
     self.closed = state['closed']
-    self._buffer_future = None
-    if self._remaining() and not self.closed:
+    self._max_readahead = state.get('max_readahead',
+                                    self.DEFAULT_MAX_READAHEAD)
+    self._readahead_depth = 1
+    self._readahead = collections.deque()
+    self._block_cache = None
+    self._pending_blocks = {}
+    self.blocked_seconds = 0.0
+    self.blocked_reads = 0
+    # Seeks served from the current buffer or the readahead window, and seeks
+    # that had to request data again.
+    self.buffered_seeks = 0
+    self.refetched_seeks = 0
+    if self._file_size is not None and self._remaining() and not self.closed:
       self._request_next_buffer()
 
   def __iter__(self):
     """Iterator interface.
 
-    Note the ReadBuffer container itself is the iterator. It's
-    (quote PEP0234)
+    Note iterating reads the lines from the current offset and moves it, like
+    iterating over a file. It's (quote PEP0234)
     'destructive: they consumes all the values and a second iterator
     cannot easily be created that iterates independently over the same values.
     You could open the file for the second time, or seek() to the beginning.'
 
     Returns:
-      Self.
+      A generator of the lines from the current offset to EOF.
     """
-    return self
+    return self._iter_lines()
 
   def next(self):
     line = self.readline()
@@ -303,6 +452,7 @@ class ReadBuffer(object):
       IOError: When this buffer is closed.
     """
     self._check_open()
+    self._ensure_open()
     if size == 0 or not self._remaining():
       return ''
 
@@ -315,8 +465,7 @@ class ReadBuffer(object):
       data_list.append(data)
       if size == 0 or not self._remaining():
         return ''.join(data_list)
-      self._buffer.reset(self._buffer_future.get_result())
-      self._request_next_buffer()
+      self._next_buffer()
       newline_offset = self._buffer.find_newline(size)
 
     data = self._buffer.read_to_offset(newline_offset + 1)
@@ -325,6 +474,65 @@ class ReadBuffer(object):
 
     return ''.join(data_list)
 
+  def readlines(self, hint=-1):
+    """Read lines until EOF and return them as a list.
+
+    Args:
+      hint: If positive, stop once lines totalling at least hint bytes have
+        been read.
+
+    Returns:
+      A list of the lines read, each with its trailing newline character.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    lines = []
+    total = 0
+    for line in self._iter_lines():
+      lines.append(line)
+      total += len(line)
+      if 0 < hint <= total:
+        break
+    return lines
+
+  def _iter_lines(self):
+    """Yield the lines from the current offset to EOF.
+
+    Each buffer is scanned once, from where the previous line ended, so
+    iterating is linear in the size of the file however long the lines are.
+    The pieces of a line that spans buffers are only joined once its end is
+    found. Nothing is kept in the generator between lines: the position is
+    self._offset and the buffer, so reads and seeks between lines are seen.
+
+    Yields:
+      Each line as a string, with its trailing newline character.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    while True:
+      self._check_open()
+      self._ensure_open()
+      pieces = []
+      while True:
+        newline_offset = self._buffer.find_newline()
+        if newline_offset >= 0:
+          data = self._buffer.read_to_offset(newline_offset + 1)
+          self._offset += len(data)
+          pieces.append(data)
+          break
+        data = self._buffer.read()
+        self._offset += len(data)
+        if data:
+          pieces.append(data)
+        if not self._remaining():
+          break
+        self._next_buffer()
+      if not pieces:
+        return
+      yield pieces[0] if len(pieces) == 1 else ''.join(pieces)
+
   def read(self, size=-1):
     """Read data from RAW file.
 
@@ -340,6 +548,7 @@ class ReadBuffer(object):
       IOError: When this buffer is closed.
     """
     self._check_open()
+    self._ensure_open()
     if not self._remaining():
       return ''
 
@@ -355,36 +564,153 @@ class ReadBuffer(object):
         self._offset += remaining
         data_list.append(self._buffer.read())
 
-        if self._buffer_future is None:
+        if not self._readahead:
           if size < 0 or size >= self._remaining():
             needs = self._remaining()
           else:
             needs = size
           data_list.extend(self._get_segments(self._offset, needs))
           self._offset += needs
+          # The buffer no longer ends at self._offset.
+          self._buffer.reset()
           break
 
-        if self._buffer_future:
-          self._buffer.reset(self._buffer_future.get_result())
-          self._buffer_future = None
+        self._next_buffer(refill=False)
 
-    if self._buffer_future is None:
-      self._request_next_buffer()
+    self._request_next_buffer()
     return ''.join(data_list)
 
+  def readinto(self, b):
+    """Read data from RAW file into a writable buffer.
+
+    Unlike read, no string is made of the data. It is copied once, from the
+    responses straight into b, so a large file can be read through a single
+    preallocated buffer.
+
+    Args:
+      b: a writable object supporting the buffer protocol, e.g. a bytearray
+        or a memoryview of one.
+
+    Returns:
+      Number of bytes read into b. Always len(b) unless EOF is reached. 0 at
+      EOF.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    self._ensure_open()
+    view = memoryview(b)
+    size = min(len(view), self._remaining())
+    if size <= 0:
+      return 0
+
+    filled = 0
+    while True:
+      count = self._buffer.readinto(view[filled:size])
+      filled += count
+      self._offset += count
+      if filled == size:
+        break
+      if not self._readahead:
+        for segment in self._get_segments(self._offset, size - filled):
+          view[filled:filled + len(segment)] = segment
+          filled += len(segment)
+          self._offset += len(segment)
+        self._buffer.reset()
+        break
+      self._next_buffer(refill=False)
+
+    self._request_next_buffer()
+    return filled
+
   def _remaining(self):
     return self._file_size - self._offset
 
+  def _ensure_open(self):
+    """Send the first GET of a lazily opened file if it has not been sent."""
+    if self._file_size is None:
+      self._open()
+
+  def _open(self):
+    """Read the first buffer of a lazily opened file.
+
+    The size of the file is the total length in the Content-Range of a 206
+    response, or the length of the body of a 200 response, which holds the
+    whole file. Google Storage answers 416 to a range request on an empty
+    file.
+
+    Raises:
+      errors.NotFoundError: if the file does not exist.
+    """
+    headers = {'Range': 'bytes=0-%d' % (self._buffer_size - 1)}
+    status, resp_headers, content = self._api.get_object(self._path,
+                                                         headers=headers)
+    errors.check_status(status, [200, 206, 416], self._path, headers,
+                        resp_headers, body=content)
+    self._check_etag(resp_headers.get('etag'))
+    if status == 416:
+      content = ''
+      file_size = 0
+    elif status == 206:
+      file_size = long(resp_headers['content-range'].rsplit('/', 1)[1])
+    else:
+      file_size = len(content)
+    self._file_size = file_size
+    if status == 206:
+      self._cache_block(0, content)
+    self._buffer.reset(content)
+    self._request_next_buffer()
+
   def _request_next_buffer(self):
-    """Request next buffer.
+    """Request the buffers after the current one up to the readahead depth.
 
     Requires self._offset and self._buffer are in consistent state.
     """
-    self._buffer_future = None
-    next_offset = self._offset + self._buffer.remaining()
-    if next_offset != self._file_size:
-      self._buffer_future = self._get_segment(next_offset,
-                                              self._buffer_size)
+    if self._readahead:
+      next_offset = self._readahead[-1][0] + self._buffer_size
+    else:
+      next_offset = self._offset + self._buffer.remaining()
+      if self._block_cache is not None:
+        next_offset -= next_offset % self._buffer_size
+    while (len(self._readahead) < self._readahead_depth and
+           next_offset < self._file_size):
+      if self._block_cache is not None:
+        future = self._get_block(next_offset // self._buffer_size)
+      else:
+        future = self._get_segment(next_offset, self._buffer_size)
+      self._readahead.append((next_offset, future))
+      next_offset += self._buffer_size
+
+  def _next_buffer(self, refill=True):
+    """Make the first buffer of the readahead window the current buffer.
+
+    The readahead depth grows when the read had to wait for it and shrinks
+    when it was already there.
+
+    Args:
+      refill: True to request the following buffers right away.
+    """
+    start, future = self._readahead.popleft()
+    began = time.time()
+    content = future.get_result()
+    waited = time.time() - began
+    self.blocked_seconds += waited
+    if waited > self.BLOCKED_THRESHOLD:
+      self.blocked_reads += 1
+      self._readahead_depth = min(self._readahead_depth * 2,
+                                  self._max_readahead)
+    elif self._readahead_depth > 1:
+      self._readahead_depth -= 1
+    # Blocks of a BlockCache start before the offset after a seek.
+    self._buffer.reset(content, self._offset - start)
+    if refill:
+      self._request_next_buffer()
+
+  @property
+  def readahead_depth(self):
+    """Number of buffers currently requested ahead of the current one."""
+    return self._readahead_depth
 
   def _get_segments(self, start, request_size):
     """Get segments of the file from Google Storage as a list.
@@ -402,6 +728,8 @@ class ReadBuffer(object):
     """
     if not request_size:
       return []
+    if self._block_cache is not None:
+      return self._get_blocks(start, request_size)
 
     end = start + request_size
     futures = []
@@ -414,6 +742,101 @@ class ReadBuffer(object):
       futures.append(self._get_segment(start, end-start))
     return [fut.get_result() for fut in futures]
 
+  def _get_blocks(self, start, request_size):
+    """Get segments of the file from the block cache as a list.
+
+    Args:
+      start: start offset to request. Inclusive. Have to be within the
+        range of the file.
+      request_size: number of bytes to request.
+
+    Returns:
+      A list of file segments in order
+    """
+    first = start // self._buffer_size
+    last = (start + request_size - 1) // self._buffer_size
+    futures = [self._get_block(index) for index in xrange(first, last + 1)]
+    segments = [future.get_result() for future in futures]
+    segments[-1] = segments[-1][:start + request_size -
+                                last * self._buffer_size]
+    segments[0] = segments[0][start - first * self._buffer_size:]
+    return segments
+
+  def _get_block(self, index):
+    """Get a block of the file through the block cache.
+
+    A block that is neither cached nor being fetched is fetched together
+    with the following blocks that are not either, up to the prefetch_blocks
+    of the cache.
+
+    Args:
+      index: index of the block. Have to be within the range of the file.
+
+    Returns:
+      A Future of the content of the block.
+    """
+    start = index * self._buffer_size
+    if self._etag is None:
+      # Without an etag a cached block cannot be told from a stale one.
+      return self._get_segment(start, self._buffer_size)
+    future = self._pending_blocks.get(index)
+    if future is not None:
+      return future
+    content = self._block_cache.get((self._path, self._etag, index))
+    if content is not None:
+      future = ndb.Future()
+      future.set_result(content)
+      return future
+
+    last = index
+    last_block = (self._file_size - 1) // self._buffer_size
+    max_blocks = max(self._max_request_size // self._buffer_size, 1)
+    while (last < last_block and
+           last - index < min(self._block_cache.prefetch_blocks,
+                              max_blocks - 1) and
+           last + 1 not in self._pending_blocks and
+           (self._path, self._etag, last + 1) not in self._block_cache):
+      last += 1
+    fetch = self._fetch_blocks(index, last)
+    for i in xrange(index, last + 1):
+      self._pending_blocks[i] = self._pick_block(fetch, i - index)
+    return self._pending_blocks[index]
+
+  @ndb.tasklet
+  def _fetch_blocks(self, first, last):
+    """Fetch the blocks first to last in one request and cache them.
+
+    Yields:
+      The list of the contents of the blocks.
+    """
+    try:
+      content = yield self._get_segment(
+          first * self._buffer_size, (last - first + 1) * self._buffer_size)
+    finally:
+      for index in xrange(first, last + 1):
+        self._pending_blocks.pop(index, None)
+    blocks = []
+    for index in xrange(first, last + 1):
+      offset = (index - first) * self._buffer_size
+      block = content[offset:offset + self._buffer_size]
+      self._cache_block(index, block)
+      blocks.append(block)
+    raise ndb.Return(blocks)
+
+  @ndb.tasklet
+  def _pick_block(self, fetch, position):
+    blocks = yield fetch
+    raise ndb.Return(blocks[position])
+
+  def _cache_block(self, index, content):
+    """Cache a block read from the file, if reading through a block cache."""
+    if self._block_cache is None or self._etag is None:
+      return
+    if len(content) == self._buffer_size or (
+        self._file_size is not None and
+        index * self._buffer_size + len(content) == self._file_size):
+      self._block_cache.set((self._path, self._etag, index), content)
+
   @ndb.tasklet
   def _get_segment(self, start, request_size, check_response=True):
     """Get a segment of the file from Google Storage.
@@ -459,6 +882,7 @@ class ReadBuffer(object):
 
     In the __init__ method, we fire one HEAD and one GET request using
     ndb tasklet. One of them would return first and set the first value.
+    A lazily opened file takes its etag from its first GET instead.
 
     Args:
       etag: etag from a GCS HTTP response. None if etag is not part of the
@@ -478,7 +902,8 @@ class ReadBuffer(object):
   def close(self):
     self.closed = True
     self._buffer = None
-    self._buffer_future = None
+    self._readahead.clear()
+    self._pending_blocks.clear()
 
   def __enter__(self):
     return self
@@ -492,6 +917,10 @@ class ReadBuffer(object):
 
     Note if the new offset is out of bound, it is adjusted to either 0 or EOF.
 
+    When the new offset is within the current buffer or a buffer of the
+    readahead window, that buffer is used and nothing is requested again, so
+    short seeks back and forth cost no round trip.
+
     Args:
       offset: seek offset as number.
       whence: seek mode. Supported modes are os.SEEK_SET (absolute seek),
@@ -503,24 +932,62 @@ class ReadBuffer(object):
       ValueError: When whence is invalid.
     """
     self._check_open()
-
-    self._buffer.reset()
-    self._buffer_future = None
+    self._ensure_open()
 
     if whence == os.SEEK_SET:
-      self._offset = offset
+      new_offset = offset
     elif whence == os.SEEK_CUR:
-      self._offset += offset
+      new_offset = self._offset + offset
     elif whence == os.SEEK_END:
-      self._offset = self._file_size + offset
+      new_offset = self._file_size + offset
     else:
       raise ValueError('Whence mode %s is invalid.' % str(whence))
 
-    self._offset = min(self._offset, self._file_size)
-    self._offset = max(self._offset, 0)
+    new_offset = min(new_offset, self._file_size)
+    new_offset = max(new_offset, 0)
+    if new_offset < self._file_size and self._seek_buffered(new_offset):
+      self.buffered_seeks += 1
+      return
+
+    self._buffer.reset()
+    self._readahead.clear()
+    self._offset = new_offset
     if self._remaining():
+      self.refetched_seeks += 1
       self._request_next_buffer()
 
+  def _seek_buffered(self, offset):
+    """Move to offset within the buffers already read or requested.
+
+    The buffers of the readahead window before the one holding offset are
+    dropped, the ones after it are kept.
+
+    Args:
+      offset: new offset. Have to be within the range of the file.
+
+    Returns:
+      True if offset was within the current buffer or the readahead window.
+      False otherwise, in which case nothing is changed.
+    """
+    buffer_start = self._offset - self._buffer.tell()
+    if buffer_start <= offset < self._offset + self._buffer.remaining():
+      self._buffer.seek(offset - buffer_start)
+      self._offset = offset
+      return True
+
+    for index, (start, _) in enumerate(self._readahead):
+      if start <= offset < start + self._buffer_size:
+        break
+    else:
+      return False
+    for _ in xrange(index):
+      self._readahead.popleft()
+    start, future = self._readahead.popleft()
+    self._buffer.reset(future.get_result(), offset - start)
+    self._offset = offset
+    self._request_next_buffer()
+    return True
+
   def tell(self):
     """Tell the file's current offset.
 
@@ -548,13 +1015,18 @@ class ReadBuffer(object):
 
 
 class _Buffer(object):
-  """In memory buffer."""
+  """In memory buffer.
+
+  The content is kept with a memoryview of it, so that readinto copies it
+  straight into the destination without slicing a new string first.
+  """
 
   def __init__(self):
     self.reset()
 
   def reset(self, content='', offset=0):
     self._buffer = content
+    self._view = memoryview(content)
     self._offset = offset
 
   def read(self, size=-1):
@@ -587,9 +1059,35 @@ class _Buffer(object):
     self._offset += len(result)
     return result
 
+  def readinto(self, view):
+    """Copies bytes from the current offset into view.
+
+    Args:
+      view: a writable memoryview to fill from its start.
+
+    Returns:
+      Number of bytes copied. Less than len(view) if the buffer runs out.
+    """
+    size = min(len(view), self.remaining())
+    view[:size] = self._view[self._offset:self._offset + size]
+    self._offset += size
+    return size
+
   def remaining(self):
     return len(self._buffer) - self._offset
 
+  def tell(self):
+    return self._offset
+
+  def seek(self, offset):
+    """Moves the current offset within the buffer.
+
+    Args:
+      offset: new offset from the start of the buffer.
+    """
+    assert 0 <= offset <= len(self._buffer)
+    self._offset = offset
+
   def find_newline(self, size=-1):
     """Search for newline char in buffer starting from current offset.
 
@@ -14,6 +14,17 @@
 
 """Utils for testing."""
 
+import hashlib
+
+try:
+  from google.appengine.ext import ndb
+  from google.appengine.ext.ndb import eventloop
+except ImportError:
+  from google.appengine.ext import ndb
+  from google.appengine.ext.ndb import eventloop
+
+_LAST_MODIFIED = 'Tue, 14 Nov 2023 22:13:20 GMT'
+
 
 class MockUrlFetchResult(object):
 
@@ -23,3 +34,75 @@ class MockUrlFetchResult(object):
     self.content = body
     self.content_was_truncated = False
     self.final_url = None
+
+
+class FakeStorageApi(object):
+  """A storage_api._StorageApi that serves objects from memory.
+
+  Only the requests ReadBuffer and download send are supported: HEAD, and GET
+  with or without a Range header, answered like Google Storage does. Every
+  request is recorded in requests, so tests can check how many were sent.
+  """
+
+  def __init__(self, latency=0):
+    """Constructor.
+
+    Args:
+      latency: Seconds before the response to a request arrives. With 0 the
+        futures returned are already done.
+    """
+    self._objects = {}
+    self.requests = []
+    self.latency = latency
+
+  def put(self, path, content):
+    """Stores content at path, with a new etag.
+
+    Args:
+      path: Quoted path to the object, e.g. /mybucket/myfile.
+      content: The content of the object as a str.
+    """
+    etag = '"%s"' % hashlib.md5(content).hexdigest()
+    self._objects[path] = (content, etag)
+
+  def head_object(self, path, **kwds):
+    return self.head_object_async(path, **kwds).get_result()
+
+  def head_object_async(self, path, **kwds):
+    self.requests.append(('HEAD', path, None))
+    if path not in self._objects:
+      return self._result(404, {}, '')
+    content, etag = self._objects[path]
+    return self._result(200, {'content-length': str(len(content)),
+                              'etag': etag,
+                              'last-modified': _LAST_MODIFIED}, '')
+
+  def get_object(self, path, headers=None, **kwds):
+    return self.get_object_async(path, headers=headers, **kwds).get_result()
+
+  def get_object_async(self, path, headers=None, **kwds):
+    byte_range = (headers or {}).get('Range')
+    self.requests.append(('GET', path, byte_range))
+    if path not in self._objects:
+      return self._result(404, {}, '')
+    content, etag = self._objects[path]
+    resp_headers = {'etag': etag}
+    if byte_range is None:
+      return self._result(200, resp_headers, content)
+    start, end = byte_range[len('bytes='):].split('-')
+    start = int(start)
+    end = min(int(end), len(content) - 1)
+    if start >= len(content):
+      return self._result(416, resp_headers, '')
+    resp_headers['content-range'] = 'bytes %d-%d/%d' % (start, end,
+                                                        len(content))
+    return self._result(206, resp_headers, content[start:end + 1])
+
+  def _result(self, status, headers, content):
+    future = ndb.Future()
+    if self.latency:
+      eventloop.queue_call(self.latency, future.set_result,
+                           (status, headers, content))
+    else:
+      future.set_result((status, headers, content))
+    return future
@@ -0,0 +1,413 @@
+# Copyright (c) 2026, the Dart project authors.  Please see the AUTHORS file
+# for details. All rights reserved. Use of this source code is governed by a
+# BSD-style license that can be found in the LICENSE file.
+
+"""Tests for the reading side of the cloudstorage library.
+
+Google Storage is replaced by the in-memory test_utils.FakeStorageApi. They
+need the App Engine SDK, and are run from this directory with it on the path:
+
+  PYTHONPATH=<path to google_appengine> python -m unittest cloudstorage_test
+"""
+
+import StringIO
+import io
+import os
+import random
+import unittest
+
+try:
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+except ImportError:
+  pass
+
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import eventloop
+import cloudstorage
+from cloudstorage import storage_api
+from cloudstorage import test_utils
+
+PATH = '/dartlang-api-docs/gen-dartdocs/stable/3.4.0/index.html'
+
+
+def content_of_size(size):
+  """Bytes that differ at every offset of a buffer, with newlines."""
+  return ''.join('%07d\n' % i for i in xrange(size // 8 + 1))[:size]
+
+
+class FakeStorageTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.api = test_utils.FakeStorageApi()
+    self.get_storage_api = storage_api._get_storage_api
+    storage_api._get_storage_api = lambda *args, **kwds: self.api
+
+  def tearDown(self):
+    storage_api._get_storage_api = self.get_storage_api
+
+  def gets(self):
+    return [request for request in self.api.requests if request[0] == 'GET']
+
+
+class DownloadTest(FakeStorageTestCase):
+
+  def download(self, content, **kwds):
+    self.api.put(PATH, content)
+    del self.api.requests[:]
+    f = StringIO.StringIO()
+    result = cloudstorage.download(PATH, f, **kwds)
+    self.assertEqual(content, f.getvalue())
+    return result
+
+  def test_download_in_parts(self):
+    for size in (0, 1, 99, 100, 101, 1000):
+      for concurrency in (1, 3, 16):
+        content = content_of_size(size)
+        result = self.download(content, part_size=100,
+                               concurrency=concurrency)
+        parts = (size + 99) // 100
+        self.assertEqual(size, result['bytes'])
+        self.assertEqual(parts, result['parts'])
+        self.assertEqual(
+            ['bytes=%d-%d' % (start, min(start + 100, size) - 1)
+             for start in xrange(0, size, 100)],
+            [byte_range for _, _, byte_range in self.gets()])
+
+  def test_parts_are_written_in_order(self):
+    finished = []
+    get_object_async = self.api.get_object_async
+    def last_part_first(path, headers=None, **kwds):
+      result = get_object_async(path, headers=headers, **kwds).get_result()
+      start = int(headers['Range'][len('bytes='):].split('-')[0])
+      future = ndb.Future()
+      def finish():
+        finished.append(start)
+        future.set_result(result)
+      eventloop.queue_call(0.001 * (1000 - start) / 64, finish)
+      return future
+    self.api.get_object_async = last_part_first
+    result = self.download(content_of_size(1000), part_size=64,
+                           concurrency=4)
+    self.assertEqual(16, result['parts'])
+    self.assertNotEqual(sorted(finished), finished)
+
+  def test_changed_file(self):
+    api = self.api
+    get_object_async = api.get_object_async
+    def change_after_first_get(path, headers=None, **kwds):
+      future = get_object_async(path, headers=headers, **kwds)
+      api.put(PATH, content_of_size(1000)[::-1])
+      return future
+    api.put(PATH, content_of_size(1000))
+    api.get_object_async = change_after_first_get
+    self.assertRaises(ValueError, cloudstorage.download, PATH,
+                      StringIO.StringIO(), part_size=100)
+
+  def test_missing_file(self):
+    self.assertRaises(cloudstorage.NotFoundError, cloudstorage.download,
+                      PATH, StringIO.StringIO())
+    self.assertEqual([], self.gets())
+
+  def test_arguments_out_of_range(self):
+    self.api.put(PATH, 'content')
+    for kwds in ({'part_size': 0}, {'concurrency': 0},
+                 {'part_size': storage_api.ReadBuffer.MAX_REQUEST_SIZE + 1}):
+      self.assertRaises(ValueError, cloudstorage.download, PATH,
+                        StringIO.StringIO(), **kwds)
+    self.assertEqual([], self.api.requests)
+
+
+class ReadBufferTest(FakeStorageTestCase):
+  """Reads files through ReadBuffers of many shapes and checks that they
+  return what io.BytesIO returns for the same calls."""
+
+  SIZES = (0, 1, 63, 64, 65, 1000, 3000)
+
+  def open(self, content, **kwds):
+    # A new file each time, so that the requests the last ReadBuffer left in
+    # flight do not see it change.
+    self.opened = getattr(self, 'opened', 0) + 1
+    path = '%s.%d' % (PATH, self.opened)
+    self.api.put(path, content)
+    return storage_api.ReadBuffer(self.api, path, **kwds)
+
+  def buffer_options(self):
+    """The keyword arguments of the ReadBuffers each file is read with."""
+    for buffer_size in (7, 64, 1000):
+      # Requests of several buffers are made by long reads, and by block
+      # caches prefetching.
+      for max_readahead, max_request_size in ((1, buffer_size),
+                                              (4, buffer_size * 3)):
+        for lazy in (False, True):
+          for cached in (False, True):
+            block_cache = None
+            if cached:
+              block_cache = storage_api.BlockCache(
+                  max_bytes=buffer_size * 8, block_size=buffer_size)
+            yield {'buffer_size': buffer_size,
+                   'max_request_size': max_request_size,
+                   'max_readahead': max_readahead,
+                   'lazy': lazy,
+                   'block_cache': block_cache}
+
+  def random_calls(self, rng, size, count=40):
+    """A list of count calls, as (method name, arguments) tuples, to make on
+    a file of the given size."""
+    calls = []
+    for _ in xrange(count):
+      kind = rng.random()
+      if kind < 0.3:
+        calls.append(('read', (rng.choice((0, 1, 2, 8, 63, 64, 65, 500,
+                                           size, -1)),)))
+      elif kind < 0.45:
+        calls.append(('readinto', (rng.choice((0, 1, 8, 64, 500,
+                                               size + 1)),)))
+      elif kind < 0.55:
+        calls.append(('readline', rng.choice(((), (-1,), (0,), (3,),
+                                              (20,)))))
+      elif kind < 0.6:
+        calls.append(('next', ()))
+      elif kind < 0.65:
+        calls.append(('readlines', (rng.choice((-1, 0, 1, 100)),)))
+      elif kind < 0.9:
+        whence = rng.choice((os.SEEK_SET, os.SEEK_CUR, os.SEEK_END))
+        calls.append(('seek', (rng.randint(-size - 10, size + 10), whence)))
+      else:
+        calls.append(('tell', ()))
+    return calls
+
+  def call(self, f, name, args):
+    if name == 'seek':
+      # ReadBuffer moves offsets outside of the file to its start or end.
+      offset, whence = args
+      if isinstance(f, io.BytesIO):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: f.tell(),
+                os.SEEK_END: len(f.getvalue())}[whence]
+        args = (min(max(base + offset, 0), len(f.getvalue())),)
+    elif name == 'readinto':
+      b = bytearray(args[0])
+      count = f.readinto(b)
+      return count, str(b[:count])
+    try:
+      result = getattr(f, name)(*args)
+    except StopIteration:
+      return StopIteration
+    if name == 'seek':
+      # Which only io.BytesIO returns.
+      return f.tell()
+    return result
+
+  def check_calls(self, content, calls, **kwds):
+    f = self.open(content, **kwds)
+    expected = io.BytesIO(content)
+    for i, (name, args) in enumerate(calls):
+      self.assertEqual(self.call(expected, name, args),
+                       self.call(f, name, args),
+                       (len(content), kwds, calls[:i + 1]))
+
+  def test_reads_and_seeks(self):
+    rng = random.Random(20)
+    for size in self.SIZES:
+      content = content_of_size(size)
+      for kwds in self.buffer_options():
+        self.check_calls(content, self.random_calls(rng, size), **kwds)
+
+  def test_sequential_reads(self):
+    for size in self.SIZES:
+      content = content_of_size(size)
+      for kwds in self.buffer_options():
+        for read_size in (7, 64, 1000):
+          f = self.open(content, **kwds)
+          pieces = iter(lambda: f.read(read_size), '')
+          self.assertEqual(content, ''.join(pieces), (size, kwds, read_size))
+
+  def test_readahead_window_adapts_to_the_network(self):
+    content = content_of_size(64 * 40)
+    self.api.latency = 0.005
+    f = self.open(content, buffer_size=64, max_readahead=4)
+    self.assertEqual(1, f.readahead_depth)
+    pieces = []
+    while f.tell() < len(content):
+      pieces.append(f.read(64))
+      # Never more than max_readahead buffers requested ahead of the one
+      # being read.
+      requested = max(int(byte_range.rsplit('-', 1)[1])
+                      for _, _, byte_range in self.gets())
+      self.assertLess(requested, f.tell() + 64 * 5)
+    self.assertEqual(content, ''.join(pieces))
+    self.assertGreater(f.blocked_reads, 0)
+    self.assertGreater(f.blocked_seconds, 0)
+    self.assertEqual(4, f.readahead_depth)
+    # Buffers that are already there shrink the window again.
+    self.api.latency = 0
+    f.seek(0)
+    while f.read(64):
+      pass
+    self.assertEqual(1, f.readahead_depth)
+
+  def test_readinto_a_memoryview(self):
+    content = content_of_size(1000)
+    for kwds in self.buffer_options():
+      f = self.open(content, **kwds)
+      b = bytearray('-' * 1010)
+      view = memoryview(b)
+      self.assertEqual(300, f.readinto(view[5:305]))
+      self.assertEqual(700, f.readinto(view[305:]))
+      self.assertEqual(0, f.readinto(view))
+      self.assertEqual('-' * 5 + content + '-' * 5, str(b), kwds)
+
+  def test_lines(self):
+    # Short lines, lines longer than the buffers, and a last line without a
+    # newline.
+    content = ''.join('%s\n' % ('x' * (i * 37 % 300)) for i in xrange(20))
+    content += 'no newline'
+    lines = io.BytesIO(content).readlines()
+    for kwds in self.buffer_options():
+      self.assertEqual(lines, list(self.open(content, **kwds)), kwds)
+      self.assertEqual(lines, self.open(content, **kwds).readlines(), kwds)
+
+  def test_reads_and_seeks_between_lines(self):
+    content = ''.join('line %d\n' % i for i in xrange(100))
+    f = self.open(content, buffer_size=16)
+    lines = iter(f)
+    self.assertEqual('line 0\n', next(lines))
+    self.assertEqual('li', f.read(2))
+    self.assertEqual('ne 1\n', next(lines))
+    f.seek(content.index('line 50'))
+    self.assertEqual('line 50\n', next(lines))
+    self.assertEqual('line 51\n', f.readline())
+    self.assertEqual(['line 52\n', 'line 53\n'], f.readlines(10))
+    self.assertEqual(['line %d\n' % i for i in xrange(54, 100)], list(lines))
+
+  def test_seeks_within_the_buffers_are_not_refetched(self):
+    content = content_of_size(1000)
+    for lazy in (False, True):
+      # The requests of the last file still in flight go to the last api.
+      self.api = test_utils.FakeStorageApi()
+      f = self.open(content, buffer_size=64, lazy=lazy)
+      self.assertEqual(content[:10], f.read(10))
+      # Back into the current buffer, then into the next one, which was
+      # requested ahead.
+      f.seek(5)
+      self.assertEqual(content[5:10], f.read(5))
+      f.seek(100)
+      self.assertEqual(content[100:104], f.read(4))
+      f.seek(-30, os.SEEK_CUR)
+      self.assertEqual(content[74:80], f.read(6))
+      self.assertEqual((3, 0), (f.buffered_seeks, f.refetched_seeks))
+      ranges = [byte_range for _, _, byte_range in self.gets()]
+      self.assertEqual(sorted(set(ranges)), sorted(ranges))
+      # Not anywhere near them.
+      f.seek(900)
+      self.assertEqual(content[900:], f.read())
+      f.seek(0)
+      self.assertEqual(content[:64], f.read(64))
+      self.assertEqual((3, 2), (f.buffered_seeks, f.refetched_seeks))
+
+  def test_seeks_within_a_deep_readahead_window(self):
+    content = content_of_size(64 * 40)
+    self.api.latency = 0.002
+    f = self.open(content, buffer_size=64, max_readahead=4)
+    while f.readahead_depth < 4:
+      f.read(64)
+    offset = f.tell()
+    # Forward over buffers requested ahead, which are dropped, and back
+    # into the one read.
+    f.seek(offset + 64 * 2 + 10)
+    self.assertEqual(content[offset + 138:offset + 148], f.read(10))
+    f.seek(offset + 64 * 2)
+    self.assertEqual(content[offset + 128:offset + 138], f.read(10))
+    self.assertEqual((2, 0), (f.buffered_seeks, f.refetched_seeks))
+    self.assertEqual(content[offset + 138:], f.read())
+    ranges = [byte_range for _, _, byte_range in self.gets()]
+    self.assertEqual(sorted(set(ranges)), sorted(ranges))
+
+  def test_block_cache_is_shared(self):
+    content = content_of_size(1000)
+    cache = storage_api.BlockCache(block_size=64, prefetch_blocks=1)
+    f = self.open(content, block_cache=cache)
+    path = f.name
+    f.seek(500)
+    self.assertEqual(content[500:510], f.read(10))
+    # The block of offset 500 came with the one after it.
+    self.assertIn('bytes=448-575', [byte_range for _, _, byte_range in
+                                    self.gets()])
+    del self.api.requests[:]
+    g = storage_api.ReadBuffer(self.api, path, block_cache=cache)
+    del self.api.requests[:]
+    g.seek(530)
+    self.assertEqual(content[530:570], g.read(40))
+    self.assertEqual([], self.gets())
+    self.assertGreater(cache.hits, 0)
+
+  def test_block_cache_is_not_read_for_a_replaced_file(self):
+    cache = storage_api.BlockCache(block_size=64)
+    f = self.open(content_of_size(1000), block_cache=cache)
+    f.read()
+    self.api.put(f.name, 'replaced' * 100)
+    g = storage_api.ReadBuffer(self.api, f.name, block_cache=cache)
+    self.assertEqual('replaced' * 100, g.read())
+
+  def test_block_cache_stays_within_max_bytes(self):
+    rng = random.Random(25)
+    content = content_of_size(5000)
+    cache = storage_api.BlockCache(max_bytes=64 * 10, block_size=64,
+                                   prefetch_blocks=2)
+    expected = io.BytesIO(content)
+    f = self.open(content, block_cache=cache)
+    for _ in xrange(200):
+      offset, size = rng.randint(0, 5000), rng.randint(0, 200)
+      f.seek(offset)
+      expected.seek(offset)
+      self.assertEqual(expected.read(size), f.read(size))
+      self.assertLessEqual(cache.memory_usage(), 64 * 10)
+    self.assertEqual(10, len(cache))
+    self.assertGreater(cache.evictions, 0)
+    self.assertGreater(cache.hits, 0)
+
+  def test_lazy_open(self):
+    content = content_of_size(1000)
+    f = self.open(content, buffer_size=64, lazy=True)
+    self.assertEqual([], self.api.requests)
+    self.assertEqual(content[:10], f.read(10))
+    # The size and etag come from the first GET, there is no HEAD.
+    self.assertEqual(('GET', 'bytes=0-63'), self.api.requests[0][::2])
+    self.assertNotIn('HEAD', [method for method, _, _ in self.api.requests])
+    f.seek(-10, os.SEEK_END)
+    self.assertEqual(content[-10:], f.read())
+
+  def test_eager_open(self):
+    f = self.open(content_of_size(1000), buffer_size=64)
+    # The HEAD, and the GET of the first buffer sent with it.
+    self.assertEqual(['GET', 'HEAD'], sorted(method for method, _, _ in
+                                             self.api.requests))
+    f.seek(0, os.SEEK_END)
+    self.assertEqual(1000, f.tell())
+
+  def test_lazy_open_of_a_small_or_empty_file(self):
+    for content in ('', 'x', content_of_size(64)):
+      f = self.open(content, buffer_size=64, lazy=True)
+      self.assertEqual(content, f.read())
+      self.assertEqual(1, len(self.api.requests))
+      del self.api.requests[:]
+
+  def test_lazy_open_of_a_missing_file(self):
+    f = storage_api.ReadBuffer(self.api, PATH, lazy=True)
+    self.assertRaises(cloudstorage.NotFoundError, f.read)
+    f = storage_api.ReadBuffer(self.api, PATH, lazy=True)
+    self.assertRaises(cloudstorage.NotFoundError, f.seek, 10)
+    self.assertRaises(cloudstorage.NotFoundError, storage_api.ReadBuffer,
+                      self.api, PATH)
+
+  def test_open_lazily(self):
+    self.api.put(PATH, 'content')
+    with cloudstorage.open(PATH, lazy=True) as f:
+      self.assertEqual([], self.api.requests)
+      self.assertEqual('content', f.read())
+    self.assertEqual([('GET', PATH, 'bytes=0-%d' % (
+        storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE - 1))], self.api.requests)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,354 @@
+# Copyright (c) 2026, the Dart project authors.  Please see the AUTHORS file
+# for details. All rights reserved. Use of this source code is governed by a
+# BSD-style license that can be found in the LICENSE file.
+
+"""Storage backends the generated docs are served from.
+
+Paths are always of the Google Storage form /bucket/path/to/object, whatever
+the backend. Backends report a missing object with cloudstorage.NotFoundError
+and describe objects with cloudstorage.GCSFileStat, so the redirector does
+not need to know which one it is using.
+
+- GcsStorage: Google Storage, pages are sent by the blob server. The default.
+- LocalStorage: a directory holding a mirror of the bucket made with
+  mirror.py, for running the redirector with dev_appserver.py without access
+  to Google Storage. The redirector still needs the App Engine services,
+  memcache, the datastore and users, so it does not run outside of App
+  Engine or its development server.
+- MemoryStorage: objects held in a dict, for trying things out.
+
+The backend is chosen with the DOCS_STORAGE environment variable (gcs, local
+or memory). LocalStorage reads its directory from DOCS_STORAGE_ROOT.
+"""
+
+import errno
+import hashlib
+import io
+import mimetypes
+import os
+import stat
+import time
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+import cloudstorage
+from cloudstorage import api_utils
+from cloudstorage import storage_api
+
+
+class Storage(object):
+  """The operations the redirector needs from a backend."""
+
+  def open(self, path, mode='r', content_type=None):
+    """Open the object at path for reading ('r') or writing ('w'). The file
+    object supports read, readline, seek and the with statement. A missing
+    object raises cloudstorage.NotFoundError, either here or from the first
+    read."""
+    raise NotImplementedError()
+
+  def stat(self, path):
+    """Return the GCSFileStat of the object at path."""
+    raise NotImplementedError()
+
+  def exists(self, path):
+    try:
+      self.stat(path)
+      return True
+    except cloudstorage.NotFoundError:
+      return False
+
+  def listdir(self, prefix):
+    """Yield the GCSFileStat of every object whose path starts with prefix, in
+    path order."""
+    raise NotImplementedError()
+
+  @ndb.tasklet
+  def read_async(self, path):
+    """Return a Future for the whole content of the object at path."""
+    with self.open(path) as f:
+      return f.read()
+
+  @ndb.tasklet
+  def read_range_async(self, path, start, end):
+    """Return a Future for the bytes start to end (inclusive) of the object at
+    path."""
+    with self.open(path) as f:
+      f.seek(start)
+      return f.read(end - start + 1)
+
+  def serve(self, handler, path, content_type=None, start=None, end=None):
+    """Send the object at path as the response of handler, or only its bytes
+    start to end (inclusive) as a 206. content_type overrides the content
+    type of the object."""
+    with self.open(path) as f:
+      body = f.read()
+    write_body(handler, path, body, len(body), content_type, start, end)
+
+
+def guess_content_type(path):
+  """The content type of the object at path guessed from its name, or None if
+  the name also has a content coding, like index.html.gz, whose bytes the
+  type alone does not describe."""
+  content_type, encoding = mimetypes.guess_type(path)
+  return content_type if encoding is None else None
+
+
+def set_content_headers(handler, path, content_type):
+  """Set the Content-Type of the response of handler sending the object at
+  path. Without a content_type both the type and the content coding are
+  guessed from the name: index.html.gz is sent as text/html with
+  Content-Encoding gzip."""
+  if content_type is None:
+    content_type, encoding = mimetypes.guess_type(path)
+    if encoding is not None:
+      handler.response.headers['Content-Encoding'] = encoding
+  handler.response.headers['Content-Type'] = (
+      content_type or 'application/octet-stream')
+
+
+def set_range_headers(handler, size, start, end):
+  """Make the response of handler a 206 for the bytes start to end of an
+  object of size bytes. end may be None or past the object, the end of the
+  range actually sent is returned."""
+  end = min(end, size - 1) if end is not None else size - 1
+  handler.response.set_status(206)
+  handler.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+      start, end, size)
+  return end
+
+
+def write_body(handler, path, body, size, content_type, start, end):
+  """Write body, or the range of it from start to end, to the response of
+  handler."""
+  set_content_headers(handler, path, content_type)
+  if start is None:
+    handler.response.write(body)
+    return
+  end = set_range_headers(handler, size, start, end)
+  handler.response.write(body[start:end + 1])
+
+
+def read_blocks(f, start, length, block_size):
+  """Yield length bytes of the open file f from start on, block_size bytes at
+  a time, and close f when done. As the app_iter of a response the file is
+  closed by the WSGI server even if the client goes away."""
+  try:
+    f.seek(start)
+    while length > 0:
+      block = f.read(min(block_size, length))
+      if not block:
+        break
+      length -= len(block)
+      yield block
+  finally:
+    f.close()
+
+
+class GcsStorage(Storage):
+  """The docs bucket on Google Storage."""
+
+  def __init__(self, retry_params=None):
+    """Arguments:
+    - retry_params: cloudstorage.RetryParams of the reads and stats, which are
+      made while a user waits, or None for the defaults of the library.
+      Listings and writes always use the defaults."""
+    self.retry_params = retry_params
+
+  def open(self, path, mode='r', content_type=None):
+    """Files are opened for reading lazily, which saves the HEAD request:
+    nothing is sent until the first read, and a missing object is only
+    reported then."""
+    if mode == 'r':
+      return cloudstorage.open(path, 'r', lazy=True,
+                               retry_params=self.retry_params)
+    return cloudstorage.open(path, mode, content_type=content_type)
+
+  def stat(self, path):
+    """A single HEAD request."""
+    return cloudstorage.stat(path, retry_params=self.retry_params)
+
+  def listdir(self, prefix):
+    return cloudstorage.listbucket(prefix)
+
+  @ndb.tasklet
+  def read_async(self, path):
+    """A single GET, without the HEAD that opening the object costs."""
+    api = storage_api._get_storage_api(retry_params=self.retry_params)
+    status, headers, content = yield api.get_object_async(
+        api_utils._quote_filename(path))
+    cloudstorage.check_status(status, [200], path, resp_headers=headers,
+                              body=content)
+    raise ndb.Return(content)
+
+  @ndb.tasklet
+  def read_range_async(self, path, start, end):
+    """A single ranged GET, without the buffering and readahead of a file
+    opened for reading."""
+    api = storage_api._get_storage_api(retry_params=self.retry_params)
+    status, headers, content = yield api.get_object_async(
+        api_utils._quote_filename(path),
+        headers={'Range': 'bytes=%d-%d' % (start, end)})
+    cloudstorage.check_status(status, [200, 206], path, resp_headers=headers,
+                              body=content)
+    if status == 200:
+      # The whole object.
+      content = content[start:end + 1]
+    raise ndb.Return(content)
+
+  def serve(self, handler, path, content_type=None, start=None, end=None):
+    """Leave sending the object to the blob server. handler has to be a
+    BlobstoreDownloadHandler."""
+    gs_key = blobstore.create_gs_key('/gs' + path)
+    if start is None:
+      handler.send_blob(gs_key, content_type=content_type, use_range=False)
+    else:
+      handler.send_blob(gs_key, content_type=content_type, start=start,
+                        end=end)
+
+
+class LocalStorage(Storage):
+  """A directory holding a mirror of the bucket, with the object
+  /bucket/path/to/object at <root>/bucket/path/to/object."""
+
+  # Block size of the file wrapper of the WSGI server.
+  BLOCK_SIZE = 64 * 1024
+
+  def __init__(self, root):
+    self.root = os.path.abspath(root)
+
+  def local_path(self, path):
+    local_path = os.path.normpath(os.path.join(self.root, path.lstrip('/')))
+    if not local_path.startswith(self.root + os.sep):
+      raise cloudstorage.NotFoundError('%s is outside of %s'
+                                       % (path, self.root))
+    return local_path
+
+  def open(self, path, mode='r', content_type=None):
+    local_path = self.local_path(path)
+    if mode == 'r':
+      try:
+        return io.open(local_path, 'rb')
+      except IOError as e:
+        if e.errno in (errno.ENOENT, errno.EISDIR):
+          raise cloudstorage.NotFoundError(path)
+        raise
+    directory = os.path.dirname(local_path)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    return io.open(local_path, 'wb')
+
+  def stat(self, path):
+    try:
+      st = os.stat(self.local_path(path))
+    except OSError as e:
+      if e.errno == errno.ENOENT:
+        raise cloudstorage.NotFoundError(path)
+      raise
+    if not stat.S_ISREG(st.st_mode):
+      raise cloudstorage.NotFoundError(path)
+    return self._stat(path, st)
+
+  def _stat(self, path, st):
+    # Hashing every file is too slow, so like most web servers derive the
+    # etag from the modification time and size instead.
+    etag = '%x-%x' % (int(st.st_mtime * 1000000), st.st_size)
+    return cloudstorage.GCSFileStat(path, st.st_size, etag, st.st_mtime,
+                                    guess_content_type(path))
+
+  def listdir(self, prefix):
+    directory = self.local_path(prefix.rsplit('/', 1)[0] or '/')
+    stats = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+      for filename in filenames:
+        local_path = os.path.join(dirpath, filename)
+        path = os.path.relpath(local_path, self.root)
+        path = '/' + path.replace(os.sep, '/')
+        if path.startswith(prefix):
+          stats.append(self._stat(path, os.stat(local_path)))
+    stats.sort(key=lambda file_stat: file_stat.filename)
+    return iter(stats)
+
+  def serve(self, handler, path, content_type=None, start=None, end=None):
+    """Hand the whole file to the file wrapper of the WSGI server, which can
+    use sendfile, or else stream it, or the range, in blocks of BLOCK_SIZE, so
+    that only a block at a time is in memory."""
+    f = self.open(path)
+    try:
+      size = os.fstat(f.fileno()).st_size
+      set_content_headers(handler, path, content_type)
+      if start is None:
+        start, end = 0, size - 1
+        file_wrapper = handler.request.environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+          handler.response.app_iter = file_wrapper(f, LocalStorage.BLOCK_SIZE)
+          handler.response.content_length = size
+          f = None
+          return
+      else:
+        end = set_range_headers(handler, size, start, end)
+      handler.response.app_iter = read_blocks(f, start, end - start + 1,
+                                              LocalStorage.BLOCK_SIZE)
+      handler.response.content_length = end - start + 1
+      f = None
+    finally:
+      if f is not None:
+        f.close()
+
+
+class MemoryStorage(Storage):
+  """Objects held in memory. Writes are only seen once the file is closed."""
+
+  def __init__(self):
+    # Path to (content, content type, modification time).
+    self.objects = {}
+
+  def put(self, path, content, content_type=None):
+    self.objects[path] = (content, content_type, time.time())
+
+  def open(self, path, mode='r', content_type=None):
+    if mode == 'r':
+      if path not in self.objects:
+        raise cloudstorage.NotFoundError(path)
+      return io.BytesIO(self.objects[path][0])
+    return _MemoryFile(self, path, content_type)
+
+  def stat(self, path):
+    if path not in self.objects:
+      raise cloudstorage.NotFoundError(path)
+    return self._stat(path)
+
+  def _stat(self, path):
+    content, content_type, mtime = self.objects[path]
+    return cloudstorage.GCSFileStat(path, len(content),
+                                    hashlib.md5(content).hexdigest(), mtime,
+                                    content_type)
+
+  def listdir(self, prefix):
+    return iter([self._stat(path) for path in sorted(self.objects)
+                 if path.startswith(prefix)])
+
+
+class _MemoryFile(io.BytesIO):
+
+  def __init__(self, storage, path, content_type):
+    io.BytesIO.__init__(self)
+    self._storage = storage
+    self._path = path
+    self._content_type = content_type
+
+  def close(self):
+    if not self.closed:
+      self._storage.put(self._path, self.getvalue(), self._content_type)
+    io.BytesIO.close(self)
+
+
+def from_environment(retry_params=None):
+  """Create the backend chosen with the DOCS_STORAGE environment variable.
+  retry_params are passed on to GcsStorage."""
+  kind = os.environ.get('DOCS_STORAGE', 'gcs')
+  if kind == 'gcs':
+    return GcsStorage(retry_params)
+  if kind == 'local':
+    return LocalStorage(os.environ['DOCS_STORAGE_ROOT'])
+  if kind == 'memory':
+    return MemoryStorage()
+  raise ValueError('Unknown DOCS_STORAGE %r' % kind)
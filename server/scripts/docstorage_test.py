@@ -0,0 +1,161 @@
+# Copyright (c) 2026, the Dart project authors.  Please see the AUTHORS file
+# for details. All rights reserved. Use of this source code is governed by a
+# BSD-style license that can be found in the LICENSE file.
+
+"""Tests for docstorage.py.
+
+They need the App Engine SDK, and are run from this directory with it on the
+path:
+
+  PYTHONPATH=<path to google_appengine> python -m unittest docstorage_test
+"""
+
+import mimetypes
+import shutil
+import tempfile
+import unittest
+
+try:
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+except ImportError:
+  pass
+
+import webapp2
+import cloudstorage
+import docstorage
+
+ROOT = '/dartlang-api-docs/gen-dartdocs/stable/3.4.0'
+
+
+class LocalStorageTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.storage = docstorage.LocalStorage(self.directory)
+    # Several blocks and a bit.
+    self.large = ''.join(chr(i % 251) for i in
+                         xrange(docstorage.LocalStorage.BLOCK_SIZE * 3 + 10))
+    self.put(ROOT + '/index.html', '<html></html>')
+    self.put(ROOT + '/index.html.gz', '\x1f\x8bgzipped')
+    self.put(ROOT + '/large.js', self.large)
+    self.put(ROOT + '/empty.txt', '')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def put(self, path, content):
+    with self.storage.open(path, 'w') as f:
+      f.write(content)
+
+  def serve(self, path, start=None, end=None, file_wrapper=None):
+    request = webapp2.Request.blank('/')
+    if file_wrapper is not None:
+      request.environ['wsgi.file_wrapper'] = file_wrapper
+    handler = webapp2.RequestHandler(request, webapp2.Response())
+    self.storage.serve(handler, path, start=start, end=end)
+    return handler.response
+
+  def test_stat(self):
+    stat = self.storage.stat(ROOT + '/index.html')
+    self.assertEqual(len('<html></html>'), stat.st_size)
+    self.assertEqual('text/html', stat.content_type)
+    self.assertTrue(stat.etag)
+    # The bytes of a compressed copy are not text/html.
+    self.assertIsNone(self.storage.stat(ROOT + '/index.html.gz').content_type)
+    for path in (ROOT + '/missing.html', ROOT, '/../etc/passwd'):
+      self.assertRaises(cloudstorage.NotFoundError, self.storage.stat, path)
+      self.assertFalse(self.storage.exists(path))
+
+  def test_open_outside_of_root(self):
+    self.assertRaises(cloudstorage.NotFoundError, self.storage.open,
+                      ROOT + '/../../../../../etc/passwd')
+
+  def test_listdir(self):
+    self.assertEqual(
+        [ROOT + '/empty.txt', ROOT + '/index.html', ROOT + '/index.html.gz',
+         ROOT + '/large.js'],
+        [stat.filename for stat in self.storage.listdir(ROOT + '/')])
+    self.assertEqual(
+        [ROOT + '/index.html', ROOT + '/index.html.gz'],
+        [stat.filename for stat in self.storage.listdir(ROOT + '/index')])
+
+  def test_serve_streams_blocks(self):
+    response = self.serve(ROOT + '/large.js')
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(len(self.large), response.content_length)
+    self.assertEqual(mimetypes.guess_type('large.js')[0],
+                     response.headers['Content-Type'])
+    blocks = list(response.app_iter)
+    self.assertEqual(4, len(blocks))
+    self.assertTrue(all(len(block) <= docstorage.LocalStorage.BLOCK_SIZE
+                        for block in blocks))
+    self.assertEqual(self.large, ''.join(blocks))
+
+  def test_serve_range(self):
+    size = len(self.large)
+    block_size = docstorage.LocalStorage.BLOCK_SIZE
+    for start, end, sent_end in (
+        (10, 19, 19),
+        (block_size - 5, block_size + 5, block_size + 5),
+        (size - 10, None, size - 1),
+        (0, size * 2, size - 1)):
+      response = self.serve(ROOT + '/large.js', start, end)
+      self.assertEqual(206, response.status_int)
+      self.assertEqual('bytes %d-%d/%d' % (start, sent_end, size),
+                       response.headers['Content-Range'])
+      self.assertEqual(sent_end - start + 1, response.content_length)
+      self.assertEqual(self.large[start:sent_end + 1],
+                       ''.join(response.app_iter))
+
+  def test_serve_empty_file(self):
+    response = self.serve(ROOT + '/empty.txt')
+    self.assertEqual(0, response.content_length)
+    self.assertEqual('', ''.join(response.app_iter))
+
+  def test_serve_with_file_wrapper(self):
+    wrapped = []
+    def file_wrapper(f, block_size):
+      wrapped.append(block_size)
+      return iter(lambda: f.read(block_size), '')
+    response = self.serve(ROOT + '/large.js', file_wrapper=file_wrapper)
+    self.assertEqual([docstorage.LocalStorage.BLOCK_SIZE], wrapped)
+    self.assertEqual(self.large, ''.join(response.app_iter))
+    # Ranges are read by the storage.
+    response = self.serve(ROOT + '/large.js', 0, 9, file_wrapper=file_wrapper)
+    self.assertEqual(1, len(wrapped))
+    self.assertEqual(self.large[:10], ''.join(response.app_iter))
+
+  def test_serve_names_with_a_content_coding(self):
+    response = self.serve(ROOT + '/index.html.gz')
+    self.assertEqual('text/html', response.headers['Content-Type'])
+    self.assertEqual('gzip', response.headers['Content-Encoding'])
+    self.assertEqual('\x1f\x8bgzipped', ''.join(response.app_iter))
+
+  def test_read_blocks_closes_the_file(self):
+    f = self.storage.open(ROOT + '/large.js')
+    blocks = docstorage.read_blocks(f, 0, len(self.large), 1024)
+    self.assertEqual(self.large[:1024], next(blocks))
+    # As a WSGI server does when the client goes away.
+    blocks.close()
+    self.assertTrue(f.closed)
+
+
+class MemoryStorageTest(unittest.TestCase):
+
+  def test_written_objects_are_seen_once_closed(self):
+    storage = docstorage.MemoryStorage()
+    f = storage.open(ROOT + '/index.html', 'w', content_type='text/html')
+    f.write('<html>')
+    self.assertFalse(storage.exists(ROOT + '/index.html'))
+    f.close()
+    stat = storage.stat(ROOT + '/index.html')
+    self.assertEqual((6, 'text/html'), (stat.st_size, stat.content_type))
+    with storage.open(ROOT + '/index.html') as f:
+      self.assertEqual('<html>', f.read())
+    self.assertRaises(cloudstorage.NotFoundError, storage.open,
+                      ROOT + '/missing.html')
+
+
+if __name__ == '__main__':
+  unittest.main()
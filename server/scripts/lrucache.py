@@ -0,0 +1,111 @@
+# Copyright (c) 2026, the Dart project authors.  Please see the AUTHORS file
+# for details. All rights reserved. Use of this source code is governed by a
+# BSD-style license that can be found in the LICENSE file.
+
+"""Bounded per-instance caches.
+
+Memcache is shared by all instances but every lookup is an RPC. The caches
+here live in the memory of one instance, in front of memcache, for results
+that are asked for on almost every request.
+"""
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+  """Thread safe least recently used cache whose entries expire.
+
+  Every entry is stored with its own time to live, so that negative results
+  can be kept for less time than positive ones. Entries are evicted least
+  recently used first once there are more than max_entries of them or once
+  their total size, as reported by sizeof(key, value), is over max_bytes.
+
+  Expired entries are not dropped until they are evicted, so get_stale can
+  still return them when a fresh value cannot be had.
+
+  The hits, misses, evictions and expirations counters are kept so that the
+  limits can be sized for the memory of an instance class."""
+
+  def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.sizeof = sizeof
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def get(self, key, default=None):
+    """Return the value cached for key, or default if there is none or it has
+    expired."""
+    now = time.time()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return default
+      value, expires, size = entry
+      if expires <= now:
+        self.expirations += 1
+        self.misses += 1
+        return default
+      del self._entries[key]
+      self._entries[key] = entry
+      self.hits += 1
+      return value
+
+  def get_stale(self, key, default=None):
+    """Return the value cached for key even if it has expired, or default if
+    there is none."""
+    with self._lock:
+      entry = self._entries.get(key)
+    if entry is None:
+      return default
+    return entry[0]
+
+  def set(self, key, value, ttl):
+    """Cache value for key for ttl seconds."""
+    size = self.sizeof(key, value) if self.sizeof is not None else 0
+    with self._lock:
+      self._discard(key)
+      self._entries[key] = (value, time.time() + ttl, size)
+      self._bytes += size
+      while self._entries and self._over_budget():
+        self._discard(next(iter(self._entries)))
+        self.evictions += 1
+
+  def delete(self, key):
+    with self._lock:
+      self._discard(key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def memory_usage(self):
+    """Total size of the cached entries as reported by sizeof."""
+    return self._bytes
+
+  def __len__(self):
+    return len(self._entries)
+
+  def stats(self):
+    return {'entries': len(self._entries), 'bytes': self._bytes,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'expirations': self.expirations}
+
+  def _discard(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self._bytes -= entry[2]
+
+  def _over_budget(self):
+    return ((self.max_entries is not None and
+             len(self._entries) > self.max_entries) or
+            (self.max_bytes is not None and self._bytes > self.max_bytes))
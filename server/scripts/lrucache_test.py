@@ -0,0 +1,120 @@
+# Copyright (c) 2026, the Dart project authors.  Please see the AUTHORS file
+# for details. All rights reserved. Use of this source code is governed by a
+# BSD-style license that can be found in the LICENSE file.
+
+"""Tests for lrucache.py.
+
+  python -m unittest lrucache_test
+"""
+
+import threading
+import time
+import unittest
+
+from lrucache import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+  def test_get_and_set(self):
+    cache = LRUCache()
+    self.assertIsNone(cache.get('a'))
+    self.assertEqual('default', cache.get('a', 'default'))
+    cache.set('a', 1, 60)
+    self.assertEqual(1, cache.get('a'))
+    cache.set('a', 2, 60)
+    self.assertEqual(2, cache.get('a'))
+    self.assertEqual(1, len(cache))
+    self.assertEqual(2, cache.hits)
+    self.assertEqual(2, cache.misses)
+
+  def test_falsy_values_are_cached(self):
+    cache = LRUCache()
+    for key, value in (('none', None), ('zero', 0), ('empty', '')):
+      cache.set(key, value, 60)
+      self.assertEqual(value, cache.get(key, 'missing'))
+
+  def test_entries_expire_with_their_own_ttl(self):
+    cache = LRUCache()
+    cache.set('short', 1, 0.01)
+    cache.set('long', 2, 60)
+    time.sleep(0.02)
+    self.assertIsNone(cache.get('short'))
+    self.assertEqual(2, cache.get('long'))
+    self.assertEqual(1, cache.expirations)
+    # Expired entries can still be had when nothing better can.
+    self.assertEqual(1, cache.get_stale('short'))
+    self.assertIsNone(cache.get_stale('other'))
+
+  def test_evicts_least_recently_used_by_count(self):
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1, 60)
+    cache.set('b', 2, 60)
+    cache.get('a')
+    cache.set('c', 3, 60)
+    self.assertEqual(1, cache.get('a'))
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual(3, cache.get('c'))
+    self.assertEqual(1, cache.evictions)
+    self.assertIsNone(cache.get_stale('b'))
+
+  def test_evicts_by_bytes(self):
+    cache = LRUCache(max_bytes=10, sizeof=lambda key, value: len(value))
+    cache.set('a', 'x' * 4, 60)
+    cache.set('b', 'x' * 4, 60)
+    self.assertEqual(8, cache.memory_usage())
+    cache.set('a', 'x' * 2, 60)
+    self.assertEqual(6, cache.memory_usage())
+    cache.set('c', 'x' * 5, 60)
+    # b was used least recently.
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual(7, cache.memory_usage())
+    cache.set('d', 'x' * 20, 60)
+    # A value over the budget on its own is not kept either.
+    self.assertEqual(0, len(cache))
+    self.assertEqual(0, cache.memory_usage())
+
+  def test_delete_and_clear(self):
+    cache = LRUCache(sizeof=lambda key, value: len(value))
+    cache.set('a', 'xx', 60)
+    cache.set('b', 'xxx', 60)
+    cache.delete('a')
+    cache.delete('missing')
+    self.assertIsNone(cache.get('a'))
+    self.assertEqual(3, cache.memory_usage())
+    cache.clear()
+    self.assertEqual(0, len(cache))
+    self.assertEqual(0, cache.memory_usage())
+
+  def test_stats(self):
+    cache = LRUCache(max_entries=1, sizeof=lambda key, value: 1)
+    cache.set('a', 1, 60)
+    cache.set('b', 2, 60)
+    cache.get('a')
+    cache.get('b')
+    self.assertEqual({'entries': 1, 'bytes': 1, 'hits': 1, 'misses': 1,
+                      'evictions': 1, 'expirations': 0}, cache.stats())
+
+  def test_concurrent_use_keeps_the_bounds(self):
+    cache = LRUCache(max_entries=50, max_bytes=400,
+                     sizeof=lambda key, value: len(value))
+    def use(thread):
+      for i in xrange(2000):
+        key = (thread * 7 + i) % 120
+        if cache.get(key) is None:
+          cache.set(key, 'x' * (key % 10), 60)
+    threads = [threading.Thread(target=use, args=(thread,))
+               for thread in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertLessEqual(len(cache), 50)
+    self.assertLessEqual(cache.memory_usage(), 400)
+    self.assertEqual(sum(len(cache.get_stale(key, '')) for key in range(120)),
+                     cache.memory_usage())
+    self.assertEqual(8 * 2000, cache.hits + cache.misses)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,288 @@
+# Copyright (c) 2026, the Dart project authors.  Please see the AUTHORS file
+# for details. All rights reserved. Use of this source code is governed by a
+# BSD-style license that can be found in the LICENSE file.
+
+"""Manifests of the generated docs stored in Google Storage.
+
+A manifest is a sorted index of every object under one docs version directory
+(for example /dartlang-api-docs/gen-dartdocs/stable/3.4.0) together with its
+size, etag, modification time and content type. Published versions never
+change, so the manifest only has to be built once; after that the server can
+answer "does this page exist" from memory instead of asking Google Storage
+for every path.
+
+The serialized form is plain text, one object per line, sorted by path:
+
+  <path relative to the version directory>\t<size>\t<etag>\t<mtime>\t<type>
+
+The content type is empty when it is not known. Manifests written before it
+was recorded have no content type field at all.
+
+A Bloom filter of the same paths is much smaller than the manifest, so many
+more versions fit in memory. It cannot confirm that a page exists, but it can
+say for certain that it does not, which is all that is needed to turn away
+requests for paths that were never published.
+"""
+
+import array
+import bisect
+import collections
+import hashlib
+import math
+import struct
+import sys
+import threading
+import cloudstorage
+import docstorage
+from lrucache import LRUCache
+
+
+class Manifest(object):
+  """Sorted index of the objects below a docs version directory."""
+
+  def __init__(self, entries):
+    """Arguments:
+    - entries: iterable of (path, size, etag, mtime, content_type) tuples,
+      where path is relative to the version directory and encoded as a utf-8
+      str, and content_type is None when it is not known. The content_type may
+      be left out."""
+    entries = sorted(entries)
+    self.paths = [entry[0] for entry in entries]
+    self.sizes = array.array('L', [entry[1] for entry in entries])
+    self.etags = [entry[2] for entry in entries]
+    self.mtimes = array.array('d', [entry[3] for entry in entries])
+    # A version only has a handful of content types, share their strings.
+    types = {}
+    self.content_types = [
+        types.setdefault(entry[4], entry[4]) if len(entry) > 4 else None
+        for entry in entries]
+    self._memory_usage = None
+
+  def __len__(self):
+    return len(self.paths)
+
+  def memory_usage(self):
+    """Number of bytes the manifest takes in memory as Python objects, which
+    is several times the size of its serialized form."""
+    if self._memory_usage is None:
+      usage = sys.getsizeof(self)
+      for values in (self.paths, self.etags):
+        usage += sys.getsizeof(values)
+        usage += sum(sys.getsizeof(value) for value in values)
+      for values in (self.sizes, self.mtimes):
+        usage += sys.getsizeof(values)
+      usage += sys.getsizeof(self.content_types)
+      usage += sum(sys.getsizeof(content_type) for content_type
+                   in set(self.content_types) if content_type is not None)
+      self._memory_usage = usage
+    return self._memory_usage
+
+  def __contains__(self, path):
+    return self._index(path) != -1
+
+  def _index(self, path):
+    index = bisect.bisect_left(self.paths, path)
+    if index < len(self.paths) and self.paths[index] == path:
+      return index
+    return -1
+
+  def lookup(self, path):
+    """Return a (size, etag, mtime, content_type) tuple for the given relative
+    path, or None if the version has no such object."""
+    index = self._index(path)
+    if index == -1:
+      return None
+    return (self.sizes[index], self.etags[index], self.mtimes[index],
+            self.content_types[index])
+
+  @classmethod
+  def build(cls, root, storage=None):
+    """List every object below the Google Storage directory root (of the form
+    /bucket/path/to/version) and return the manifest for it. The objects are
+    listed with the listdir of the given docstorage backend, or else straight
+    from Google Storage.
+
+    Listings of Google Storage have no content types. For those objects the
+    type gsutil uploads them with, the one guessed from their name, is
+    recorded instead; unless the name also has a content coding, like
+    index.html.gz, whose type is then left unknown."""
+    prefix = root + '/'
+    if storage is not None:
+      listing = storage.listdir(prefix)
+    else:
+      listing = cloudstorage.listbucket(prefix)
+    entries = []
+    for stat in listing:
+      if stat.is_dir:
+        continue
+      path = stat.filename[len(prefix):]
+      if isinstance(path, unicode):
+        path = path.encode('utf-8')
+      entries.append((path, stat.st_size, stat.etag, stat.st_ctime,
+                      stat.content_type or docstorage.guess_content_type(path)))
+    return cls(entries)
+
+  def dump(self, f):
+    """Write the manifest to the writable file object f."""
+    for index, path in enumerate(self.paths):
+      f.write('%s\t%d\t%s\t%r\t%s\n' % (path, self.sizes[index],
+                                        self.etags[index], self.mtimes[index],
+                                        self.content_types[index] or ''))
+
+  @classmethod
+  def load(cls, f):
+    """Read a manifest written by dump from the readable file object f."""
+    entries = []
+    for line in f:
+      fields = line.rstrip('\n').split('\t')
+      path, size, etag, mtime = fields[:4]
+      content_type = fields[4] if len(fields) > 4 else ''
+      entries.append((path, long(size), etag, float(mtime),
+                      content_type or None))
+    return cls(entries)
+
+
+class BloomFilter(object):
+  """Bloom filter over the relative paths of a docs version."""
+
+  HEADER = struct.Struct('<II')
+
+  def __init__(self, num_bits, num_hashes, bits=None):
+    self.num_bits = num_bits
+    self.num_hashes = num_hashes
+    if bits is None:
+      bits = bytearray((num_bits + 7) // 8)
+    self.bits = bits
+
+  @classmethod
+  def for_capacity(cls, capacity, error_rate):
+    """Create an empty filter sized to hold capacity paths with the given
+    false positive rate."""
+    capacity = max(capacity, 1)
+    num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                             (math.log(2) ** 2)))
+    num_hashes = max(1, int(round(float(num_bits) / capacity * math.log(2))))
+    return cls(num_bits, num_hashes)
+
+  def _positions(self, path):
+    if isinstance(path, unicode):
+      path = path.encode('utf-8')
+    h1, h2 = struct.unpack('<QQ', hashlib.md5(path).digest())
+    for i in xrange(self.num_hashes):
+      yield (h1 + i * h2) % self.num_bits
+
+  def add(self, path):
+    for position in self._positions(path):
+      self.bits[position >> 3] |= 1 << (position & 7)
+
+  def __contains__(self, path):
+    for position in self._positions(path):
+      if not self.bits[position >> 3] & (1 << (position & 7)):
+        return False
+    return True
+
+  def memory_usage(self):
+    """Number of bytes used by the bit array."""
+    return len(self.bits)
+
+  def dumps(self):
+    return self.HEADER.pack(self.num_bits, self.num_hashes) + str(self.bits)
+
+  @classmethod
+  def loads(cls, data):
+    num_bits, num_hashes = cls.HEADER.unpack_from(data)
+    return cls(num_bits, num_hashes, bytearray(data[cls.HEADER.size:]))
+
+
+class IndexCache(object):
+  """Thread safe per-instance cache of the manifests or filters loaded for
+  docs versions, keyed by the Google Storage directory of the version.
+
+  Entries are evicted least recently used first once there are more than
+  max_entries of them or once their total size, as reported by sizeof, is over
+  max_bytes. The index loaded last is kept even if it is over max_bytes on its
+  own, so that it is not loaded again for every request. A version without an
+  index is remembered for missing_ttl so that it is not looked up on every
+  request, and a version whose index could not be loaded for error_ttl, so
+  that while Google Storage fails requests do not all wait for it to fail
+  again. Those versions are kept apart, in a cache of at most max_missing of
+  them, so that requests for versions that were never published can neither
+  push loaded indexes out nor grow the cache without limit."""
+
+  def __init__(self, missing_ttl, max_entries=None, max_bytes=None,
+               sizeof=None, max_missing=1000, error_ttl=None):
+    self.missing_ttl = missing_ttl
+    self.error_ttl = error_ttl
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.sizeof = sizeof
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self._missing = LRUCache(max_entries=max_missing)
+
+  def get(self, root, load):
+    """Return the cached index for root, calling load(root) to fetch it on a
+    miss. load returns None if the version has no index and raises if the
+    index could not be fetched. The error is raised again, and for error_ttl
+    the version is treated as having no index."""
+    with self._lock:
+      index = self._entries.pop(root, None)
+      if index is not None:
+        self._entries[root] = index
+        return index
+    if self._missing.get(root):
+      return None
+    try:
+      index = load(root)
+    except Exception:
+      if self.error_ttl is not None:
+        self._missing.set(root, True, self.error_ttl.total_seconds())
+      raise
+    if index is None:
+      self._missing.set(root, True, self.missing_ttl.total_seconds())
+      return None
+    with self._lock:
+      self._discard(root)
+      self._entries[root] = index
+      self._bytes += self._size(index)
+      while len(self._entries) > 1 and self._over_budget():
+        self._discard(next(iter(self._entries)))
+    return index
+
+  def forget(self, root):
+    with self._lock:
+      self._discard(root)
+    self._missing.delete(root)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+    self._missing.clear()
+
+  def memory_usage(self):
+    """Total size of the cached indexes as reported by sizeof."""
+    return self._bytes
+
+  def __len__(self):
+    return len(self._entries)
+
+  def missing_count(self):
+    """Number of versions remembered as having no index."""
+    return len(self._missing)
+
+  def _size(self, index):
+    if self.sizeof is None:
+      return 0
+    return self.sizeof(index)
+
+  def _discard(self, root):
+    index = self._entries.pop(root, None)
+    if index is not None:
+      self._bytes -= self._size(index)
+
+  def _over_budget(self):
+    return ((self.max_entries is not None and
+             len(self._entries) > self.max_entries) or
+            (self.max_bytes is not None and self._bytes > self.max_bytes))
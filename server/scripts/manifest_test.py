@@ -0,0 +1,279 @@
+# Copyright (c) 2026, the Dart project authors.  Please see the AUTHORS file
+# for details. All rights reserved. Use of this source code is governed by a
+# BSD-style license that can be found in the LICENSE file.
+
+"""Tests for manifest.py.
+
+They need the App Engine SDK, and are run from this directory with it on the
+path:
+
+  PYTHONPATH=<path to google_appengine> python -m unittest manifest_test
+"""
+
+import StringIO
+import time
+import unittest
+from datetime import timedelta
+
+try:
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+except ImportError:
+  pass
+
+import cloudstorage
+import docstorage
+from manifest import BloomFilter, IndexCache, Manifest
+
+ROOT = '/dartlang-api-docs/gen-dartdocs/stable/3.4.0'
+
+ENTRIES = [
+  ('index.html', 1234, 'e7d8f0a1', 1700000000.25, 'text/html'),
+  ('index.html.gz', 456, 'a1b2c3d4', 1700000000.25, None),
+  ('dart-core/String-class.html', 56789, '0a1b2c3d', 1700000001.5,
+   'text/html'),
+  ('dart-core/dart-core-library.html', 4321, 'ffee0011', 1700000002.0,
+   'text/html'),
+  ('static-assets/styles.css', 99, '12345678', 1700000003.75, 'text/css'),
+]
+
+
+class ManifestTest(unittest.TestCase):
+
+  def test_lookup(self):
+    manifest = Manifest(ENTRIES)
+    self.assertEqual(len(ENTRIES), len(manifest))
+    for entry in ENTRIES:
+      self.assertIn(entry[0], manifest)
+      self.assertEqual(entry[1:], manifest.lookup(entry[0]))
+    self.assertNotIn('dart-core', manifest)
+    self.assertIsNone(manifest.lookup('dart-core/List-class.html'))
+    self.assertIsNone(manifest.lookup(''))
+
+  def test_dump_and_load(self):
+    f = StringIO.StringIO()
+    Manifest(ENTRIES).dump(f)
+    lines = f.getvalue().splitlines()
+    self.assertEqual(sorted(lines), lines)
+    f.seek(0)
+    manifest = Manifest.load(f)
+    self.assertEqual(sorted(entry[0] for entry in ENTRIES), manifest.paths)
+    for entry in ENTRIES:
+      self.assertEqual(entry[1:], manifest.lookup(entry[0]))
+
+  def test_load_without_content_types(self):
+    f = StringIO.StringIO('dart-core/String-class.html\t56789\t0a1b2c3d\t'
+                          '1700000001.5\nindex.html\t1234\te7d8f0a1\t'
+                          '1700000000.25\n')
+    manifest = Manifest.load(f)
+    self.assertEqual((1234, 'e7d8f0a1', 1700000000.25, None),
+                     manifest.lookup('index.html'))
+    # Entries without a content type are accepted too.
+    manifest = Manifest([entry[:4] for entry in ENTRIES])
+    self.assertEqual((99, '12345678', 1700000003.75, None),
+                     manifest.lookup('static-assets/styles.css'))
+
+  def test_build(self):
+    storage = docstorage.MemoryStorage()
+    storage.put(ROOT + '/index.html', 'index', 'text/html; charset=utf-8')
+    storage.put(ROOT + '/dart-core/String-class.html', 'String')
+    storage.put(ROOT + '/index.html.gz', 'gzipped index')
+    storage.put(ROOT + '-dev/index.html', 'another version')
+    manifest = Manifest.build(ROOT, storage)
+    self.assertEqual(['dart-core/String-class.html', 'index.html',
+                      'index.html.gz'], manifest.paths)
+    stat = storage.stat(ROOT + '/index.html')
+    self.assertEqual((stat.st_size, stat.etag, stat.st_ctime,
+                      'text/html; charset=utf-8'),
+                     manifest.lookup('index.html'))
+    # Without a content type in the listing, as from Google Storage, the type
+    # comes from the name, unless the name has a content coding too.
+    self.assertEqual('text/html',
+                     manifest.lookup('dart-core/String-class.html')[3])
+    self.assertIsNone(manifest.lookup('index.html.gz')[3])
+
+  def test_memory_usage_grows_with_entries(self):
+    small = Manifest(ENTRIES)
+    large = Manifest([('page%05d.html' % i, i, '%032x' % i, float(i),
+                       'text/html') for i in xrange(1000)])
+    f = StringIO.StringIO()
+    large.dump(f)
+    self.assertGreater(small.memory_usage(), 0)
+    # Python objects take more room than the serialized manifest.
+    self.assertGreater(large.memory_usage(), len(f.getvalue()))
+
+
+class BloomFilterTest(unittest.TestCase):
+
+  PATHS = ['dart-core/Class%d-class.html' % i for i in xrange(2000)]
+
+  def build(self, error_rate=0.01):
+    bloom_filter = BloomFilter.for_capacity(len(self.PATHS), error_rate)
+    for path in self.PATHS:
+      bloom_filter.add(path)
+    return bloom_filter
+
+  def false_positives(self, bloom_filter):
+    unknown = ['dart-core/Other%d-class.html' % i for i in xrange(20000)]
+    return sum(1 for path in unknown if path in bloom_filter)
+
+  def test_has_every_path_added(self):
+    bloom_filter = self.build()
+    for path in self.PATHS:
+      self.assertIn(path, bloom_filter)
+
+  def test_false_positive_rate(self):
+    for error_rate in (0.1, 0.01, 0.001):
+      bloom_filter = self.build(error_rate)
+      # The paths hash the same on every run, so the count does not vary.
+      self.assertLess(self.false_positives(bloom_filter),
+                      20000 * error_rate * 2, error_rate)
+
+  def test_memory_usage_follows_error_rate(self):
+    loose = self.build(0.1)
+    tight = self.build(0.001)
+    self.assertEqual(len(loose.bits), loose.memory_usage())
+    self.assertGreater(tight.memory_usage(), loose.memory_usage() * 2)
+    # About 1.2 bytes per path at 1%.
+    self.assertLess(self.build(0.01).memory_usage(), len(self.PATHS) * 2)
+
+  def test_unicode_paths(self):
+    bloom_filter = BloomFilter.for_capacity(1, 0.01)
+    bloom_filter.add(u'dart-core/Caf\xe9-class.html')
+    self.assertIn(u'dart-core/Caf\xe9-class.html'.encode('utf-8'),
+                  bloom_filter)
+
+  def test_dumps_and_loads(self):
+    bloom_filter = self.build()
+    loaded = BloomFilter.loads(bloom_filter.dumps())
+    self.assertEqual(bloom_filter.num_bits, loaded.num_bits)
+    self.assertEqual(bloom_filter.num_hashes, loaded.num_hashes)
+    self.assertEqual(bloom_filter.bits, loaded.bits)
+    for path in self.PATHS:
+      self.assertIn(path, loaded)
+    self.assertEqual(self.false_positives(bloom_filter),
+                     self.false_positives(loaded))
+
+
+class IndexCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.loads = []
+    self.indexes = {}
+
+  def load(self, root):
+    self.loads.append(root)
+    index = self.indexes.get(root)
+    if isinstance(index, Exception):
+      raise index
+    return index
+
+  def test_loads_once(self):
+    cache = IndexCache(timedelta(hours=1))
+    self.indexes['a'] = 'index of a'
+    self.assertEqual('index of a', cache.get('a', self.load))
+    self.assertEqual('index of a', cache.get('a', self.load))
+    self.assertEqual(['a'], self.loads)
+    self.assertEqual(1, len(cache))
+
+  def test_missing_index_is_remembered_apart(self):
+    cache = IndexCache(timedelta(hours=1), max_entries=1, max_missing=2)
+    self.indexes['a'] = 'index of a'
+    cache.get('a', self.load)
+    for root in ('b', 'c', 'd', 'c'):
+      self.assertIsNone(cache.get(root, self.load))
+    self.assertEqual(['a', 'b', 'c', 'd'], self.loads)
+    self.assertEqual(2, cache.missing_count())
+    # Versions without an index did not push the loaded one out.
+    self.assertEqual('index of a', cache.get('a', self.load))
+    self.assertEqual(4, len(self.loads))
+
+  def test_missing_index_is_looked_up_again_later(self):
+    cache = IndexCache(timedelta(seconds=0.01))
+    self.assertIsNone(cache.get('a', self.load))
+    self.indexes['a'] = 'index of a'
+    self.assertIsNone(cache.get('a', self.load))
+    time.sleep(0.02)
+    self.assertEqual('index of a', cache.get('a', self.load))
+    self.assertEqual(['a', 'a'], self.loads)
+
+  def test_failed_load_is_retried_after_error_ttl(self):
+    cache = IndexCache(timedelta(hours=1), error_ttl=timedelta(seconds=0.01))
+    self.indexes['a'] = cloudstorage.TransientError('down')
+    self.assertRaises(cloudstorage.TransientError, cache.get, 'a', self.load)
+    self.assertIsNone(cache.get('a', self.load))
+    self.assertEqual(['a'], self.loads)
+    self.indexes['a'] = 'index of a'
+    time.sleep(0.02)
+    self.assertEqual('index of a', cache.get('a', self.load))
+
+  def test_failed_load_is_retried_without_error_ttl(self):
+    cache = IndexCache(timedelta(hours=1))
+    self.indexes['a'] = cloudstorage.TransientError('down')
+    self.assertRaises(cloudstorage.TransientError, cache.get, 'a', self.load)
+    self.assertRaises(cloudstorage.TransientError, cache.get, 'a', self.load)
+    self.assertEqual(['a', 'a'], self.loads)
+
+  def test_evicts_least_recently_used_by_count(self):
+    cache = IndexCache(timedelta(hours=1), max_entries=2)
+    for root in 'abc':
+      self.indexes[root] = 'index of ' + root
+    cache.get('a', self.load)
+    cache.get('b', self.load)
+    cache.get('a', self.load)
+    cache.get('c', self.load)
+    self.assertEqual(2, len(cache))
+    cache.get('a', self.load)
+    cache.get('b', self.load)
+    self.assertEqual(['a', 'b', 'c', 'b'], self.loads)
+
+  def test_evicts_by_bytes(self):
+    cache = IndexCache(timedelta(hours=1), max_bytes=10, sizeof=len)
+    self.indexes.update({'a': 'x' * 4, 'b': 'x' * 4, 'c': 'x' * 4})
+    cache.get('a', self.load)
+    cache.get('b', self.load)
+    self.assertEqual(8, cache.memory_usage())
+    cache.get('c', self.load)
+    self.assertEqual(2, len(cache))
+    self.assertEqual(8, cache.memory_usage())
+    cache.get('b', self.load)
+    self.assertEqual(['a', 'b', 'c'], self.loads)
+
+  def test_keeps_an_index_over_budget_on_its_own(self):
+    cache = IndexCache(timedelta(hours=1), max_bytes=10, sizeof=len)
+    self.indexes.update({'a': 'x' * 4, 'b': 'x' * 20})
+    cache.get('a', self.load)
+    cache.get('b', self.load)
+    cache.get('b', self.load)
+    self.assertEqual(1, len(cache))
+    self.assertEqual(20, cache.memory_usage())
+    self.assertEqual(['a', 'b'], self.loads)
+
+  def test_manifests_are_evicted_by_memory_usage(self):
+    manifest = Manifest(ENTRIES)
+    cache = IndexCache(timedelta(hours=1),
+                       max_bytes=manifest.memory_usage() * 2,
+                       sizeof=Manifest.memory_usage)
+    for root in 'abc':
+      self.indexes[root] = Manifest(ENTRIES)
+      cache.get(root, self.load)
+    self.assertEqual(2, len(cache))
+    self.assertEqual(manifest.memory_usage() * 2, cache.memory_usage())
+
+  def test_forget(self):
+    cache = IndexCache(timedelta(hours=1))
+    self.indexes['a'] = 'index of a'
+    cache.get('a', self.load)
+    self.assertIsNone(cache.get('b', self.load))
+    cache.forget('a')
+    cache.forget('b')
+    self.assertEqual(0, len(cache))
+    self.assertEqual(0, cache.missing_count())
+    self.indexes['b'] = 'index of b'
+    self.assertEqual('index of a', cache.get('a', self.load))
+    self.assertEqual('index of b', cache.get('b', self.load))
+    self.assertEqual(['a', 'b', 'a', 'b'], self.loads)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,316 @@
+# Copyright (c) 2026, the Dart project authors.  Please see the AUTHORS file
+# for details. All rights reserved. Use of this source code is governed by a
+# BSD-style license that can be found in the LICENSE file.
+
+"""Incremental mirror of the generated docs on local disk.
+
+The mirror has the layout docstorage.LocalStorage serves from: the object
+/bucket/path/to/object is stored at <root>/bucket/path/to/object. What has
+been downloaded is recorded in a JSON state file at <root>/STATE_FILE:
+
+  {"objects": {"<path>": {"etag": "<etag>", "size": <size>}, ...},
+   "versions": ["<version directory>", ...]}
+
+Published versions never change, so once every object of a version has been
+downloaded the version is listed under "versions" and is not looked at again.
+A version is only listed once none of its objects is newer than the
+latest.txt of its channel, which the publisher writes after uploading a
+version: a version uploaded since may not be complete yet. Syncing after a
+release costs one listing of the channel plus the files of the new version.
+Objects are only downloaded when their etag or size differ from the state
+file, or when the local copy is gone. The state file is saved at the end of
+every channel, and every STATE_SAVE_INTERVAL seconds in between.
+
+Downloads run concurrently, at most concurrency at a time and with at most
+MAX_BYTES_IN_FLIGHT bytes of bodies being received, with the async GETs of
+the cloudstorage library. Objects bigger than MAX_GET_SIZE are fetched in
+parallel parts with cloudstorage.download instead.
+
+Like the redirector, this uses the cloudstorage library, so it runs with the
+App Engine SDK on the path. Outside of App Engine there is no app identity
+service for the library to get its OAuth tokens from, nor memcache to keep
+them in, so main() registers local stand-ins for the services first (see
+register_api_stubs). The tokens are those of the Application Default
+Credentials (gcloud auth application-default login, or
+GOOGLE_APPLICATION_CREDENTIALS naming a service account key file), or of the
+service account given with --service-account and its PEM private key with
+--private-key:
+
+  PYTHONPATH=<path to google_appengine> python mirror.py /srv/api-docs stable
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+
+try:
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+except ImportError:
+  pass
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import urlfetch_stub
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.ext import ndb
+import cloudstorage
+from cloudstorage import api_utils
+from cloudstorage import storage_api
+
+GEN_DARTDOCS = '/dartlang-api-docs/gen-dartdocs'
+CHANNEL_LATEST = '/dartlang-api-docs/channels/%s/latest.txt'
+CHANNELS = ('stable', 'beta', 'dev', 'main')
+STATE_FILE = '.mirror-state.json'
+# How often the state file is saved while a channel is synced. It is
+# rewritten whole, so saving it after every version would make a first sync
+# quadratic in the number of versions.
+STATE_SAVE_INTERVAL = 60
+# Objects up to this size are downloaded with a single GET, bigger ones in
+# parts of DOWNLOAD_PART_SIZE.
+MAX_GET_SIZE = 8 * 1024 * 1024
+DOWNLOAD_PART_SIZE = 4 * 1024 * 1024
+# Bodies are held in memory until they are written, so the concurrent GETs
+# are limited to this many bytes in all, beyond one object at a time.
+MAX_BYTES_IN_FLIGHT = 64 * 1024 * 1024
+
+
+def register_api_stubs(app_id, email_address=None, private_key_path=None):
+  """Register local stand-ins for the App Engine services the cloudstorage
+  library needs, so that it can reach Google Storage from outside of App
+  Engine: memcache and an in-memory datastore to keep its tokens in, urlfetch
+  to make requests, and an app identity service to get the tokens from.
+
+  Arguments:
+  - app_id: the application id the services run as.
+  - email_address: the service account to get the tokens for, or None to use
+    the Application Default Credentials.
+  - private_key_path: the PEM private key of the service account."""
+  from google.appengine.api.app_identity import (
+      app_identity_defaultcredentialsbased_stub)
+  from google.appengine.api.app_identity import app_identity_keybased_stub
+  os.environ['APPLICATION_ID'] = app_id
+  # The library talks to the Google Storage emulation of the development
+  # server when SERVER_SOFTWARE is unset or starts with Development.
+  os.environ['SERVER_SOFTWARE'] = 'mirror'
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_stub_map.apiproxy.RegisterStub(
+      'memcache', memcache_stub.MemcacheServiceStub())
+  apiproxy_stub_map.apiproxy.RegisterStub(
+      'urlfetch', urlfetch_stub.URLFetchServiceStub())
+  apiproxy_stub_map.apiproxy.RegisterStub(
+      'datastore_v3', datastore_file_stub.DatastoreFileStub(app_id, None))
+  if email_address is not None:
+    app_identity = app_identity_keybased_stub.KeyBasedAppIdentityServiceStub(
+        email_address=email_address, private_key_path=private_key_path)
+  else:
+    # Unlike AppIdentityServiceStub.Create, fail right away when there are no
+    # credentials instead of handing out tokens Google Storage refuses.
+    app_identity = (app_identity_defaultcredentialsbased_stub.
+                    DefaultCredentialsBasedAppIdentityServiceStub())
+  apiproxy_stub_map.apiproxy.RegisterStub('app_identity_service', app_identity)
+
+
+class Mirror(object):
+  """A local mirror of part of the docs bucket below root."""
+
+  def __init__(self, root, concurrency=16):
+    self.root = os.path.abspath(root)
+    self.concurrency = concurrency
+    self.objects = {}
+    self.versions = set()
+    # Objects downloaded and bytes written since the mirror was created, and
+    # the most bytes of bodies that were being received at the same time.
+    self.downloaded = 0
+    self.downloaded_bytes = 0
+    self.peak_bytes_in_flight = 0
+    self.saved_at = time.time()
+    self.load_state()
+
+  def state_path(self):
+    return os.path.join(self.root, STATE_FILE)
+
+  def local_path(self, path):
+    return os.path.join(self.root, path.lstrip('/'))
+
+  def load_state(self):
+    try:
+      with open(self.state_path()) as f:
+        state = json.load(f)
+    except IOError:
+      return
+    self.objects = state.get('objects', {})
+    self.versions = set(state.get('versions', []))
+
+  def save_state(self):
+    state = {'objects': self.objects, 'versions': sorted(self.versions)}
+    self.write_file(self.state_path(), json.dumps(state, sort_keys=True))
+    self.saved_at = time.time()
+
+  def checkpoint(self):
+    """Save the state if it was last saved STATE_SAVE_INTERVAL ago, so that
+    not all is lost when a long sync is cut short."""
+    if time.time() - self.saved_at >= STATE_SAVE_INTERVAL:
+      self.save_state()
+
+  def write_file(self, local_path, content):
+    """Replace the file at local_path with content, so that a sync that is
+    cut short never leaves a partial file behind."""
+    directory = os.path.dirname(local_path)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    temp_path = local_path + '.part'
+    with open(temp_path, 'wb') as f:
+      f.write(content)
+    os.rename(temp_path, local_path)
+
+  def sync_channel(self, channel):
+    """Mirror every version of the channel, and its latest.txt. Returns the
+    number of objects downloaded."""
+    downloaded = self.downloaded
+    # Before the versions, so that a version published meanwhile is not
+    # taken for complete.
+    latest = self.stat_latest(channel)
+    prefix = '%s/%s/' % (GEN_DARTDOCS, channel)
+    for stat in cloudstorage.listbucket(prefix, delimiter='/'):
+      if stat.is_dir and stat.filename.rstrip('/') not in self.versions:
+        self.sync_version(stat.filename.rstrip('/'), latest.st_ctime)
+        self.checkpoint()
+    self.sync_objects([latest])
+    self.save_state()
+    return self.downloaded - downloaded
+
+  def stat_latest(self, channel):
+    """The GCSFileStat of the latest.txt of the channel. It comes from a
+    listing, whose modification times, unlike those of a stat, have the
+    precision of those of the objects of the versions."""
+    path = CHANNEL_LATEST % channel
+    for stat in cloudstorage.listbucket(path):
+      if stat.filename == path:
+        return stat
+    raise cloudstorage.NotFoundError(path)
+
+  def sync_version(self, version_dir, published_before):
+    """Mirror the objects below version_dir, a Google Storage directory like
+    /dartlang-api-docs/gen-dartdocs/stable/3.4.0. The version is not looked
+    at again if all of them were downloaded and none was modified after
+    published_before, the modification time of latest.txt."""
+    stats = [stat for stat in cloudstorage.listbucket(version_dir + '/')
+             if not stat.is_dir]
+    if (self.sync_objects(stats) and stats and
+        max(stat.st_ctime for stat in stats) <= published_before):
+      self.versions.add(version_dir)
+
+  def is_current(self, stat):
+    known = self.objects.get(stat.filename)
+    return (known is not None and known['etag'] == stat.etag and
+            known['size'] == stat.st_size and
+            os.path.exists(self.local_path(stat.filename)))
+
+  def sync_objects(self, stats):
+    """Download the objects of the given GCSFileStats that changed. Returns
+    whether all of them are now current."""
+    pending = [stat for stat in stats if not self.is_current(stat)]
+    large = [stat for stat in pending if stat.st_size > MAX_GET_SIZE]
+    small = [stat for stat in pending if stat.st_size <= MAX_GET_SIZE]
+    ok = True
+    for stat in large:
+      try:
+        self.copy_object(stat)
+      except Exception:
+        logging.exception('Could not download ' + stat.filename)
+        ok = False
+    return self.download_objects(small) and ok
+
+  def download_objects(self, stats):
+    """Download the objects of the given GCSFileStats, with at most
+    concurrency GETs and MAX_BYTES_IN_FLIGHT bytes in flight. Returns whether
+    all of them succeeded."""
+    api = storage_api._get_storage_api(retry_params=None)
+    queue = list(reversed(stats))
+    in_flight = {}
+    bytes_in_flight = 0
+    ok = True
+    while queue or in_flight:
+      while (queue and len(in_flight) < self.concurrency and
+             (not in_flight or bytes_in_flight + queue[-1].st_size <=
+              MAX_BYTES_IN_FLIGHT)):
+        stat = queue.pop()
+        in_flight[api.get_object_async(
+            api_utils._quote_filename(stat.filename))] = stat
+        bytes_in_flight += stat.st_size
+      self.peak_bytes_in_flight = max(self.peak_bytes_in_flight,
+                                      bytes_in_flight)
+      future = ndb.Future.wait_any(in_flight.keys())
+      stat = in_flight.pop(future)
+      bytes_in_flight -= stat.st_size
+      try:
+        status, headers, content = future.get_result()
+        cloudstorage.check_status(status, [200], stat.filename,
+                                  resp_headers=headers, body=content)
+        self.write_file(self.local_path(stat.filename), content)
+        self.record(stat, len(content))
+      except Exception:
+        logging.exception('Could not download ' + stat.filename)
+        ok = False
+    return ok
+
+  def copy_object(self, stat):
+    """Download one object too big for a single GET in parallel parts, as
+    many at a time as fit in MAX_BYTES_IN_FLIGHT."""
+    local_path = self.local_path(stat.filename)
+    directory = os.path.dirname(local_path)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    temp_path = local_path + '.part'
+    concurrency = max(1, min(self.concurrency,
+                             MAX_BYTES_IN_FLIGHT // DOWNLOAD_PART_SIZE))
+    with open(temp_path, 'wb') as f:
+      result = cloudstorage.download(stat.filename, f,
+                                     concurrency=concurrency,
+                                     part_size=DOWNLOAD_PART_SIZE)
+    os.rename(temp_path, local_path)
+    logging.info('%s: %d bytes at %.0f bytes/s', stat.filename,
+                 result['bytes'], result['bytes_per_second'] or 0)
+    self.record(stat, result['bytes'])
+
+  def record(self, stat, size):
+    self.objects[stat.filename] = {'etag': stat.etag, 'size': stat.st_size}
+    self.downloaded += 1
+    self.downloaded_bytes += size
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Mirror the generated docs to a local directory.')
+  parser.add_argument('root', help='directory to mirror to')
+  parser.add_argument('channels', nargs='*', default=CHANNELS,
+                      help='channels to mirror (default: all)')
+  parser.add_argument('--concurrency', type=int, default=16,
+                      help='downloads in flight at a time')
+  parser.add_argument('--app-id', default='dart-api-docs-mirror',
+                      help='application id to run the App Engine APIs as')
+  parser.add_argument('--service-account',
+                      help='service account to read the bucket as (default: '
+                      'the Application Default Credentials)')
+  parser.add_argument('--private-key',
+                      help='PEM private key of --service-account')
+  args = parser.parse_args()
+  if bool(args.service_account) != bool(args.private_key):
+    parser.error('--service-account and --private-key go together')
+  logging.basicConfig(level=logging.INFO)
+  register_api_stubs(args.app_id, args.service_account, args.private_key)
+
+  mirror = Mirror(args.root, args.concurrency)
+  start = time.time()
+  for channel in args.channels:
+    count = mirror.sync_channel(channel)
+    logging.info('%s: %d objects downloaded', channel, count)
+  logging.info('%d objects, %d bytes in %.1fs', mirror.downloaded,
+               mirror.downloaded_bytes, time.time() - start)
+
+
+if __name__ == '__main__':
+  main()
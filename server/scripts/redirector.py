@@ -2,47 +2,291 @@
 # for details. All rights reserved. Use of this source code is governed by a
 # BSD-style license that can be found in the LICENSE file.
 
+import hmac
 import logging
+import mimetypes
+import os
 import re
 import json
+import threading
+import time
+import urllib
+import urlparse
+import uuid
 from webapp2 import *
 from webapp2_extras.routes import DomainRoute
+from webob import exc
 from datetime import datetime, timedelta
-from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
 from google.appengine.api import memcache
+from google.appengine.api import users
+from google.appengine.ext import ndb
 import cloudstorage
+from cloudstorage import common
+import docstorage
+from lrucache import LRUCache
+from manifest import BloomFilter, IndexCache, Manifest
 
 ONE_HOUR = 60 * 60
 ONE_DAY = ONE_HOUR * 24
 ONE_WEEK = ONE_DAY * 7
+ONE_YEAR = ONE_DAY * 365
+
+# Hosts that are served by this application.
+OWN_HOSTS = ('api.dart.dev',)
+# Longest redirect chain followed on the server before redirecting the client.
+MAX_REDIRECT_HOPS = 10
+# Longest time the redirect of a channel to its latest version is cached. A
+# release is refreshed right away on publishing, so it should not take the
+# whole update interval of the channel to reach the users of a cache.
+MAX_REDIRECT_CACHE_AGE = 10 * 60
 
 # for redirects below
 ONLY_DART_LIB = re.compile("^dart:([a-zA-Z0-9_]+)$")
 LIB_NAME_AND_CLASS_NAME = re.compile("^dart[:-]([^\.]+)\.(.+)$")
+# Versions whose docs never change once published: releases, git hashes and
+# the old numbered bleeding edge builds.
+IMMUTABLE_VERSION = re.compile(
+    r'^((\d+\.){2}\d+([\+-][\.a-zA-Z0-9-\+]*)?|[0-9a-f]{40}|\d+)$')
+
+def cache_control(age, immutable=False, stale_if_error=None):
+  """Cache-Control header value letting browsers and intermediate caches keep
+  a response for age seconds, and for stale_if_error seconds more when they
+  get an error trying to refresh it."""
+  value = 'max-age=%d,s-maxage=%d' % (age, age)
+  if immutable:
+    value += ',immutable'
+  if stale_if_error:
+    value += ',stale-if-error=%d' % stale_if_error
+  return value
+
+BYTE_RANGE = re.compile(r'^(\d*)-(\d*)$')
+
+def parse_byte_ranges(header, size):
+  """Parse the value of a Range header asking for parts of an object of size
+  bytes. Returns the satisfiable ranges as inclusive (start, end) tuples, an
+  empty list if there are none, or None if the header is not a valid bytes
+  range and has to be ignored."""
+  units, _, specs = header.partition('=')
+  if units.strip().lower() != 'bytes' or not specs.strip():
+    return None
+  ranges = []
+  for spec in specs.split(','):
+    spec = spec.strip()
+    if not spec:
+      continue
+    match = BYTE_RANGE.match(spec)
+    if not match or not (match.group(1) or match.group(2)):
+      return None
+    first, last = match.groups()
+    if not first:
+      # The last bytes of the object.
+      length = int(last)
+      if length:
+        ranges.append((max(size - length, 0), size - 1))
+      continue
+    start = int(first)
+    if last and start > int(last):
+      return None
+    if start < size:
+      end = int(last) if last else size - 1
+      ranges.append((start, min(end, size - 1)))
+  return ranges
+
+def encoding_qualities(header):
+  """Parse the value of an Accept-Encoding header into a function giving the
+  quality of a content coding. As in RFC 7231 a coding named in the header
+  gets its own quality, even 0, and '*' only stands for the others; webob
+  lets '*' override a coding refused with q=0."""
+  qualities = {}
+  for spec in (header or '').split(','):
+    coding, _, params = spec.partition(';')
+    coding = coding.strip().lower()
+    if not coding:
+      continue
+    quality = 1.0
+    for param in params.split(';'):
+      name, _, value = param.partition('=')
+      if name.strip().lower() == 'q':
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0.0
+    qualities[coding] = quality
+  wildcard = qualities.get('*', 0.0)
+  return lambda coding: qualities.get(coding, wildcard)
 
 class VersionInfo(object):
   """Small helper class holding information about the last version seen and the
   last time the version was checked for."""
+  # How long to keep serving the known version after a failed refresh before
+  # trying again.
+  RETRY_INTERVAL = timedelta(minutes=1)
+  # How often to look at the version shared by all instances in memcache.
+  SHARED_CHECK_INTERVAL = timedelta(seconds=10)
+
   def __init__(self, update_interval):
     # The most recent version for this channel.
     self.version = None
     # The time this version was found.
     self.last_check = None
     self.update_interval = update_interval
+    # The generation of the shared version this version was taken from, and
+    # the last time the shared version was looked at.
+    self.generation = None
+    self.last_shared_check = None
+    # Held by the one request refreshing the version.
+    self.refresh_lock = threading.Lock()
+    # Lookups served from the known version, refreshes from Google Storage,
+    # refreshes that failed and refreshes left to another instance.
+    self.hits = 0
+    self.misses = 0
+    self.errors = 0
+    self.deferred = 0
 
   def should_update(self):
     """Tests to see if the last check was long enough past the update interval
     that we should update the version."""
     return datetime.now() > self.last_check + self.update_interval
 
+  def seconds_left(self):
+    """Seconds until the version is next updated, 0 if it is due."""
+    left = self.last_check + self.update_interval - datetime.now()
+    return max(0, int(left.total_seconds()))
+
+  def should_check_shared(self):
+    return (self.last_shared_check is None or
+            datetime.now() > self.last_shared_check +
+            VersionInfo.SHARED_CHECK_INTERVAL)
+
+  def retry_later(self, interval=RETRY_INTERVAL):
+    """Postpone the next update to interval from now."""
+    self.last_check = (datetime.now() - self.update_interval +
+                       min(interval, self.update_interval))
+
+  def stats(self):
+    return {'version': self.version, 'generation': self.generation,
+            'hits': self.hits, 'misses': self.misses, 'errors': self.errors,
+            'deferred': self.deferred}
+
+class DocInfo(object):
+  """What the server knows about a page without reading it: its size, etag,
+  modification time and content type. Any of them may be None when the source
+  of the information did not have it."""
+  __slots__ = ('size', 'etag', 'mtime', 'content_type')
+
+  def __init__(self, size=None, etag=None, mtime=None, content_type=None):
+    self.size = size
+    self.etag = etag
+    self.mtime = mtime
+    self.content_type = content_type
+
+  @classmethod
+  def from_stat(cls, stat):
+    return cls(stat.st_size, stat.etag, stat.st_ctime, stat.content_type)
+
+  def dumps(self):
+    """Serialize for memcache. The leading 1 keeps the value readable by
+    instances that only look for the "1" they used to store."""
+    return '\t'.join(['1'] + ['' if value is None else str(value)
+                              for value in (self.size, self.etag, self.mtime,
+                                            self.content_type)])
+
+  @classmethod
+  def loads(cls, value):
+    fields = value.split('\t')[1:] + [''] * 4
+    size, etag, mtime, content_type = [field or None for field in fields[:4]]
+    return cls(size and long(size), etag, mtime and float(mtime),
+               content_type)
+
+  def memory_usage(self):
+    """Rough number of bytes the info takes in memory."""
+    return 120 + len(self.etag or '') + len(self.content_type or '')
+
+def doc_info_size(path, info):
+  """Size of an entry of the DocInfo cache, None meaning a missing page."""
+  size = 80 + len(path)
+  if info is not None:
+    size += info.memory_usage()
+  return size
+
+class CallGroup(object):
+  """Lets concurrent requests of an instance that need the same thing share
+  one call to get it: the first request makes the call and the others wait
+  for its result, or its exception."""
+
+  class _Call(object):
+    def __init__(self):
+      self.done = threading.Event()
+      self.result = None
+      self.error = None
+
+  def __init__(self):
+    self._calls = {}
+    self._lock = threading.Lock()
+    # Calls made, and requests that waited for a call of another request.
+    self.calls = 0
+    self.shared = 0
+
+  def do(self, key, func):
+    """Return func(), unless a call for key is already in flight, in which
+    case wait for that call and return its result."""
+    with self._lock:
+      call = self._calls.get(key)
+      if call is None:
+        call = self._calls[key] = CallGroup._Call()
+        self.calls += 1
+        leader = True
+      else:
+        self.shared += 1
+        leader = False
+    if not leader:
+      call.done.wait()
+      if call.error is not None:
+        raise call.error
+      return call.result
+    try:
+      call.result = func()
+      return call.result
+    except Exception as e:
+      call.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+
+  def stats(self):
+    return {'in_flight': len(self._calls), 'calls': self.calls,
+            'shared': self.shared}
+
+class RefreshToken(ndb.Model):
+  """The secret the docs publisher presents to the refresh handler. It lives in
+  the datastore, under the id 'refresh', to keep it out of the source."""
+  token = ndb.StringProperty(indexed=False)
+
 class ApiDocs(blobstore_handlers.BlobstoreDownloadHandler):
   GOOGLE_STORAGE = '/dartlang-api-docs/channels'
   GOOGLE_STORAGE_NEW = '/dartlang-api-docs/gen-dartdocs'
+  GOOGLE_STORAGE_MANIFESTS = '/dartlang-api-docs/manifests'
+  # Where the docs are read from, Google Storage unless DOCS_STORAGE says
+  # otherwise. See docstorage.py. A user is waiting for the reads, so they
+  # give up after a few seconds instead of the 30 the library allows, and
+  # the last known good answers are served instead.
+  REQUEST_RETRY_PARAMS = cloudstorage.RetryParams(
+      initial_delay=0.1, max_delay=1.0, min_retries=0, max_retries=2,
+      max_retry_period=5.0, urlfetch_timeout=5.0)
+  storage = docstorage.from_environment(REQUEST_RETRY_PARAMS)
 
   def version_file_loc(self, channel):
     return '%s/%s/latest.txt' % (ApiDocs.GOOGLE_STORAGE, channel)
 
+  def manifest_loc(self, root, extension='txt'):
+    """Location of the manifest for the docs version stored below root. The
+    Bloom filter of the version is stored next to it with extension bloom."""
+    return '%s%s.%s' % (ApiDocs.GOOGLE_STORAGE_MANIFESTS,
+                        root[len(ApiDocs.GOOGLE_STORAGE_NEW):], extension)
+
   # Dictionary of versions holding version information of the latest recorded
   # version number and the time when it was recorded.
   latest_versions = {
@@ -52,18 +296,158 @@ class ApiDocs(blobstore_handlers.BlobstoreDownloadHandler):
     'stable': VersionInfo(timedelta(days=1)),
   }
 
+  # How long to wait before looking again for a manifest that did not exist,
+  # and how many versions without one to remember.
+  MISSING_MANIFEST_RECHECK = timedelta(hours=1)
+  MISSING_MANIFEST_ENTRIES = 4096
+  # How soon to retry a lookup or an index load that failed, and to tell
+  # clients to retry when there was nothing to fall back on.
+  LOOKUP_RETRY_INTERVAL = 60
+  # Manifests of recently served docs versions. They hold every path of a
+  # version, about 6MB as Python objects for a release of 30000 pages, so
+  # only a few are kept. The budget should hold the latest version of every
+  # channel, and can be set per deployment with env_variables in app.yaml.
+  MANIFEST_MEMORY_BUDGET = int(
+      os.environ.get('MANIFEST_CACHE_BYTES', 24 * 1024 * 1024))
+  manifests = IndexCache(
+      MISSING_MANIFEST_RECHECK, max_entries=8,
+      max_bytes=MANIFEST_MEMORY_BUDGET, sizeof=Manifest.memory_usage,
+      max_missing=MISSING_MANIFEST_ENTRIES,
+      error_ttl=timedelta(seconds=LOOKUP_RETRY_INTERVAL))
+
+  # False positive rate of newly built Bloom filters, and the number of bytes
+  # an instance may spend on keeping them in memory.
+  BLOOM_ERROR_RATE = 0.01
+  BLOOM_MEMORY_BUDGET = 4 * 1024 * 1024
+  bloom_filters = IndexCache(
+      MISSING_MANIFEST_RECHECK, max_bytes=BLOOM_MEMORY_BUDGET,
+      sizeof=BloomFilter.memory_usage, max_missing=MISSING_MANIFEST_ENTRIES,
+      error_ttl=timedelta(seconds=LOOKUP_RETRY_INTERVAL))
+
+  # What this instance knows about the pages of versions without a manifest,
+  # kept in front of memcache. Missing pages (None, "0" in memcache) are kept
+  # for much less time, as a version may still be being uploaded. The limits
+  # can be set per deployment with env_variables in app.yaml.
+  DOC_INFO_TTL = ONE_DAY
+  DOC_INFO_MISSING_TTL = 5 * 60
+  doc_infos = LRUCache(
+      max_entries=int(os.environ.get('DOC_INFO_CACHE_ENTRIES', 50000)),
+      max_bytes=int(os.environ.get('DOC_INFO_CACHE_BYTES', 8 * 1024 * 1024)),
+      sizeof=doc_info_size)
+  # Lookups of pages missing from doc_infos that are in flight on this
+  # instance, so concurrent requests for a page share one lookup.
+  doc_lookups = CallGroup()
+
+  # Bodies of pages of up to CONTENT_CACHE_MAX_SIZE bytes, keyed by their
+  # Google Storage path and etag, sent from memory instead of by the storage
+  # backend. Setting CONTENT_CACHE_BYTES to 0 in app.yaml turns the cache off.
+  CONTENT_CACHE_MAX_SIZE = 64 * 1024
+  contents = LRUCache(
+      max_bytes=int(os.environ.get('CONTENT_CACHE_BYTES', 16 * 1024 * 1024)),
+      sizeof=lambda key, body: 100 + len(key[0]) + len(body))
+  content_loads = CallGroup()
+
+  # The publisher may store compressed copies of text pages next to them,
+  # named after the page with the extension of the content coding. They are
+  # only used once the manifest of the version lists them. Of those the
+  # client accepts equally, the first in ENCODING_PREFERENCE is sent.
+  COMPRESSIBLE_EXTENSIONS = ('.html', '.css', '.js', '.json', '.svg', '.txt',
+                             '.xml')
+  COMPRESSED_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+  ENCODING_PREFERENCE = ('br', 'gzip')
+
+  # Multiple ranges of a page are sent as one multipart response read by the
+  # handler, so only that many ranges and bytes are served that way. Bigger
+  # requests get the whole page.
+  MAX_RANGES = 16
+  MULTIPART_MAX_SIZE = 1024 * 1024
+
+  # How long caches may keep serving a page while this server fails, and
+  # how long the last known good lookup of a page is kept in memcache to
+  # serve it while Google Storage fails.
+  STALE_IF_ERROR = ONE_DAY
+  LAST_KNOWN_GOOD_TTL = ONE_WEEK
+  # When a new version is published every instance gets the same requests at
+  # once. The first instance to look a page up takes a lease on it in
+  # memcache and leaves its finding there. The others poll for it for up to
+  # PROBE_LEASE_WAIT seconds before probing Google Storage themselves.
+  PROBE_LEASE_TIME = 10
+  PROBE_LEASE_WAIT = 1.0
+  PROBE_LEASE_POLL = 0.05
+  probe_lease_stats = {'taken': 0, 'shared': 0, 'gave_up': 0}
+  # Once the version of a channel is out of date, only the instance holding
+  # the refresh lease of the channel rereads it; the others keep serving the
+  # version they know until the new one is shared. The lease outlives
+  # SHARED_CHECK_INTERVAL so that it is not taken again before every instance
+  # has seen the new version.
+  REFRESH_LEASE_TIME = 30
+
   def recheck_latest_version(self, channel):
     """Check Google storage to determine the latest version file in a given
     channel."""
     data = None
     version_file_location = self.version_file_loc(channel)
-    with cloudstorage.open(version_file_location, 'r') as f:
+    with ApiDocs.storage.open(version_file_location) as f:
       line = f.readline()
       data = line.replace('\x00', '')
     revision = data
+    self.set_latest_version(channel, revision)
+    return revision
+
+  @ndb.tasklet
+  def fetch_latest_version_async(self, channel):
+    """Read the latest version file of the channel in a single GET, without
+    blocking, so that several channels can be fetched at the same time."""
+    content = yield ApiDocs.storage.read_async(self.version_file_loc(channel))
+    newline = content.find('\n')
+    if newline != -1:
+      content = content[:newline + 1]
+    raise ndb.Return(content.replace('\x00', ''))
+
+  def set_latest_version(self, channel, revision):
     ApiDocs.latest_versions[channel].version = revision
     ApiDocs.latest_versions[channel].last_check = datetime.now()
-    return revision
+    self.publish_latest_version(channel)
+
+  def shared_version_key(self, channel):
+    return 'latest_version:' + channel
+
+  def publish_latest_version(self, channel):
+    """Share the version of the channel we just read from Google Storage with
+    all other instances through memcache, under a new generation number."""
+    version_info = ApiDocs.latest_versions[channel]
+    generation = memcache.incr('latest_version_generation', initial_value=0)
+    if generation is None:
+      logging.warning('Could not publish the latest %s version' % channel)
+      return
+    version_info.generation = generation
+    memcache.set(self.shared_version_key(channel), {
+      'version': version_info.version,
+      'generation': generation,
+      'checked': version_info.last_check,
+    })
+
+  def check_shared_version(self, channel):
+    """Pick up the version of the channel another instance published, if it is
+    newer than ours. Its check time comes along, so Google Storage is only
+    polled again once the shared version itself is out of date."""
+    version_info = ApiDocs.latest_versions[channel]
+    version_info.last_shared_check = datetime.now()
+    shared = memcache.get(self.shared_version_key(channel))
+    if shared and shared['generation'] != version_info.generation:
+      version_info.version = shared['version']
+      version_info.last_check = shared['checked']
+      version_info.generation = shared['generation']
+
+  def take_refresh_lease(self, channel):
+    """Take the refresh lease of the channel. False if another instance holds
+    it; if memcache can't be reached at all, every instance refreshes for
+    itself."""
+    lease_key = 'latest_version_lease:' + channel
+    if memcache.add(key=lease_key, value='',
+                    time=ApiDocs.REFRESH_LEASE_TIME):
+      return True
+    return memcache.get(lease_key) is None
 
   def get_latest_version(self, channel):
     """Determine what the latest version number is for this particular channel.
@@ -71,10 +455,45 @@ class ApiDocs(blobstore_handlers.BlobstoreDownloadHandler):
     version of stable, for example."""
     forced_reload = (self.request and self.request.get('force_reload'))
     version_info = ApiDocs.latest_versions[channel]
-    if (forced_reload or
-        version_info.version is None or version_info.should_update()):
+    if not forced_reload and version_info.should_check_shared():
+      self.check_shared_version(channel)
+    if forced_reload or version_info.version is None:
+      # There is nothing to serve in the meantime, so wait for the request
+      # that is already refreshing, if any.
+      with version_info.refresh_lock:
+        if forced_reload or version_info.version is None:
+          return self.refresh_latest_version(channel)
+    elif (version_info.should_update() and
+          version_info.refresh_lock.acquire(False)):
+      # Exactly one request of one instance refreshes the version; concurrent
+      # requests keep serving the version we already know about until it is
+      # done.
+      try:
+        if version_info.should_update():
+          if self.take_refresh_lease(channel):
+            return self.refresh_latest_version(channel)
+          version_info.deferred += 1
+          version_info.retry_later(VersionInfo.SHARED_CHECK_INTERVAL)
+      finally:
+        version_info.refresh_lock.release()
+    version_info.hits += 1
+    return version_info.version
+
+  def refresh_latest_version(self, channel):
+    """Recheck the latest version of the channel, falling back to the version
+    we already know about if Google Storage can't be read. Callers must hold
+    the refresh_lock of the channel."""
+    version_info = ApiDocs.latest_versions[channel]
+    version_info.misses += 1
+    try:
       return self.recheck_latest_version(channel)
-    else:
+    except Exception:
+      version_info.errors += 1
+      if version_info.version is None:
+        raise
+      logging.exception('Could not refresh the latest %s version, still '
+                        'serving %s' % (channel, version_info.version))
+      version_info.retry_later()
       return version_info.version
 
   def get_cache_age(self, path):
@@ -86,8 +505,36 @@ class ApiDocs(blobstore_handlers.BlobstoreDownloadHandler):
       age = ONE_HOUR
     return age
 
+  def send_not_found(self, path):
+    """Send a 404. A version may still be being uploaded, so unlike its pages
+    a missing page is only cached for the age its file type gets."""
+    self.response.headers['Cache-Control'] = cache_control(
+        self.get_cache_age(path))
+    self.error(404)
+
+  def send_unavailable(self):
+    """Send a 503 telling the client when to try again. It must not be cached
+    in place of the page."""
+    self.response.headers['Cache-Control'] = 'no-store'
+    self.response.headers['Retry-After'] = str(ApiDocs.LOOKUP_RETRY_INTERVAL)
+    self.error(503)
+
+  def get_cache_control(self, path, version_num):
+    """Pages of a fully specified version never change, so they can be cached
+    for good. Anything else falls back to an age based on the file type."""
+    if IMMUTABLE_VERSION.match(version_num):
+      return cache_control(ONE_YEAR, immutable=True,
+                           stale_if_error=ApiDocs.STALE_IF_ERROR)
+    return cache_control(self.get_cache_age(path),
+                         stale_if_error=ApiDocs.STALE_IF_ERROR)
+
   def build_gcs_path(self, version_num, postfix, channel):
     """Build the path to the information on Google Storage."""
+    return '%s/%s' % (self.build_gcs_root(version_num, channel), postfix)
+
+  def build_gcs_root(self, version_num, channel):
+    """Build the path to the directory on Google Storage holding all the docs
+    for a version."""
     suffix = channel
     # Support for bleeding edge versions before git hashes (October 26, 2022).
     if channel == 'be' and version_num.isdigit() and len(version_num) != 40:
@@ -97,14 +544,17 @@ class ApiDocs(blobstore_handlers.BlobstoreDownloadHandler):
       nums = version_num.split('.')
       release_num = nums[1]
       if nums[0] == '1' and int(release_num) < 15:
-        return '%s/%s/%s' % (ApiDocs.GOOGLE_STORAGE_NEW, version_num, postfix)
-    return '%s/%s/%s/%s' % (ApiDocs.GOOGLE_STORAGE_NEW, suffix, version_num, postfix)
+        return '%s/%s' % (ApiDocs.GOOGLE_STORAGE_NEW, version_num)
+    return '%s/%s/%s' % (ApiDocs.GOOGLE_STORAGE_NEW, suffix, version_num)
 
   def resolve_doc_path(self, channel):
     """Given the request URL, determine what specific docs version we should
     actually display."""
-    path = None
+    return '%s/%s' % self.resolve_doc_location(channel)
 
+  def resolve_doc_location(self, channel):
+    """Given the request URL, determine the Google Storage directory of the
+    docs version we should display and the path of the page within it."""
     if channel:
       length = len(channel) + 2
     else:
@@ -123,10 +573,389 @@ class ApiDocs(blobstore_handlers.BlobstoreDownloadHandler):
         channel = 'stable'
         version_num = self.get_latest_version(channel)
       postfix = 'index.html'
-    path = self.build_gcs_path(version_num, postfix, channel)
-    logging.debug('build_gcs_path("%s", "%s", "%s") -> "%s"'
-                  % (version_num, postfix, channel, path))
-    return path
+    root = self.build_gcs_root(version_num, channel)
+    logging.debug('build_gcs_root("%s", "%s") -> "%s", postfix "%s"'
+                  % (version_num, channel, root, postfix))
+    return root, postfix
+
+  def get_manifest(self, root):
+    """Return the Manifest of the docs version stored below root, loading it
+    from Google Storage the first time it is needed. Returns None if the
+    version has no manifest."""
+    try:
+      return ApiDocs.manifests.get(root, self.load_manifest)
+    except Exception:
+      logging.exception('Could not load the manifest for ' + root)
+      return None
+
+  def load_manifest(self, root):
+    try:
+      with ApiDocs.storage.open(self.manifest_loc(root)) as f:
+        return Manifest.load(f)
+    except cloudstorage.NotFoundError:
+      return None
+
+  def get_bloom_filter(self, root):
+    """Return the BloomFilter of the paths of the docs version stored below
+    root, or None if the version has none."""
+    try:
+      return ApiDocs.bloom_filters.get(root, self.load_bloom_filter)
+    except Exception:
+      logging.exception('Could not load the Bloom filter for ' + root)
+      return None
+
+  def load_bloom_filter(self, root):
+    """Load the Bloom filter from memcache, where the first instance to need
+    it leaves a copy, or else from Google Storage."""
+    key = 'bloom:' + root
+    data = memcache.get(key)
+    if data is None:
+      try:
+        with ApiDocs.storage.open(self.manifest_loc(root, 'bloom')) as f:
+          data = f.read()
+      except cloudstorage.NotFoundError:
+        return None
+      memcache.add(key=key, value=data, time=ONE_DAY)
+    return BloomFilter.loads(data)
+
+  @classmethod
+  def bloom_memory_usage(cls):
+    """Bytes this instance spends on Bloom filters."""
+    return cls.bloom_filters.memory_usage()
+
+  @classmethod
+  def forget_manifest(cls, root):
+    """Drop the cached manifest and Bloom filter of the docs version stored
+    below root."""
+    cls.manifests.forget(root)
+    cls.bloom_filters.forget(root)
+    memcache.delete('bloom:' + root)
+
+  def probe_doc(self, path):
+    """Fetch the metadata for the object at the given Google Storage path, with
+    a single HEAD request when the docs are on Google Storage. Raises
+    cloudstorage.NotFoundError if the object does not exist."""
+    return ApiDocs.storage.stat(path)
+
+  def may_have_index(self, root):
+    """Only published versions, which never change, have indexes. Anything
+    else that looks like a version is not worth reading indexes for."""
+    return IMMUTABLE_VERSION.match(root.rsplit('/', 1)[1]) is not None
+
+  def find_doc(self, root, postfix):
+    """Look up the page at postfix in the docs version stored below root.
+    Returns its DocInfo, or None if there is no such page."""
+    indexed = self.may_have_index(root)
+
+    # Paths that are definitely not part of the version, which is what
+    # crawlers mostly ask for, are turned away without any round-trip.
+    bloom_filter = self.get_bloom_filter(root) if indexed else None
+    if bloom_filter is not None and postfix not in bloom_filter:
+      logging.debug('No ' + postfix + ' in the Bloom filter for ' + root +
+                    ', sending 404')
+      return None
+
+    # Published versions never change, so when the version has a manifest it
+    # answers the existence check without a round-trip to memcache or GCS.
+    manifest = self.get_manifest(root) if indexed else None
+    if manifest is not None:
+      entry = manifest.lookup(postfix)
+      if entry is None:
+        logging.debug('No ' + postfix + ' in the manifest for ' + root +
+                      ', sending 404')
+        return None
+      return DocInfo(*entry)
+
+    # is there a better way to check if a file exists in cloud storage?
+    # AE will serve a 500 if the file doesn't exist, but that should
+    # be a 404
+    my_path = '%s/%s' % (root, postfix)
+    gcs_path = '/gs%s' % my_path
+    # False, unlike None, means the page is not in the cache at all.
+    info = ApiDocs.doc_infos.get(gcs_path, False)
+    if info is not False:
+      return info
+    return ApiDocs.doc_lookups.do(
+        gcs_path, lambda: self.lookup_doc(my_path, gcs_path))
+
+  def lookup_doc(self, path, gcs_path):
+    """Find the DocInfo of the object at the given Google Storage path in
+    memcache, or else probe for it. The result is cached in doc_infos, and
+    in memcache for all instances: a missing page as "0", for
+    DOC_INFO_MISSING_TTL only.
+
+    Only a NotFoundError makes a page missing. When the probe fails in any
+    other way the last known good DocInfo of the page is returned instead,
+    and the error is raised if there is none."""
+    cached = memcache.get(gcs_path)
+    if cached == '0':
+      ApiDocs.doc_infos.set(gcs_path, None, ApiDocs.DOC_INFO_MISSING_TTL)
+      return None
+    if cached is not None and cached.startswith('1'):
+      info = DocInfo.loads(cached)
+      ApiDocs.doc_infos.set(gcs_path, info, ApiDocs.DOC_INFO_TTL)
+      return info
+    try:
+      info = self.probe_doc_shared(path, gcs_path)
+    except Exception:
+      info = self.last_known_good_doc(gcs_path)
+      if info is None:
+        raise
+      logging.exception('Could not look up ' + gcs_path +
+                        ', using the last known good lookup')
+      ApiDocs.doc_infos.set(gcs_path, info, ApiDocs.LOOKUP_RETRY_INTERVAL)
+      return info
+    if info is None:
+      memcache.set(key=gcs_path, value='0',
+                   time=ApiDocs.DOC_INFO_MISSING_TTL)
+      ApiDocs.doc_infos.set(gcs_path, None, ApiDocs.DOC_INFO_MISSING_TTL)
+      logging.debug('Could not open ' + gcs_path + ', sending 404')
+      return None
+    value = info.dumps()
+    memcache.set(key=gcs_path, value=value, time=ONE_DAY)
+    memcache.set(key='lkg:' + gcs_path, value=value,
+                 time=ApiDocs.LAST_KNOWN_GOOD_TTL)
+    ApiDocs.doc_infos.set(gcs_path, info, ApiDocs.DOC_INFO_TTL)
+    return info
+
+  def last_known_good_doc(self, gcs_path):
+    """The DocInfo last found for the object at the given Google Storage path
+    by this instance, even if it has expired, or else by any instance within
+    LAST_KNOWN_GOOD_TTL. None if there is none."""
+    info = ApiDocs.doc_infos.get_stale(gcs_path)
+    if info is not None:
+      return info
+    cached = memcache.get('lkg:' + gcs_path)
+    if cached is not None:
+      return DocInfo.loads(cached)
+    return None
+
+  def probe_doc_shared(self, path, gcs_path):
+    """Probe for the object at path, or wait for the instance holding the
+    lease on it to do so. Returns its DocInfo, or None if it does not exist.
+    The lease holds '' while the probe runs and then the finding of the
+    probe: a serialized DocInfo, or '0'."""
+    lease_key = 'lease:' + gcs_path
+    if not memcache.add(key=lease_key, value='',
+                        time=ApiDocs.PROBE_LEASE_TIME):
+      deadline = time.time() + ApiDocs.PROBE_LEASE_WAIT
+      while time.time() < deadline:
+        time.sleep(ApiDocs.PROBE_LEASE_POLL)
+        finding = memcache.get(lease_key)
+        if finding is None:
+          break
+        if finding:
+          ApiDocs.probe_lease_stats['shared'] += 1
+          return DocInfo.loads(finding) if finding.startswith('1') else None
+      ApiDocs.probe_lease_stats['gave_up'] += 1
+    else:
+      ApiDocs.probe_lease_stats['taken'] += 1
+    try:
+      info = DocInfo.from_stat(self.probe_doc(path))
+    except cloudstorage.NotFoundError:
+      info = None
+    except Exception:
+      # Nothing was found out, let the others stop waiting and try for
+      # themselves.
+      memcache.delete(lease_key)
+      raise
+    memcache.set(key=lease_key, value=info.dumps() if info else '0',
+                 time=ApiDocs.PROBE_LEASE_TIME)
+    return info
+
+  def send_doc(self, gcs_path, info, content_type=None):
+    """Send the page with the validators from info, or just a 304 if the
+    copy the client already has is still current. Small pages are sent from
+    the content cache, anything else by the storage backend, as are pages
+    whose content type is not known. content_type overrides the content type
+    of the object."""
+    if info.etag:
+      self.response.headers['ETag'] = '"%s"' % info.etag
+    if info.mtime:
+      self.response.headers['Last-Modified'] = common.posix_time_to_http(
+          int(info.mtime))
+    if self.is_not_modified(info):
+      self.response.set_status(304)
+      return
+    path = gcs_path[len('/gs'):]
+    if info.size is None:
+      # Without the size any Range cannot be checked, so it is ignored.
+      ApiDocs.storage.serve(self, path, content_type)
+      return
+
+    self.response.headers['Accept-Ranges'] = 'bytes'
+    ranges = self.get_ranges(info)
+    if ranges == []:
+      # Shared caches key on the URL alone, so this must not be stored.
+      self.response.headers['Cache-Control'] = 'no-store'
+      self.response.headers['Content-Range'] = 'bytes */%d' % info.size
+      self.error(416)
+      return
+    if ranges is not None and len(ranges) > 1:
+      if (len(ranges) > ApiDocs.MAX_RANGES or
+          sum(end - start + 1 for start, end in ranges) >
+          ApiDocs.MULTIPART_MAX_SIZE):
+        # Too much work for a response the client can do without.
+        ranges = None
+
+    content_type = content_type or info.content_type
+    if content_type is None:
+      # Only the backend can tell what the page is, so it sends it, whole or
+      # in one range.
+      if ranges is not None and len(ranges) > 1:
+        ranges = None
+      if ranges is None:
+        ApiDocs.storage.serve(self, path)
+      else:
+        start, end = ranges[0]
+        ApiDocs.storage.serve(self, path, None, start, end)
+      return
+
+    body = self.get_content(path, info)
+    if body is None and ranges is not None and len(ranges) == 1:
+      start, end = ranges[0]
+      ApiDocs.storage.serve(self, path, content_type, start, end)
+      return
+    if body is None and ranges is None:
+      ApiDocs.storage.serve(self, path, content_type)
+      return
+
+    if ranges is None:
+      self.response.headers['Content-Type'] = content_type
+      self.response.write(body)
+    elif len(ranges) == 1:
+      start, end = ranges[0]
+      self.response.set_status(206)
+      self.response.headers['Content-Type'] = content_type
+      self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+          start, end, info.size)
+      self.response.write(body[start:end + 1])
+    else:
+      self.send_multipart(path, body, ranges, info.size, content_type)
+
+  def get_ranges(self, info):
+    """The ranges of the page of the given DocInfo the request asks for, as
+    parse_byte_ranges returns them. None means the whole page, either because
+    no Range was asked for or because it has to be ignored."""
+    range_header = self.request.headers.get('Range')
+    if range_header is None:
+      return None
+    # If-Range asks for the parts only if the page has not changed.
+    if_range = self.request.headers.get('If-Range')
+    if if_range is not None:
+      if if_range.startswith('"') or if_range.startswith('W/'):
+        if not info.etag or if_range != '"%s"' % info.etag:
+          return None
+      else:
+        try:
+          since = common.http_time_to_posix(if_range)
+        except (TypeError, ValueError, OverflowError):
+          return None
+        if not info.mtime or int(info.mtime) != since:
+          return None
+    return parse_byte_ranges(range_header, info.size)
+
+  def send_multipart(self, path, body, ranges, size, content_type):
+    """Send the ranges of the page at the given Google Storage path as a
+    multipart/byteranges response. The ranges are cut from body when the page
+    is in the content cache, or else each read with its own ranged read, all
+    at the same time."""
+    if body is not None:
+      parts = [body[start:end + 1] for start, end in ranges]
+    else:
+      futures = [ApiDocs.storage.read_range_async(path, start, end)
+                 for start, end in ranges]
+      parts = [future.get_result() for future in futures]
+
+    boundary = uuid.uuid4().hex
+    self.response.set_status(206)
+    self.response.headers['Content-Type'] = (
+        'multipart/byteranges; boundary=%s' % boundary)
+    for (start, end), part in zip(ranges, parts):
+      self.response.write('--%s\r\nContent-Type: %s\r\n'
+                          'Content-Range: bytes %d-%d/%d\r\n\r\n'
+                          % (boundary, content_type, start, end, size))
+      self.response.write(part)
+      self.response.write('\r\n')
+    self.response.write('--%s--\r\n' % boundary)
+
+  def find_compressed_doc(self, root, postfix):
+    """Find the best compressed copy of the page at postfix the client
+    accepts. Returns the content coding and the DocInfo of the copy, or
+    (None, None) to send the page as it is.
+
+    Only copies listed in the manifest of the version are used. Looking for
+    them in Google Storage would cost a probe per page and content coding,
+    for copies that most versions do not have."""
+    # Parts of a page are taken from the page itself.
+    if 'Range' in self.request.headers or not self.may_have_index(root):
+      return None, None
+    manifest = self.get_manifest(root)
+    if manifest is None:
+      return None, None
+    quality = encoding_qualities(self.request.headers.get('Accept-Encoding'))
+    encodings = [encoding for encoding in ApiDocs.ENCODING_PREFERENCE
+                 if quality(encoding) > 0]
+    encodings.sort(key=quality, reverse=True)
+    for encoding in encodings:
+      entry = manifest.lookup(postfix + ApiDocs.COMPRESSED_EXTENSIONS[encoding])
+      if entry is not None:
+        return encoding, DocInfo(*entry)
+    return None, None
+
+  def get_content(self, path, info):
+    """Return the body of the page at the given Google Storage path from the
+    content cache, reading it into the cache on a miss. Returns None if the
+    page is not one the cache keeps."""
+    if (not ApiDocs.contents.max_bytes or not info.etag or
+        info.size is None or info.size > ApiDocs.CONTENT_CACHE_MAX_SIZE):
+      return None
+    key = (path, info.etag)
+    body = ApiDocs.contents.get(key)
+    if body is None:
+      try:
+        body = ApiDocs.content_loads.do(
+            key, lambda: self.load_content(key, info.size))
+      except Exception:
+        logging.exception('Could not read ' + path + ', sending the blob')
+        return None
+    return body
+
+  def load_content(self, key, size):
+    path, etag = key
+    with ApiDocs.storage.open(path) as f:
+      body = f.read()
+    # The page was replaced since info was taken. Leave it to the backend.
+    if len(body) != size:
+      return None
+    ApiDocs.contents.set(key, body, ONE_DAY)
+    return body
+
+  def is_not_modified(self, info):
+    """Whether the conditional headers of the request show the client has
+    the current version of the page. As in RFC 7232, If-Modified-Since is
+    only looked at when there is no If-None-Match."""
+    if_none_match = self.request.headers.get('If-None-Match')
+    if if_none_match is not None:
+      if not info.etag:
+        return False
+      etag = '"%s"' % info.etag
+      for tag in if_none_match.split(','):
+        tag = tag.strip()
+        # The weak comparison RFC 7232 asks for with If-None-Match.
+        if tag.startswith('W/'):
+          tag = tag[2:]
+        if tag == '*' or tag == etag:
+          return True
+      return False
+    if_modified_since = self.request.headers.get('If-Modified-Since')
+    if if_modified_since and info.mtime:
+      try:
+        since = common.http_time_to_posix(if_modified_since)
+      except (TypeError, ValueError, OverflowError):
+        return False
+      return int(info.mtime) <= since
+    return False
 
   def get_channel(self):
     """Quick accessor to examine a request and determine what channel
@@ -142,18 +971,9 @@ class ApiDocs(blobstore_handlers.BlobstoreDownloadHandler):
         return channel
     return None
 
-  def get(self, *args, **kwargs):
-    """The main entry point for handling the URL for those with ApiDocs as the
-    handler. See http://webapp-improved.appspot.com/api/webapp2.html?highlight=
-    redirecthandler#webapp2.RedirectHandler.get.
-
-    Arguments:
-    - args: Positional arguments passed to this URL handler
-    - kwargs: Dictionary arguments passed to the hander; expecting at least one
-      item in the dictionary with a key of 'path', which was populated from the
-      regular expression matching in Route."""
-    channel = self.get_channel()
-
+  def get_redirect(self, channel):
+    """Return the URI the request should be redirected to, or None if it is
+    for a page of a specific docs version that should be served."""
     # this is serving all paths, so check to make sure version is valid pattern
     # else redirect to stable
     # /dev/1.15.0-dev.5.1/index.html
@@ -171,56 +991,189 @@ class ApiDocs(blobstore_handlers.BlobstoreDownloadHandler):
         if len(version_num) == 40 or int(version_num) > 136051:
           path = request[index+1:]
           if not channel:
-            return self.redirect('/main/%s/%s' % (version_num, path))
+            return '/main/%s/%s' % (version_num, path)
         else:
-          return self.redirect('/stable')
+          return '/stable'
       else:
         match = re.match(r'(\d+\.){2}\d+([\+-]([\.a-zA-Z0-9-\+])*)?', version_num)
         latest = self.get_latest_version(channel or 'stable')
         if match:
           if not channel:
-            return self.redirect('/stable/%s/index.html' % latest)
+            return '/stable/%s/index.html' % latest
         else:
-          return self.redirect('/%s/%s/%s' % (channel or 'stable', latest, request))
+          return '/%s/%s/%s' % (channel or 'stable', latest, request)
     else:
       match = re.match(r'(\d+\.){2}\d+([\+-]([\.a-zA-Z0-9-\+])*)?', request)
       if match:
-        return self.redirect('/%s/index.html' % request)
+        return '/%s/index.html' % request
       else:
-        return self.redirect('/stable')
+        return '/stable'
+    return None
+
+  def get(self, *args, **kwargs):
+    """The main entry point for handling the URL for those with ApiDocs as the
+    handler. See http://webapp-improved.appspot.com/api/webapp2.html?highlight=
+    redirecthandler#webapp2.RedirectHandler.get.
+
+    Arguments:
+    - args: Positional arguments passed to this URL handler
+    - kwargs: Dictionary arguments passed to the hander; expecting at least one
+      item in the dictionary with a key of 'path', which was populated from the
+      regular expression matching in Route."""
+    channel = self.get_channel()
 
-    my_path = self.resolve_doc_path(channel)
+    redirect_uri = self.get_redirect(channel)
+    if redirect_uri is not None:
+      uri, temporary = follow_redirects(redirect_uri)
+      set_redirect_cache_control(self, uri)
+      return self.redirect(uri)
+
+    root, postfix = self.resolve_doc_location(channel)
+    my_path = '%s/%s' % (root, postfix)
 
     gcs_path = '/gs%s' % my_path
     if not gcs_path:
       self.error(404)
       return
 
-    gs_key = blobstore.create_gs_key(gcs_path)
-    age = self.get_cache_age(gcs_path)
-
-    self.response.headers['Cache-Control'] = 'max-age=' + \
-       str(age) + ',s-maxage=' + str(age)
+    # ['', '<channel>', '<version>', ...]
+    version_num = self.request.path.split('/')[2]
+    self.response.headers['Cache-Control'] = self.get_cache_control(
+        gcs_path, version_num)
 
     self.response.headers['Access-Control-Allow-Origin'] = '*'
 
-    # is there a better way to check if a file exists in cloud storage?
-    # AE will serve a 500 if the file doesn't exist, but that should
-    # be a 404
+    try:
+      info = self.find_doc(root, postfix)
+    except Exception:
+      logging.exception('Could not look up ' + gcs_path + ', sending 503')
+      self.send_unavailable()
+      return
+    if info is None:
+      self.send_not_found(gcs_path)
+      return
 
-    path_exists = memcache.get(gcs_path)
-    if path_exists == "1":
-        self.send_blob(gs_key)
-    else:
+    content_type = None
+    if postfix.endswith(ApiDocs.COMPRESSIBLE_EXTENSIONS):
+      self.response.headers['Vary'] = 'Accept-Encoding'
+      encoding, compressed = self.find_compressed_doc(root, postfix)
+      if compressed is not None:
+        content_type = (info.content_type or
+                        mimetypes.guess_type(postfix)[0] or
+                        'application/octet-stream')
+        self.response.headers['Content-Encoding'] = encoding
+        gcs_path += ApiDocs.COMPRESSED_EXTENSIONS[encoding]
+        info = compressed
+    self.send_doc(gcs_path, info, content_type)
+
+class BuildManifest(RequestHandler):
+  """Builds the manifest and Bloom filter of a published docs version from the
+  bucket listing and stores them in Google Storage, where ApiDocs picks them
+  up. Only admins can reach this handler, see app.yaml."""
+
+  def post(self, channel, version):
+    apidocs = ApiDocs()
+    root = apidocs.build_gcs_root(version, channel)
+    manifest = Manifest.build(root, ApiDocs.storage)
+    if not len(manifest):
+      self.abort(404)
+    with ApiDocs.storage.open(apidocs.manifest_loc(root), 'w',
+                              content_type='text/plain') as f:
+      manifest.dump(f)
+    bloom_filter = BloomFilter.for_capacity(len(manifest),
+                                            ApiDocs.BLOOM_ERROR_RATE)
+    for path in manifest.paths:
+      bloom_filter.add(path)
+    with ApiDocs.storage.open(apidocs.manifest_loc(root, 'bloom'), 'w',
+                              content_type='application/octet-stream') as f:
+      f.write(bloom_filter.dumps())
+    ApiDocs.forget_manifest(root)
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write('%d paths in %s\n' % (len(manifest), root))
+
+class RefreshVersions(RequestHandler):
+  """Rereads the latest version of the channels from Google Storage and
+  publishes them to all instances. The docs publisher calls this after an
+  upload, passing the secret stored in RefreshToken as a bearer token.
+
+  POST /_refresh[?channel=<channel>...]"""
+
+  def post(self):
+    if not self.is_authorized():
+      self.abort(403)
+    channels = self.request.get_all('channel') or ApiDocs.latest_versions.keys()
+    apidocs = ApiDocs()
+    versions = {}
+    for channel in channels:
+      if channel not in ApiDocs.latest_versions:
+        self.abort(400, 'Unknown channel %s' % channel)
+      with ApiDocs.latest_versions[channel].refresh_lock:
+        versions[channel] = apidocs.recheck_latest_version(channel)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(versions, sort_keys=True))
+
+  def is_authorized(self):
+    if users.is_current_user_admin():
+      return True
+    authorization = self.request.headers.get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+      return False
+    secret = RefreshToken.get_by_id('refresh')
+    if secret is None or not secret.token:
+      return False
+    return hmac.compare_digest(str(secret.token),
+                               authorization[len('Bearer '):])
+
+class Warmup(RequestHandler):
+  """Handles the warmup request App Engine sends to a new instance before it
+  receives traffic, so that no user request has to wait for the latest
+  version of a channel."""
+
+  def get(self):
+    start = time.time()
+    apidocs = ApiDocs()
+    for channel in ApiDocs.latest_versions:
+      apidocs.check_shared_version(channel)
+    missing = [channel for channel, info in ApiDocs.latest_versions.iteritems()
+               if info.version is None]
+    futures = [apidocs.fetch_latest_version_async(channel)
+               for channel in missing]
+    for channel, future in zip(missing, futures):
+      version_info = ApiDocs.latest_versions[channel]
       try:
-        # just check for existence
-        cloudstorage.open(my_path, 'r').close()
-        memcache.add(key=gcs_path, value="1", time=ONE_DAY)
-        self.send_blob(gs_key)
+        revision = future.get_result()
       except Exception:
-        memcache.add(key=gcs_path, value="0", time=ONE_DAY)
-        logging.debug('Could not open ' + gcs_path + ', sending 404')
-        self.error(404)
+        logging.exception('Could not read the latest %s version' % channel)
+        continue
+      with version_info.refresh_lock:
+        apidocs.set_latest_version(channel, revision)
+    elapsed = time.time() - start
+    logging.info('Warmed up in %.3fs, read %s from Google Storage'
+                 % (elapsed, ', '.join(missing) or 'nothing'))
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write('Warmed up in %.3fs\n' % elapsed)
+
+class Stats(RequestHandler):
+  """Reports the caching counters of this instance as JSON. Only admins can
+  reach this handler, see app.yaml."""
+
+  def get(self):
+    stats = {
+      'latest_versions': dict((channel, info.stats()) for channel, info
+                              in ApiDocs.latest_versions.iteritems()),
+      'manifests': len(ApiDocs.manifests),
+      'manifest_memory_usage': ApiDocs.manifests.memory_usage(),
+      'missing_manifests': ApiDocs.manifests.missing_count(),
+      'bloom_filters': len(ApiDocs.bloom_filters),
+      'missing_bloom_filters': ApiDocs.bloom_filters.missing_count(),
+      'bloom_memory_usage': ApiDocs.bloom_memory_usage(),
+      'doc_infos': ApiDocs.doc_infos.stats(),
+      'doc_lookups': ApiDocs.doc_lookups.stats(),
+      'contents': ApiDocs.contents.stats(),
+      'probe_leases': ApiDocs.probe_lease_stats,
+    }
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(stats, indent=2, sort_keys=True))
 
 def redir_dom(handler, *args, **kwargs):
   return '/stable/dart-html/index.html'
@@ -346,13 +1299,160 @@ def redir_legacy_lib_class(handler, *args, **kwargs):
 def redir_apidartdev(handler, *args, **kwargs):
     return 'https://api.dart.dev/%s' % (kwargs['path'])
 
-application = WSGIApplication(
+def redirect_target(uri):
+  """Return the next hop if this application answers uri with a redirect, as
+  a tuple of the URI and whether the redirect is temporary. Returns None if
+  uri is served, if it is on another host or if it can't be resolved."""
+  scheme, netloc, path, query, fragment = urlparse.urlsplit(uri)
+  if netloc and netloc not in OWN_HOSTS:
+    return None
+  request = Request.blank(urlparse.urlunsplit(('', '', path, query, '')))
+  try:
+    route, args, kwargs = application.router.match(request)
+    if route.handler is ApiDocs:
+      apidocs = ApiDocs(request)
+      target = apidocs.get_redirect(apidocs.get_channel())
+      # ApiDocs always redirects temporarily.
+      temporary = True
+    elif issubclass(route.handler, RedirectHandler):
+      target = kwargs.pop('_uri', '/')
+      temporary = not kwargs.pop('_permanent', True)
+      code = kwargs.pop('_code', None)
+      temporary = temporary or (code is not None and code != 301)
+      func = getattr(target, '__call__', None)
+      if func:
+        target = func(route.handler(request), *args, **kwargs)
+    else:
+      return None
+  except exc.HTTPException:
+    return None
+  except Exception:
+    logging.exception('Could not resolve the redirect for ' + uri)
+    return None
+  if target is None:
+    return None
+  if netloc and not urlparse.urlsplit(target).netloc:
+    target = urlparse.urlunsplit((scheme, netloc, target, '', ''))
+  return target, temporary
+
+def set_redirect_cache_control(handler, target):
+  """If the redirect to target resolved a channel alias to the latest version
+  of the channel, let it be cached until we check for a newer version, but no
+  longer than MAX_REDIRECT_CACHE_AGE."""
+  parts = urlparse.urlsplit(target).path.split('/')
+  # ['', '<channel>', '<version>', ...]
+  if len(parts) < 3 or parts[1] not in ApiDocs.latest_versions:
+    return
+  channel, version = parts[1], parts[2]
+  version_info = ApiDocs.latest_versions[channel]
+  if (version == version_info.version and
+      version not in handler.request.path.split('/')):
+    age = min(version_info.seconds_left(), MAX_REDIRECT_CACHE_AGE)
+    handler.response.headers['Cache-Control'] = cache_control(age)
+
+def follow_redirects(uri):
+  """Follow the redirects this application issues, starting at uri, and return
+  the final destination together with whether any hop was temporary."""
+  temporary = False
+  for _ in xrange(MAX_REDIRECT_HOPS):
+    hop = redirect_target(uri)
+    if hop is None or hop[0] == uri:
+      break
+    uri, hop_temporary = hop
+    temporary = temporary or hop_temporary
+  return uri, temporary
+
+class ChainedRedirectHandler(RedirectHandler):
+  """RedirectHandler that sends the client to the end of the redirect chain,
+  instead of to a URL that this application would redirect again. The redirect
+  is temporary if any hop on the way is."""
+
+  def get(self, *args, **kwargs):
+    uri = kwargs.pop('_uri', '/')
+    permanent = kwargs.pop('_permanent', True)
+    code = kwargs.pop('_code', None)
+
+    func = getattr(uri, '__call__', None)
+    if func:
+      uri = func(self, *args, **kwargs)
+
+    uri, temporary = follow_redirects(uri)
+    if temporary:
+      permanent = False
+      code = code if code not in (None, 301) else 302
+    set_redirect_cache_control(self, uri)
+    self.redirect(uri, permanent=permanent, code=code)
+
+class PrefixRouter(Router):
+  """Router that indexes its routes by the literal text their templates start
+  with. Matching a request only tries, in their original order, the routes
+  whose literal prefix the path starts with, so the catch-all ApiDocs route is
+  reached after a handful of regex matches instead of after all of them.
+  Routes that are not plain Routes, like DomainRoute, are always tried."""
+
+  def __init__(self, routes=None):
+    self._index = None
+    super(PrefixRouter, self).__init__(routes)
+
+  def add(self, route):
+    super(PrefixRouter, self).add(route)
+    self._index = None
+
+  def _build_index(self):
+    # A trie over the characters of the literal prefixes. The None key of a
+    # node lists the positions of the routes whose prefix ends there.
+    index = {None: []}
+    for position, route in enumerate(self.match_routes):
+      prefix = ''
+      if isinstance(route, Route):
+        prefix = route.template.split('<', 1)[0]
+      node = index
+      for char in prefix:
+        node = node.setdefault(char, {None: []})
+      node[None].append(position)
+    self._index = index
+
+  def match(self, request):
+    if self._index is None:
+      self._build_index()
+    node = self._index
+    candidates = list(node[None])
+    for char in urllib.unquote(request.path):
+      node = node.get(char)
+      if node is None:
+        break
+      candidates.extend(node[None])
+    candidates.sort()
+
+    method_not_allowed = False
+    for position in candidates:
+      try:
+        match = self.match_routes[position].match(request)
+        if match:
+          return match
+      except exc.HTTPMethodNotAllowed:
+        method_not_allowed = True
+    if method_not_allowed:
+      raise exc.HTTPMethodNotAllowed()
+    raise exc.HTTPNotFound()
+
+class RedirectorApplication(WSGIApplication):
+  router_class = PrefixRouter
+
+application = RedirectorApplication(
   [
     # Legacy domain name, redirect to new domain
     DomainRoute('api.dartlang.org', [
-        Route('/<path:.*>', RedirectHandler,
+        Route('/<path:.*>', ChainedRedirectHandler,
             defaults={'_uri': redir_apidartdev}),
     ]),
+    # Admin only, see app.yaml.
+    Route('/_admin/manifest/<channel:stable|beta|dev|main|be>/'
+        '<version:[\w.+-]+>', BuildManifest),
+    Route('/_admin/stats', Stats),
+    Route('/_refresh', RefreshVersions),
+    Route('/_ah/warmup', Warmup),
+
     # Legacy URL redirection schemes.
     # Redirect all old URL package requests to our updated URL scheme.
     # TODO(efortuna): Remove this line when pkg gets moved off of
@@ -361,92 +1461,94 @@ application = WSGIApplication(
         'json|logging|matcher|mime|mock|observe|path|polymer|'
         'polymer_expressions|sequence_zip|serialization|source_maps|'
         'template_binding|unittest|unmodifiable_collection|utf><:/?>',
-        RedirectHandler, defaults={'_uri': redir_pkgs, '_code': 302}),
-    Route('/dom<path:.*>', RedirectHandler, defaults={'_uri': redir_dom}),
-    Route('/docs/bleeding_edge<path:.*>', RedirectHandler,
+        ChainedRedirectHandler, defaults={'_uri': redir_pkgs, '_code': 302}),
+    Route('/dom<path:.*>', ChainedRedirectHandler,
+        defaults={'_uri': redir_dom}),
+    Route('/docs/bleeding_edge<path:.*>', ChainedRedirectHandler,
         defaults={'_uri': '/be'}),
 
     # Data requests go to cloud storage
-    Route('/apidocs/channels/be/docs<path:.*>', RedirectHandler,
+    Route('/apidocs/channels/be/docs<path:.*>', ChainedRedirectHandler,
         defaults={'_uri': '/be'}),
-    Route('/apidocs/channels/beta/docs<path:.*>', RedirectHandler,
+    Route('/apidocs/channels/beta/docs<path:.*>', ChainedRedirectHandler,
         defaults={'_uri': '/beta'}),
-    Route('/apidocs/channels/dev/docs<path:.*>', RedirectHandler,
+    Route('/apidocs/channels/dev/docs<path:.*>', ChainedRedirectHandler,
         defaults={'_uri': '/dev'}),
-    Route('/apidocs/channels/stable/docs<path:.*>', RedirectHandler,
+    Route('/apidocs/channels/stable/docs<path:.*>', ChainedRedirectHandler,
         defaults={'_uri': '/stable'}),
 
-    Route('/stable/',  RedirectHandler,
+    Route('/stable/',  ChainedRedirectHandler,
         defaults={'_uri': '/stable'}),
-    Route('/latest',  RedirectHandler,
+    Route('/latest',  ChainedRedirectHandler,
         defaults={'_uri': '/stable'}),
-    Route('/dev/',  RedirectHandler,
+    Route('/dev/',  ChainedRedirectHandler,
         defaults={'_uri': '/dev'}),
-    Route('/beta/',  RedirectHandler,
+    Route('/beta/',  ChainedRedirectHandler,
         defaults={'_uri': '/beta'}),
-    Route('/be/',  RedirectHandler,
+    Route('/be/',  ChainedRedirectHandler,
         defaults={'_uri': '/be'}),
-    Route('/bleeding_edge',  RedirectHandler,
+    Route('/bleeding_edge',  ChainedRedirectHandler,
         defaults={'_uri': '/be'}),
-    Route('/be',  RedirectHandler,
+    Route('/be',  ChainedRedirectHandler,
         defaults={'_uri': '/main'}),
-    Route('/main/',  RedirectHandler,
+    Route('/main/',  ChainedRedirectHandler,
         defaults={'_uri': '/main'}),
 
-    Route('/stable/latest', RedirectHandler,
+    Route('/stable/latest', ChainedRedirectHandler,
         defaults={'_uri': '/stable'}),
-    Route('/dev/latest', RedirectHandler,
+    Route('/dev/latest', ChainedRedirectHandler,
         defaults={'_uri': '/dev'}),
-    Route('/beta/latest', RedirectHandler,
+    Route('/beta/latest', ChainedRedirectHandler,
         defaults={'_uri': '/beta'}),
-    Route('/be/latest', RedirectHandler,
+    Route('/be/latest', ChainedRedirectHandler,
         defaults={'_uri': '/be'}),
-    Route('/main/latest', RedirectHandler,
+    Route('/main/latest', ChainedRedirectHandler,
         defaults={'_uri': '/main'}),
 
-    Route('/dart_<libname:[\w]+>.html', RedirectHandler,
+    Route('/dart_<libname:[\w]+>.html', ChainedRedirectHandler,
         defaults={'_uri': redir_legacy_lib}),
 
-    Route('/dart_<libname:[\w]+>/<classname:[\w]+>.html', RedirectHandler,
+    Route('/dart_<libname:[\w]+>/<classname:[\w]+>.html',
+        ChainedRedirectHandler,
         defaults={'_uri': redir_legacy_lib_class}),
 
     # temp routing till stable docs are rolled out
-    Route('/stable', RedirectHandler,
-        defaults={'_uri': redir_stable_latest}), #ApiDocs),
-    Route('/dev', RedirectHandler,
-        defaults={'_uri': redir_dev_latest}), #ApiDocs),
-    Route('/beta', RedirectHandler,
-        defaults={'_uri': redir_beta_latest}),#ApiDocs),
-    Route('/main', RedirectHandler,
-        defaults={'_uri': redir_main_latest}),#ApiDocs),
+    Route('/stable', ChainedRedirectHandler,
+        defaults={'_uri': redir_stable_latest, '_code': 302}), #ApiDocs),
+    Route('/dev', ChainedRedirectHandler,
+        defaults={'_uri': redir_dev_latest, '_code': 302}), #ApiDocs),
+    Route('/beta', ChainedRedirectHandler,
+        defaults={'_uri': redir_beta_latest, '_code': 302}),#ApiDocs),
+    Route('/main', ChainedRedirectHandler,
+        defaults={'_uri': redir_main_latest, '_code': 302}),#ApiDocs),
 
     Route('/apidocs/channels/<channel:stable|dev|be>/dartdoc-viewer<path:.*>',
-        RedirectHandler,
+        ChainedRedirectHandler,
         defaults={'_uri': redir_name}),
 
-    Route('/docs/continuous<path:.*>', RedirectHandler,
+    Route('/docs/continuous<path:.*>', ChainedRedirectHandler,
         defaults={'_uri': '/be'}),
-    Route('/docs/releases/latest<path:.*>', RedirectHandler,
+    Route('/docs/releases/latest<path:.*>', ChainedRedirectHandler,
         defaults={'_uri': '/stable'}),
 
      # Legacy handling: redirect old doc links to apidoc.
-    Route('/docs/channels/be/latest<path:.*>', RedirectHandler,
+    Route('/docs/channels/be/latest<path:.*>', ChainedRedirectHandler,
         defaults={'_uri': redir_old_be}),
-    Route('/docs/channels/dev/latest<path:.*>', RedirectHandler,
+    Route('/docs/channels/dev/latest<path:.*>', ChainedRedirectHandler,
         defaults={'_uri': redir_old_dev}),
-    Route('/docs/channels/stable/latest<path:.*>', RedirectHandler,
+    Route('/docs/channels/stable/latest<path:.*>', ChainedRedirectHandler,
         defaults={'_uri': redir_old_stable}),
-    Route('/docs/channels/be', RedirectHandler,
+    Route('/docs/channels/be', ChainedRedirectHandler,
         defaults={'_uri': '/be'}),
-    Route('/docs/channels/dev', RedirectHandler,
+    Route('/docs/channels/dev', ChainedRedirectHandler,
         defaults={'_uri': '/dev'}),
-    Route('/docs/channels/stable', RedirectHandler,
+    Route('/docs/channels/stable', ChainedRedirectHandler,
         defaults={'_uri': '/stable'}),
 
-    Route('/<version:[\w.-]+>/dart-<libname:\w+>', RedirectHandler,
+    Route('/<version:[\w.-]+>/dart-<libname:\w+>', ChainedRedirectHandler,
         defaults={'_uri': redir_bare_lib_name}),
 
-    Route('/', RedirectHandler, defaults={'_uri': '/stable'}),
+    Route('/', ChainedRedirectHandler, defaults={'_uri': '/stable'}),
 
     Route('<path:.*>', ApiDocs)
   ],
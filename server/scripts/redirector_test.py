@@ -0,0 +1,903 @@
+# Copyright (c) 2026, the Dart project authors.  Please see the AUTHORS file
+# for details. All rights reserved. Use of this source code is governed by a
+# BSD-style license that can be found in the LICENSE file.
+
+"""Tests for redirector.py.
+
+They need the App Engine SDK, and are run from this directory with it on the
+path:
+
+  PYTHONPATH=<path to google_appengine> python -m unittest redirector_test
+
+The docs are read from a docstorage.MemoryStorage, so nothing is fetched from
+Google Storage.
+"""
+
+import json
+import os
+import threading
+import time
+import unittest
+import urlparse
+from datetime import datetime, timedelta
+
+try:
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+except ImportError:
+  pass
+
+# As on App Engine, where google.appengine.ext.webapp is webapp2.
+os.environ.setdefault('APPENGINE_RUNTIME', 'python27')
+os.environ['DOCS_STORAGE'] = 'memory'
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+import webapp2
+from webapp2_extras.routes import DomainRoute
+import webob
+import cloudstorage
+import docstorage
+import redirector
+from redirector import ApiDocs, VersionInfo
+
+LATEST_VERSIONS = {
+  'stable': '3.4.0',
+  'beta': '3.5.0-180.1.beta',
+  'dev': '3.5.0-200.0.dev',
+  'main': '0123456789abcdef0123456789abcdef01234567',
+}
+
+# Every legacy route of the application, with a path it matches.
+LEGACY_PATHS = [
+  'http://api.dartlang.org/stable/3.4.0/index.html',
+  'http://api.dartlang.org/docs/channels/stable',
+  '/docs/pkg/args',
+  '/dom',
+  '/dom/index.html',
+  '/docs/bleeding_edge',
+  '/docs/bleeding_edge/index.html',
+  '/apidocs/channels/be/docs/index.html',
+  '/apidocs/channels/beta/docs/index.html',
+  '/apidocs/channels/dev/docs/index.html',
+  '/apidocs/channels/stable/docs/index.html',
+  '/stable/',
+  '/latest',
+  '/dev/',
+  '/beta/',
+  '/be/',
+  '/bleeding_edge',
+  '/be',
+  '/main/',
+  '/stable/latest',
+  '/dev/latest',
+  '/beta/latest',
+  '/be/latest',
+  '/main/latest',
+  '/dart_core.html',
+  '/dart_core/Iterable.html',
+  '/stable',
+  '/dev',
+  '/beta',
+  '/main',
+  '/apidocs/channels/stable/dartdoc-viewer/home',
+  '/apidocs/channels/dev/dartdoc-viewer/dart:math',
+  '/apidocs/channels/be/dartdoc-viewer/dart-async.Future',
+  '/docs/continuous',
+  '/docs/releases/latest/index.html',
+  '/docs/channels/be/latest/index.html',
+  '/docs/channels/dev/latest',
+  '/docs/channels/stable/latest/dart_core.html',
+  '/docs/channels/be',
+  '/docs/channels/dev',
+  '/docs/channels/stable',
+  '/1.12.0/dart-async',
+  '/',
+  # Redirected by ApiDocs itself.
+  '/3.4.0',
+  '/stable/not-a-version/index.html',
+  '/136052/index.html',
+]
+
+
+class RedirectorTestCase(unittest.TestCase):
+  """Runs every test with empty caches, its own MemoryStorage and the latest
+  versions of LATEST_VERSIONS."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_user_stub()
+    ndb.get_context().clear_cache()
+    ApiDocs.doc_infos.clear()
+    ApiDocs.contents.clear()
+    ApiDocs.manifests.clear()
+    ApiDocs.bloom_filters.clear()
+    self.storage = ApiDocs.storage
+    ApiDocs.storage = docstorage.MemoryStorage()
+    self.latest_versions = ApiDocs.latest_versions
+    ApiDocs.latest_versions = dict(
+        (channel, VersionInfo(info.update_interval))
+        for channel, info in self.latest_versions.iteritems())
+    self.get_latest_version = ApiDocs.get_latest_version
+    ApiDocs.get_latest_version = (
+        lambda handler, channel: LATEST_VERSIONS[channel])
+
+  def tearDown(self):
+    ApiDocs.get_latest_version = self.get_latest_version
+    ApiDocs.latest_versions = self.latest_versions
+    ApiDocs.storage = self.storage
+    self.testbed.deactivate()
+
+  def get(self, url, headers=None):
+    # A webapp2 response would replace the Cache-Control header it was built
+    # with by no-cache.
+    return webob.Request.blank(url, headers=headers).get_response(
+        redirector.application)
+
+  def build_index(self, channel, version):
+    """Build the manifest and Bloom filter of the docs version from what is
+    in storage."""
+    response = webob.Request.blank(
+        '/_admin/manifest/%s/%s' % (channel, version),
+        POST={}).get_response(redirector.application)
+    self.assertEqual(200, response.status_int, response.body)
+
+
+class LegacyRoutesTest(RedirectorTestCase):
+
+  def test_legacy_routes_redirect_once(self):
+    for path in LEGACY_PATHS:
+      response = self.get(path)
+      self.assertIn(response.status_int, (301, 302), path)
+      location = response.headers['Location']
+      scheme, netloc, target, query, _ = urlparse.urlsplit(location)
+      if netloc not in redirector.OWN_HOSTS + ('localhost',):
+        # Another site, whose redirects are not ours to collapse.
+        continue
+      if netloc not in redirector.OWN_HOSTS:
+        location = urlparse.urlunsplit(('', '', target, query, ''))
+      self.assertIsNone(redirector.redirect_target(location), path)
+      response = self.get(urlparse.urlunsplit((scheme, netloc, target, query,
+                                               '')))
+      self.assertNotIn(response.status_int, (301, 302, 303, 307, 308),
+                       '%s redirects to %s, which redirects to %s'
+                       % (path, location, response.headers.get('Location')))
+
+  def test_channel_redirects_to_latest_version(self):
+    response = self.get('/stable')
+    self.assertEqual('http://localhost/stable/3.4.0/index.html',
+                     response.headers['Location'])
+    self.assertEqual((u'/main/%s/index.html' % LATEST_VERSIONS['main'], True),
+                     redirector.follow_redirects('/be'))
+
+  def test_channel_redirect_is_cached_until_the_next_check(self):
+    version_info = ApiDocs.latest_versions['stable']
+    version_info.version = LATEST_VERSIONS['stable']
+    for left, age in ((timedelta(minutes=5), 300), (timedelta(hours=3), 600),
+                      (timedelta(0), 0), (-timedelta(hours=1), 0)):
+      version_info.last_check = (datetime.now() -
+                                 version_info.update_interval + left)
+      cache_control = self.get('/stable').headers['Cache-Control']
+      max_age = int(cache_control.split(',')[0][len('max-age='):])
+      self.assertTrue(age - 1 <= max_age <= age, (left, cache_control))
+
+
+def route_prefixes(routes):
+  """The literal prefixes of the templates of routes, including the routes
+  nested in DomainRoutes."""
+  for route in routes:
+    if isinstance(route, DomainRoute):
+      for prefix in route_prefixes(route.routes):
+        yield prefix
+    else:
+      yield route.template.split('<', 1)[0]
+
+
+def router_cases():
+  """Paths and hosts around every route of the application: each literal
+  prefix on its own, cut short and followed by the paths that routes look
+  for, plus the legacy paths."""
+  suffixes = ['', '/', 'x', '/x', '/index.html', '/latest', '/latest/',
+              '/3.4.0', '/3.4.0/index.html', '/dart-core/String-class.html',
+              '/docs/index.html', '/dartdoc-viewer/dart:math', '%3A', ':',
+              '/args', '/args/', '.html', '/../stable']
+  paths = set(path for path in LEGACY_PATHS if path.startswith('/'))
+  for prefix in set(route_prefixes(redirector.application.router.match_routes)):
+    for length in range(1, len(prefix) + 1):
+      paths.add(prefix[:length])
+    for suffix in suffixes:
+      paths.add(prefix + suffix)
+      paths.add(prefix.rstrip('/') + suffix)
+  for channel in ('stable', 'beta', 'dev', 'be', 'main', 'latest'):
+    for suffix in suffixes:
+      paths.add('/' + channel + suffix)
+      paths.add('/docs/channels/' + channel + suffix)
+      paths.add('/apidocs/channels/' + channel + suffix)
+  for path in sorted(paths):
+    if not path.startswith('/'):
+      path = '/' + path
+    for host in ('api.dart.dev', 'api.dartlang.org', 'localhost:8080'):
+      yield path, host
+
+
+class PrefixRouterTest(unittest.TestCase):
+
+  def match(self, router, path, host, method='GET'):
+    request = webapp2.Request.blank(path, base_url='http://' + host)
+    request.method = method
+    try:
+      return router.match(request)
+    except Exception as e:
+      return type(e)
+
+  def test_matches_like_the_linear_router(self):
+    routes = redirector.application.router.match_routes
+    router = redirector.PrefixRouter(routes)
+    linear = webapp2.Router(routes)
+    cases = list(router_cases())
+    self.assertGreater(len(cases), 1000)
+    for path, host in cases:
+      for method in ('GET', 'POST'):
+        self.assertEqual(self.match(linear, path, host, method),
+                         self.match(router, path, host, method),
+                         '%s %s%s' % (method, host, path))
+
+  def test_routes_added_later_are_matched(self):
+    router = redirector.PrefixRouter([
+        webapp2.Route('/<path:.*>', 'catch-all')])
+    router.add(webapp2.Route('/stable/<path:.*>', 'stable'))
+    request = webapp2.Request.blank('/stable/index.html')
+    self.assertEqual('catch-all', router.match(request)[0].handler)
+    router = redirector.PrefixRouter([
+        webapp2.Route('/stable/<path:.*>', 'stable')])
+    router.add(webapp2.Route('/<path:.*>', 'catch-all'))
+    self.assertEqual('stable', router.match(request)[0].handler)
+    request = webapp2.Request.blank('/beta/index.html')
+    self.assertEqual('catch-all', router.match(request)[0].handler)
+
+
+class CallGroupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.group = redirector.CallGroup()
+    self.started = threading.Event()
+    self.proceed = threading.Event()
+    self.calls = []
+
+  def slow_call(self, result):
+    """A call that returns or raises result once proceed is set."""
+    def call():
+      self.calls.append(result)
+      self.started.set()
+      self.proceed.wait()
+      if isinstance(result, Exception):
+        raise result
+      return result
+    return call
+
+  def run_concurrently(self, key, result, waiters=4):
+    """Call the group for key from a leader and waiters threads, the waiters
+    joining while the leader's call is in flight. Returns what each thread
+    got, a result or an exception."""
+    outcomes = []
+    def do():
+      try:
+        outcomes.append(self.group.do(key, self.slow_call(result)))
+      except Exception as e:
+        outcomes.append(e)
+    threads = [threading.Thread(target=do)]
+    threads[0].start()
+    self.started.wait()
+    threads += [threading.Thread(target=do) for _ in range(waiters)]
+    for thread in threads[1:]:
+      thread.start()
+    # The waiters must be waiting before the call returns.
+    while self.group.shared < waiters:
+      time.sleep(0.001)
+    self.proceed.set()
+    for thread in threads:
+      thread.join()
+    return outcomes
+
+  def test_concurrent_callers_share_one_call(self):
+    self.assertEqual(['result'] * 5, self.run_concurrently('a', 'result'))
+    self.assertEqual(['result'], self.calls)
+    self.assertEqual(1, self.group.calls)
+    self.assertEqual(4, self.group.shared)
+
+  def test_concurrent_callers_share_the_exception(self):
+    error = cloudstorage.TransientError('down')
+    self.assertEqual([error] * 5, self.run_concurrently('a', error))
+    self.assertEqual(1, len(self.calls))
+
+  def test_later_callers_make_a_new_call(self):
+    self.proceed.set()
+    self.assertEqual(1, self.group.do('a', self.slow_call(1)))
+    self.assertEqual(2, self.group.do('a', self.slow_call(2)))
+    self.assertRaises(ValueError, self.group.do, 'a',
+                      self.slow_call(ValueError()))
+    self.assertEqual(3, self.group.do('a', self.slow_call(3)))
+    self.assertEqual(4, self.group.calls)
+    self.assertEqual(0, self.group.shared)
+
+  def test_keys_do_not_share_calls(self):
+    group = self.group
+    inner = []
+    # A call for another key made from within a call is not held up.
+    self.assertEqual('a', group.do('a', lambda: inner.append(
+        group.do('b', lambda: 'b')) or 'a'))
+    self.assertEqual(['b'], inner)
+    self.assertEqual(2, group.calls)
+
+
+class FlakyStorage(docstorage.MemoryStorage):
+  """A MemoryStorage that fails every lookup of a page and every read of an
+  index with error while it is set, as Google Storage does when it is down.
+  Reads of pages still succeed."""
+
+  def __init__(self):
+    docstorage.MemoryStorage.__init__(self)
+    self.error = None
+    self.index_reads = 0
+    self.stats = 0
+
+  def open(self, path, mode='r', content_type=None):
+    if mode == 'r' and path.startswith(ApiDocs.GOOGLE_STORAGE_MANIFESTS):
+      self.index_reads += 1
+      if self.error:
+        raise self.error('Could not read ' + path)
+    return docstorage.MemoryStorage.open(self, path, mode, content_type)
+
+  def stat(self, path):
+    self.stats += 1
+    if self.error:
+      raise self.error('Could not stat ' + path)
+    return docstorage.MemoryStorage.stat(self, path)
+
+
+class StorageFailureTest(RedirectorTestCase):
+
+  ROOT = ApiDocs.GOOGLE_STORAGE_NEW + '/stable/3.4.0'
+  PAGE = ROOT + '/index.html'
+
+  def setUp(self):
+    RedirectorTestCase.setUp(self)
+    ApiDocs.storage = FlakyStorage()
+    ApiDocs.storage.put(self.PAGE, '<html></html>', 'text/html')
+
+  def fail_with(self, error):
+    """Make storage fail with error, once the page has been looked up and
+    this instance has forgotten about it."""
+    self.assertEqual(200, self.get('/stable/3.4.0/index.html').status_int)
+    ApiDocs.storage.error = error
+    ApiDocs.doc_infos.clear()
+    ApiDocs.manifests.clear()
+    ApiDocs.bloom_filters.clear()
+    memcache.delete('/gs' + self.PAGE)
+
+  def test_known_page_is_served_while_storage_fails(self):
+    for error in (cloudstorage.TransientError, cloudstorage.TimeoutError):
+      self.fail_with(error)
+      response = self.get('/stable/3.4.0/index.html')
+      self.assertEqual(200, response.status_int, error)
+      self.assertEqual('<html></html>', response.body)
+      ApiDocs.storage.error = None
+
+  def test_failed_index_loads_are_not_retried_at_once(self):
+    for error in (cloudstorage.TransientError, cloudstorage.TimeoutError):
+      self.fail_with(error)
+      ApiDocs.storage.index_reads = 0
+      for _ in range(3):
+        self.get('/stable/3.4.0/index.html')
+        self.get('/stable/3.4.0/dart-core/dart-core-library.html')
+      # One read of the Bloom filter, one of the manifest.
+      self.assertEqual(2, ApiDocs.storage.index_reads, error)
+      ApiDocs.storage.error = None
+
+  def test_unknown_page_is_unavailable_while_storage_fails(self):
+    for error in (cloudstorage.TransientError, cloudstorage.TimeoutError):
+      ApiDocs.storage.error = error
+      ApiDocs.doc_infos.clear()
+      path = '/stable/3.4.0/dart-core/dart-core-library.html'
+      response = self.get(path)
+      self.assertEqual(503, response.status_int, error)
+      self.assertEqual(str(ApiDocs.LOOKUP_RETRY_INTERVAL),
+                       response.headers['Retry-After'])
+      self.assertIn('no-store', response.headers['Cache-Control'])
+      # The page may well exist, so it must not be remembered as missing.
+      self.assertIsNone(memcache.get('/gs' + self.ROOT +
+                                     '/dart-core/dart-core-library.html'))
+
+
+class ConditionalRequestTest(RedirectorTestCase):
+
+  PAGE = ApiDocs.GOOGLE_STORAGE_NEW + '/stable/3.4.0/index.html'
+  INFO = redirector.DocInfo(13, '0a1b2c3d', 1700000000.5)
+  LAST_MODIFIED = 'Tue, 14 Nov 2023 22:13:20 GMT'
+
+  def not_modified(self, headers, info=INFO):
+    request = webapp2.Request.blank('/stable/3.4.0/index.html',
+                                    headers=headers)
+    return ApiDocs(request).is_not_modified(info)
+
+  def test_if_none_match(self):
+    for value in ('"0a1b2c3d"', 'W/"0a1b2c3d"', '"other", "0a1b2c3d"',
+                  '"other",W/"0a1b2c3d"', '*'):
+      self.assertTrue(self.not_modified({'If-None-Match': value}), value)
+    for value in ('"other"', '0a1b2c3d', '"0A1B2C3D"', ''):
+      self.assertFalse(self.not_modified({'If-None-Match': value}), value)
+    self.assertFalse(self.not_modified({'If-None-Match': '*'},
+                                       redirector.DocInfo(13)))
+
+  def test_if_modified_since(self):
+    self.assertTrue(self.not_modified(
+        {'If-Modified-Since': self.LAST_MODIFIED}))
+    self.assertTrue(self.not_modified(
+        {'If-Modified-Since': 'Wed, 15 Nov 2023 00:00:00 GMT'}))
+    self.assertFalse(self.not_modified(
+        {'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:19 GMT'}))
+    for value in ('yesterday', '', 'Tue, 14 Nov'):
+      self.assertFalse(self.not_modified({'If-Modified-Since': value}),
+                       value)
+    self.assertFalse(self.not_modified(
+        {'If-Modified-Since': self.LAST_MODIFIED}, redirector.DocInfo(13)))
+
+  def test_if_none_match_takes_precedence(self):
+    self.assertFalse(self.not_modified(
+        {'If-None-Match': '"other"',
+         'If-Modified-Since': 'Wed, 15 Nov 2023 00:00:00 GMT'}))
+    self.assertTrue(self.not_modified(
+        {'If-None-Match': '"0a1b2c3d"',
+         'If-Modified-Since': 'Tue, 14 Nov 2023 00:00:00 GMT'}))
+
+  def test_current_copy_gets_304(self):
+    ApiDocs.storage.put(self.PAGE, '<html></html>', 'text/html')
+    response = self.get('/stable/3.4.0/index.html')
+    self.assertEqual(200, response.status_int)
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+    for headers in ({'If-None-Match': etag},
+                    {'If-Modified-Since': last_modified}):
+      response = self.get('/stable/3.4.0/index.html', headers)
+      self.assertEqual(304, response.status_int, headers)
+      self.assertEqual('', response.body)
+      self.assertEqual(etag, response.headers['ETag'])
+    response = self.get('/stable/3.4.0/index.html',
+                        {'If-None-Match': '"other"'})
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('<html></html>', response.body)
+
+
+class ContentTypeTest(RedirectorTestCase):
+
+  ROOT = ApiDocs.GOOGLE_STORAGE_NEW + '/stable/3.4.0'
+  GZIPPED = '\x1f\x8b\x08\x00gzipped index'
+
+  def setUp(self):
+    RedirectorTestCase.setUp(self)
+    ApiDocs.storage.put(self.ROOT + '/index.html', '<html></html>',
+                        'text/html; charset=utf-8')
+    ApiDocs.storage.put(self.ROOT + '/index.html.gz', self.GZIPPED)
+
+  def check(self, indexed):
+    response = self.get('/stable/3.4.0/index.html')
+    self.assertEqual('text/html; charset=utf-8',
+                     response.headers['Content-Type'], indexed)
+    response = self.get('/stable/3.4.0/index.html.gz')
+    self.assertEqual(200, response.status_int, indexed)
+    self.assertEqual('text/html', response.headers['Content-Type'], indexed)
+    self.assertEqual('gzip', response.headers['Content-Encoding'], indexed)
+    self.assertEqual(self.GZIPPED, response.body)
+
+  def test_content_type_of_the_object_is_sent(self):
+    self.check(indexed=False)
+
+  def test_content_type_of_the_manifest_is_sent(self):
+    self.build_index('stable', '3.4.0')
+    # The manifest is used, not a stat of the object.
+    ApiDocs.storage.put(self.ROOT + '/index.html', '<html></html>')
+    self.check(indexed=True)
+
+
+class CompressionTest(RedirectorTestCase):
+
+  ROOT = ApiDocs.GOOGLE_STORAGE_NEW + '/stable/3.4.0'
+  PAGES = {
+    'index.html': '<html>index</html>',
+    'index.html.gz': 'gzipped index',
+    'index.html.br': 'brotli index',
+    'static-assets/styles.css': 'body {}',
+    'static-assets/styles.css.gz': 'gzipped styles',
+    'static-assets/logo.png': 'PNG',
+    'static-assets/logo.png.gz': 'gzipped PNG',
+  }
+
+  def setUp(self):
+    RedirectorTestCase.setUp(self)
+    for path, content in self.PAGES.iteritems():
+      ApiDocs.storage.put(self.ROOT + '/' + path, content)
+
+  def get_page(self, path, accept_encoding=None, **headers):
+    if accept_encoding is not None:
+      headers['Accept-Encoding'] = accept_encoding
+    response = self.get('/stable/3.4.0/' + path, headers)
+    self.assertEqual(200, response.status_int, path)
+    return response
+
+  def test_encoding_qualities(self):
+    quality = redirector.encoding_qualities('gzip;q=0.5, BR, identity;q=0')
+    self.assertEqual((0.5, 1.0, 0.0, 0.0),
+                     (quality('gzip'), quality('br'), quality('identity'),
+                      quality('deflate')))
+    quality = redirector.encoding_qualities('gzip;q=0, *;q=0.2')
+    self.assertEqual((0.0, 0.2), (quality('gzip'), quality('br')))
+    quality = redirector.encoding_qualities('gzip; q=oops, , br ; q=0.1')
+    self.assertEqual((0.0, 0.1), (quality('gzip'), quality('br')))
+    self.assertEqual(0.0, redirector.encoding_qualities(None)('gzip'))
+
+  def test_best_accepted_copy_is_sent(self):
+    self.build_index('stable', '3.4.0')
+    for accept_encoding, encoding in (
+        ('gzip, deflate, br', 'br'),
+        ('gzip', 'gzip'),
+        ('br;q=0.5, gzip', 'gzip'),
+        ('gzip;q=0, *', 'br'),
+        ('br;q=0, gzip;q=0, *', None),
+        ('*', 'br'),
+        ('identity', None),
+        ('', None),
+        (None, None)):
+      response = self.get_page('index.html', accept_encoding)
+      self.assertEqual('Accept-Encoding', response.headers['Vary'])
+      self.assertEqual(encoding, response.headers.get('Content-Encoding'),
+                       accept_encoding)
+      name = 'index.html' + {'br': '.br', 'gzip': '.gz', None: ''}[encoding]
+      self.assertEqual(self.PAGES[name], response.body, accept_encoding)
+      self.assertEqual('text/html', response.headers['Content-Type'])
+      stat = ApiDocs.storage.stat(self.ROOT + '/' + name)
+      self.assertEqual('"%s"' % stat.etag, response.headers['ETag'])
+
+  def test_missing_copies_are_skipped(self):
+    self.build_index('stable', '3.4.0')
+    response = self.get_page('static-assets/styles.css', 'br, gzip')
+    self.assertEqual('gzip', response.headers['Content-Encoding'])
+    self.assertEqual('text/css', response.headers['Content-Type'])
+    response = self.get_page('static-assets/styles.css', 'br')
+    self.assertNotIn('Content-Encoding', response.headers)
+    self.assertEqual('body {}', response.body)
+
+  def test_only_compressible_pages_vary(self):
+    self.build_index('stable', '3.4.0')
+    response = self.get_page('static-assets/logo.png', 'gzip')
+    self.assertNotIn('Vary', response.headers)
+    self.assertNotIn('Content-Encoding', response.headers)
+    self.assertEqual('PNG', response.body)
+
+  def test_copies_are_only_used_once_indexed(self):
+    response = self.get_page('index.html', 'gzip')
+    self.assertEqual('Accept-Encoding', response.headers['Vary'])
+    self.assertNotIn('Content-Encoding', response.headers)
+    self.assertEqual(self.PAGES['index.html'], response.body)
+
+  def test_ranges_are_cut_from_the_page(self):
+    self.build_index('stable', '3.4.0')
+    response = self.get('/stable/3.4.0/index.html',
+                        {'Accept-Encoding': 'gzip', 'Range': 'bytes=0-5'})
+    self.assertEqual(206, response.status_int)
+    self.assertNotIn('Content-Encoding', response.headers)
+    self.assertEqual('Accept-Encoding', response.headers['Vary'])
+    self.assertEqual(self.PAGES['index.html'][:6], response.body)
+
+
+class ByteRangeTest(RedirectorTestCase):
+
+  ROOT = ApiDocs.GOOGLE_STORAGE_NEW + '/stable/3.4.0'
+  # A page kept in the content cache, and one sent by the storage backend.
+  SMALL = ''.join(chr(i % 251) for i in xrange(1000))
+  LARGE = ''.join(chr(i % 251) for i in
+                  xrange(ApiDocs.CONTENT_CACHE_MAX_SIZE + 1000))
+
+  def setUp(self):
+    RedirectorTestCase.setUp(self)
+    ApiDocs.storage.put(self.ROOT + '/small.js', self.SMALL,
+                        'application/javascript')
+    ApiDocs.storage.put(self.ROOT + '/large.js', self.LARGE,
+                        'application/javascript')
+
+  def get_range(self, name, value, **headers):
+    headers['Range'] = value
+    return self.get('/stable/3.4.0/' + name, headers)
+
+  def pages(self):
+    return (('small.js', self.SMALL), ('large.js', self.LARGE))
+
+  def test_parse_byte_ranges(self):
+    parse = redirector.parse_byte_ranges
+    for header, ranges in (
+        ('bytes=0-9', [(0, 9)]),
+        ('bytes=5-', [(5, 99)]),
+        ('bytes=90-200', [(90, 99)]),
+        ('bytes=-10', [(90, 99)]),
+        ('bytes=-200', [(0, 99)]),
+        ('bytes=0-0,-1', [(0, 0), (99, 99)]),
+        (' Bytes = 0-1, ,4-5 ', [(0, 1), (4, 5)]),
+        ('bytes=-0', []),
+        ('bytes=100-', []),
+        ('bytes=100-200, -0', []),
+        ('bytes=100-200, 10-19', [(10, 19)])):
+      self.assertEqual(ranges, parse(header, 100), header)
+    for header in ('items=0-9', 'bytes=', 'bytes=9-0', 'bytes=a-b',
+                   'bytes=-', 'bytes=0-1,x', 'bytes 0-9', 'bytes=0-9-'):
+      self.assertIsNone(parse(header, 100), header)
+
+  def test_single_range(self):
+    for name, content in self.pages():
+      size = len(content)
+      for value, start, end in (('bytes=10-19', 10, 19),
+                                ('bytes=-10', size - 10, size - 1),
+                                ('bytes=%d-' % (size - 5), size - 5, size - 1),
+                                ('bytes=0-%d' % (size * 2), 0, size - 1)):
+        response = self.get_range(name, value)
+        self.assertEqual(206, response.status_int, (name, value))
+        self.assertEqual('bytes %d-%d/%d' % (start, end, size),
+                         response.headers['Content-Range'])
+        self.assertEqual('application/javascript',
+                         response.headers['Content-Type'])
+        self.assertEqual(content[start:end + 1], response.body)
+
+  def test_unsatisfiable_range(self):
+    for name, content in self.pages():
+      response = self.get_range(name, 'bytes=%d-' % len(content))
+      self.assertEqual(416, response.status_int, name)
+      self.assertEqual('bytes */%d' % len(content),
+                       response.headers['Content-Range'])
+      self.assertEqual('no-store', response.headers['Cache-Control'])
+
+  def test_invalid_range_is_ignored(self):
+    for name, content in self.pages():
+      response = self.get_range(name, 'bytes=20-10')
+      self.assertEqual(200, response.status_int, name)
+      self.assertEqual('bytes', response.headers['Accept-Ranges'])
+      self.assertEqual(content, response.body)
+
+  def test_if_range(self):
+    for name, content in self.pages():
+      response = self.get('/stable/3.4.0/' + name)
+      etag = response.headers['ETag']
+      last_modified = response.headers['Last-Modified']
+      for if_range, status in ((etag, 206), (last_modified, 206),
+                               ('"other"', 200), ('W/' + etag, 200),
+                               ('Mon, 01 Jan 2001 00:00:00 GMT', 200),
+                               ('not a date', 200)):
+        response = self.get_range(name, 'bytes=0-9', **{'If-Range': if_range})
+        self.assertEqual(status, response.status_int, (name, if_range))
+        self.assertEqual(content[:10] if status == 206 else content,
+                         response.body)
+
+  def parse_multipart(self, response):
+    """The Content-Type, Content-Range and body of each part."""
+    content_type, _, boundary = response.headers['Content-Type'].partition(
+        '; boundary=')
+    self.assertEqual('multipart/byteranges', content_type)
+    body = response.body
+    self.assertTrue(body.endswith('--%s--\r\n' % boundary))
+    parts = []
+    for part in body.split('--%s' % boundary)[1:-1]:
+      headers, _, content = part[len('\r\n'):].partition('\r\n\r\n')
+      headers = dict(line.split(': ', 1) for line in headers.split('\r\n'))
+      self.assertTrue(content.endswith('\r\n'))
+      parts.append((headers['Content-Type'], headers['Content-Range'],
+                    content[:-len('\r\n')]))
+    return parts
+
+  def test_multiple_ranges(self):
+    for name, content in self.pages():
+      size = len(content)
+      response = self.get_range(name, 'bytes=0-4, 10-14, -3')
+      self.assertEqual(206, response.status_int, name)
+      self.assertNotIn('Content-Range', response.headers)
+      self.assertEqual([
+        ('application/javascript', 'bytes 0-4/%d' % size, content[0:5]),
+        ('application/javascript', 'bytes 10-14/%d' % size, content[10:15]),
+        ('application/javascript', 'bytes %d-%d/%d' % (size - 3, size - 1,
+                                                       size), content[-3:]),
+      ], self.parse_multipart(response))
+
+  def test_too_many_ranges_get_the_whole_page(self):
+    value = 'bytes=' + ','.join('%d-%d' % (i * 10, i * 10)
+                                for i in xrange(ApiDocs.MAX_RANGES + 1))
+    for name, content in self.pages():
+      response = self.get_range(name, value)
+      self.assertEqual(200, response.status_int, name)
+      self.assertEqual(content, response.body)
+
+
+class MissingPageTest(RedirectorTestCase):
+
+  ROOT = ApiDocs.GOOGLE_STORAGE_NEW + '/stable/3.4.0'
+  PATH = '/stable/3.4.0/dart-core/List-class.html'
+  GCS_PATH = '/gs' + ROOT + '/dart-core/List-class.html'
+
+  def setUp(self):
+    RedirectorTestCase.setUp(self)
+    # The clock of memcache, which testbed has no option for.
+    self.now = time.time()
+    self.testbed.get_stub(testbed.MEMCACHE_SERVICE_NAME)._gettime = (
+        lambda: self.now)
+    ApiDocs.storage = FlakyStorage()
+
+  def test_missing_page_is_shared_for_a_short_time(self):
+    self.assertEqual(404, self.get(self.PATH).status_int)
+    self.assertEqual('0', memcache.get(self.GCS_PATH))
+    self.assertEqual(1, ApiDocs.storage.stats)
+    # Another instance takes the page as missing without a probe, once the
+    # finding of the probe lease is gone too.
+    self.now += ApiDocs.PROBE_LEASE_TIME + 1
+    ApiDocs.doc_infos.clear()
+    self.assertEqual(404, self.get(self.PATH).status_int)
+    self.assertEqual(1, ApiDocs.storage.stats)
+    # Until the page is published.
+    ApiDocs.storage.put(self.ROOT + '/dart-core/List-class.html', 'List',
+                        'text/html')
+    self.now += ApiDocs.DOC_INFO_MISSING_TTL + 1
+    ApiDocs.doc_infos.clear()
+    self.assertIsNone(memcache.get(self.GCS_PATH))
+    response = self.get(self.PATH)
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('List', response.body)
+    self.assertEqual(2, ApiDocs.storage.stats)
+
+
+class LatestVersionTest(RedirectorTestCase):
+
+  def setUp(self):
+    RedirectorTestCase.setUp(self)
+    ApiDocs.get_latest_version = self.get_latest_version
+    self.apidocs = ApiDocs(webapp2.Request.blank('/stable'))
+    self.version_info = ApiDocs.latest_versions['stable']
+    self.publish('3.4.0')
+
+  def publish(self, version):
+    ApiDocs.storage.put(self.apidocs.version_file_loc('stable'), version)
+
+  def expire(self):
+    """Make the known version out of date."""
+    self.version_info.last_check = (datetime.now() -
+                                    self.version_info.update_interval)
+
+  def test_reads_the_latest_version_once(self):
+    self.assertEqual('3.4.0', self.apidocs.get_latest_version('stable'))
+    self.publish('3.4.1')
+    self.assertEqual('3.4.0', self.apidocs.get_latest_version('stable'))
+    self.assertEqual(1, self.version_info.misses)
+    self.assertEqual(1, self.version_info.hits)
+
+  def test_rereads_an_out_of_date_version(self):
+    self.apidocs.get_latest_version('stable')
+    self.publish('3.4.1')
+    self.expire()
+    self.assertEqual('3.4.1', self.apidocs.get_latest_version('stable'))
+    self.assertEqual(2, self.version_info.misses)
+
+  def test_one_request_refreshes_while_the_others_serve_the_known_version(self):
+    self.apidocs.get_latest_version('stable')
+    self.publish('3.4.1')
+    self.expire()
+    reading = threading.Event()
+    proceed = threading.Event()
+    recheck_latest_version = ApiDocs.recheck_latest_version
+    def slow_recheck(handler, channel):
+      reading.set()
+      proceed.wait()
+      return recheck_latest_version(handler, channel)
+    ApiDocs.recheck_latest_version = slow_recheck
+    try:
+      refreshed = []
+      refresh = threading.Thread(target=lambda: refreshed.append(
+          self.apidocs.get_latest_version('stable')))
+      refresh.start()
+      reading.wait()
+      for _ in range(5):
+        self.assertEqual('3.4.0', self.apidocs.get_latest_version('stable'))
+      proceed.set()
+      refresh.join()
+    finally:
+      ApiDocs.recheck_latest_version = recheck_latest_version
+    self.assertEqual(['3.4.1'], refreshed)
+    self.assertEqual('3.4.1', self.apidocs.get_latest_version('stable'))
+    self.assertEqual(2, self.version_info.misses)
+
+  def test_failed_refresh_keeps_the_known_version(self):
+    self.apidocs.get_latest_version('stable')
+    del ApiDocs.storage.objects[self.apidocs.version_file_loc('stable')]
+    self.expire()
+    self.assertEqual('3.4.0', self.apidocs.get_latest_version('stable'))
+    self.assertEqual(1, self.version_info.errors)
+    # It is only tried again after RETRY_INTERVAL.
+    self.assertFalse(self.version_info.should_update())
+    self.assertEqual('3.4.0', self.apidocs.get_latest_version('stable'))
+    self.assertEqual(1, self.version_info.errors)
+
+  def test_failed_first_read_raises(self):
+    del ApiDocs.storage.objects[self.apidocs.version_file_loc('stable')]
+    self.assertRaises(cloudstorage.NotFoundError,
+                      self.apidocs.get_latest_version, 'stable')
+    self.assertEqual(1, self.version_info.errors)
+
+  def test_instance_holding_the_lease_refreshes_for_all(self):
+    self.apidocs.get_latest_version('stable')
+    self.publish('3.4.1')
+    self.expire()
+    memcache.add('latest_version_lease:stable', '')
+    self.assertEqual('3.4.0', self.apidocs.get_latest_version('stable'))
+    self.assertEqual(1, self.version_info.misses)
+    self.assertEqual(1, self.version_info.deferred)
+    self.assertFalse(self.version_info.should_update())
+    # The lease holder shares what it read, and that is taken up at the next
+    # look at the shared version.
+    memcache.set(self.apidocs.shared_version_key('stable'), {
+      'version': '3.4.1', 'generation': 1000, 'checked': datetime.now(),
+    })
+    self.version_info.last_shared_check -= VersionInfo.SHARED_CHECK_INTERVAL
+    self.assertEqual('3.4.1', self.apidocs.get_latest_version('stable'))
+    self.assertEqual(1, self.version_info.misses)
+
+  def test_lease_is_held_after_a_refresh(self):
+    self.apidocs.get_latest_version('stable')
+    self.expire()
+    self.apidocs.get_latest_version('stable')
+    self.assertEqual(2, self.version_info.misses)
+    self.assertIsNotNone(memcache.get('latest_version_lease:stable'))
+
+
+class RefreshVersionsTest(RedirectorTestCase):
+
+  TOKEN = 'secret-token'
+
+  def setUp(self):
+    RedirectorTestCase.setUp(self)
+    ApiDocs.get_latest_version = self.get_latest_version
+    ApiDocs.storage.put(ApiDocs.GOOGLE_STORAGE + '/stable/latest.txt',
+                        '3.4.1')
+
+  def refresh(self, headers=None):
+    return webob.Request.blank(
+        '/_refresh?channel=stable', headers=headers,
+        POST={}).get_response(redirector.application)
+
+  def test_admin_is_authorized(self):
+    self.testbed.setup_env(user_email='admin@example.com', user_id='1',
+                           user_is_admin='1', overwrite=True)
+    response = self.refresh()
+    self.assertEqual(200, response.status_int)
+    self.assertEqual({'stable': '3.4.1'}, json.loads(response.body))
+    self.assertEqual('3.4.1', ApiDocs.latest_versions['stable'].version)
+
+  def test_bearer_token_is_authorized(self):
+    redirector.RefreshToken(id='refresh', token=self.TOKEN).put()
+    response = self.refresh({'Authorization': 'Bearer ' + self.TOKEN})
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('3.4.1', ApiDocs.latest_versions['stable'].version)
+
+  def test_others_are_refused(self):
+    redirector.RefreshToken(id='refresh', token=self.TOKEN).put()
+    for headers in (None, {'Authorization': 'Bearer wrong'},
+                    {'Authorization': 'Bearer '},
+                    {'Authorization': self.TOKEN}):
+      self.assertEqual(403, self.refresh(headers).status_int, headers)
+    self.assertIsNone(ApiDocs.latest_versions['stable'].version)
+
+  def test_no_token_is_refused(self):
+    response = self.refresh({'Authorization': 'Bearer '})
+    self.assertEqual(403, response.status_int)
+    redirector.RefreshToken(id='refresh').put()
+    response = self.refresh({'Authorization': 'Bearer '})
+    self.assertEqual(403, response.status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()